@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the pre-processing pipeline and of the DataLoader query patterns, on synthetic data.
+
+Every benchmark runs in a fresh process, so its peak memory is its own. Results are written to
+<results_dir>/<version>_<n_participants>.json, by default under the work directory, to be compared
+across releases with --baseline.
+
+Example:
+    python benchmarks/run_benchmarks.py --n_participants 10000 --work_dir /tmp/ukbb_bench
+"""
+import argparse
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import time
+from functools import partial
+from os.path import join as pjoin
+from typing import Callable, Dict, List
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s:%(lineno)d - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def get_args():
+    """
+    Parse arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--work_dir", type=str, required=True, help="Directory for the synthetic raw and derived data.")
+    parser.add_argument("--n_participants", type=int, default=10_000, help="Number of synthetic participants.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data generator.")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs of each query benchmark; the fastest is kept.")
+    parser.add_argument("--baseline", type=str, default=None, help="A previous results file to compare against.")
+    parser.add_argument(
+        "--results_dir", type=str, default=None, help="Directory of the results file. Defaults to <work_dir>/results."
+    )
+    return parser.parse_args()
+
+
+# Every benchmark is set up first, untimed, and returns the timed step, which returns its row count
+
+
+def _generate(work_dir: str, n_participants: int, seed: int) -> Callable[[], int]:
+    from ukbb_parser import synthetic
+
+    def run():
+        rows = synthetic.main(out_dir=pjoin(work_dir, "raw"), n_participants=n_participants, seed=seed)
+        return sum(rows.values())
+
+    return run
+
+
+def _standardise(work_dir: str) -> Callable[[], int]:
+    from ukbb_parser.updater import standardise_raw
+
+    raw_dir = pjoin(work_dir, "raw")
+
+    def run():
+        standardise_raw.main(
+            raw_dir=raw_dir,
+            std_dir=pjoin(work_dir, "standardised"),
+            withdrawn_file=pjoin(raw_dir, "withdrawn_consent.txt"),
+        )
+        return _parquet_rows(pjoin(work_dir, "standardised"))
+
+    return run
+
+
+def _derive(stage: str, work_dir: str) -> Callable[[], int]:
+    module = importlib.import_module(f"ukbb_parser.updater.{stage}")
+
+    def run():
+        start = time.time()
+        module.main(std_dir=pjoin(work_dir, "standardised"), final_dir=pjoin(work_dir, "final"))
+        return _parquet_rows(pjoin(work_dir, "final"), since=start)
+
+    return run
+
+
+def _first_occurrence(work_dir: str) -> Callable[[], int]:
+    from ukbb_parser.updater import derive_first_occurrence
+
+    def run():
+        start = time.time()
+        derive_first_occurrence.main(final_dir=pjoin(work_dir, "final"))
+        return _parquet_rows(pjoin(work_dir, "final"), since=start)
+
+    return run
+
+
+def _export_sequences(work_dir: str) -> Callable[[], int]:
+    from ukbb_parser.updater import export_sequences
+
+    def run():
+        export_sequences.main(final_dir=pjoin(work_dir, "final"), sequences_dir=pjoin(work_dir, "sequences"))
+        with open(pjoin(work_dir, "sequences", "metadata.json")) as f:
+            return json.load(f)["events"]
+
+    return run
+
+
+def _manifest(work_dir: str) -> Callable[[], int]:
+    from ukbb_parser.updater import manifest
+
+    def run():
+        manifest.main(final_dir=pjoin(work_dir, "final"))
+        return _parquet_rows(pjoin(work_dir, "final"))
+
+    return run
+
+
+def _query(pattern: str, work_dir: str) -> Callable[[], int]:
+    from ukbb_loaders.loaders.load import DataLoader
+
+    dl = DataLoader(pjoin(work_dir, "final"))
+    # A cohort of about 1% of the participants, spread over the eid range
+    eids = dl.patients_with("icd10", "", prefix=True)
+    cohort = eids[:: max(1, len(eids) // max(1, len(eids) // 100))]
+    # Twenty overlapping cohorts of about 5% of the participants each
+    cohorts = {f"cohort_{i}": eids[i % 7:: 20 - i % 3] for i in range(20)}
+    queries = {
+        "load_hospital_icd10": lambda: dl.get_hospital_data("icd10"),
+        "load_hospital_all": lambda: dl.get_hospital_data(["icd9", "icd10", "opcs3", "opcs4"]),
+        "load_gp_clinical": lambda: dl.get_gp_clinical_data(),
+        "load_gp_medications": lambda: dl.get_gp_medication_data(),
+        "load_cohort_gp_clinical": lambda: dl.get_gp_clinical_data(patient_list=cohort),
+        "load_codes_icd10": lambda: dl.get_hospital_data("icd10", codes=["I10", "E11"], prefix=True),
+        "patients_with_icd10": lambda: dl.patients_with("icd10", "I2", prefix=True),
+        "load_first_occurrence_phecode": lambda: dl.get_first_occurrence_data("phecode"),
+        "batch_gp_medications": lambda: dl.get_batch("get_gp_medication_data", cohorts, combine=True),
+    }
+    return lambda: len(queries[pattern]())
+
+
+PIPELINE = {
+    "standardise_raw": _standardise,
+    "derive_gp": partial(_derive, "derive_gp"),
+    "derive_hospital": partial(_derive, "derive_hospital"),
+    "derive_death": partial(_derive, "derive_death"),
+    "derive_first_occurrence": _first_occurrence,
+    "export_sequences": _export_sequences,
+    "manifest": _manifest,
+}
+QUERIES = [
+    "load_hospital_icd10",
+    "load_hospital_all",
+    "load_gp_clinical",
+    "load_gp_medications",
+    "load_cohort_gp_clinical",
+    "load_codes_icd10",
+    "patients_with_icd10",
+    "load_first_occurrence_phecode",
+    "batch_gp_medications",
+]
+
+
+def _parquet_rows(directory: str, since: float = None) -> int:
+    """
+    Returns the number of rows of the tables of a directory, only counting the tables written after
+    `since` if given.
+    """
+    import pyarrow.parquet as pq
+
+    paths = [
+        pjoin(directory, f)
+        for f in os.listdir(directory)
+        if f.endswith(".parquet") and not f.endswith(".code_index.parquet")
+    ]
+    return sum(
+        pq.read_metadata(path).num_rows for path in paths if since is None or os.path.getmtime(path) >= since
+    )
+
+
+def _child(setup: Callable, args: tuple, queue):
+    run = setup(*args)
+    wall, cpu = time.perf_counter(), time.process_time()
+    rows = run()
+    queue.put(
+        {
+            "seconds": time.perf_counter() - wall,
+            "cpu_seconds": time.process_time() - cpu,
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "rows": rows,
+        }
+    )
+
+
+def measure(name: str, setup: Callable, *args) -> Dict:
+    """
+    Runs a benchmark in a fresh process and returns its wall time, CPU time, peak memory and
+    throughput. The peak memory covers the whole process, including its setup.
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_child, args=(setup, args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"The {name} benchmark failed.")
+    result["rows_per_second"] = result["rows"] / result["seconds"] if result["seconds"] else None
+    logger.info(f"{name}: {result['seconds']:.2f}s, {result['peak_rss_mb']:.0f}MB peak, {result['rows']} rows")
+    return {"name": name, **result}
+
+
+def compare(results: List[Dict], baseline_path: str):
+    """
+    Logs the change of every benchmark against a previous results file.
+    """
+    with open(baseline_path) as f:
+        baseline = {result["name"]: result for result in json.load(f)["results"]}
+    for result in results:
+        previous = baseline.get(result["name"])
+        if previous is None:
+            continue
+        time_change = result["seconds"] / previous["seconds"] - 1
+        memory_change = result["peak_rss_mb"] / previous["peak_rss_mb"] - 1
+        logger.info(f"{result['name']}: time {time_change:+.0%}, peak memory {memory_change:+.0%}")
+
+
+def main(
+        work_dir: str,
+        n_participants: int,
+        seed: int = 0,
+        repeats: int = 3,
+        baseline: str = None,
+        results_dir: str = None,
+) -> str:
+    from ukbb_loaders import __version__
+
+    for directory in ["standardised", "final"]:
+        os.makedirs(pjoin(work_dir, directory), exist_ok=True)
+
+    results = [measure("generate", _generate, work_dir, n_participants, seed)]
+    results += [measure(name, setup, work_dir) for name, setup in PIPELINE.items()]
+    for pattern in QUERIES:
+        runs = [measure(pattern, partial(_query, pattern), work_dir) for _ in range(repeats)]
+        results.append(min(runs, key=lambda run: run["seconds"]))
+
+    results_dir = results_dir or pjoin(work_dir, "results")
+    os.makedirs(results_dir, exist_ok=True)
+    output = pjoin(results_dir, f"{__version__}_{n_participants}.json")
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "version": __version__,
+                "n_participants": n_participants,
+                "seed": seed,
+                "cpus": os.cpu_count(),
+                "results": results,
+            },
+            f,
+            indent=1,
+        )
+    logger.info(f"Results written to {output}")
+    if baseline is not None:
+        compare(results, baseline)
+    return str(output)
+
+
+if __name__ == "__main__":
+    args = get_args()
+    main(
+        work_dir=args.work_dir,
+        n_participants=args.n_participants,
+        seed=args.seed,
+        repeats=args.repeats,
+        baseline=args.baseline,
+        results_dir=args.results_dir,
+    )
@@ -45,6 +45,7 @@ def setup_package():
             "pyarrow",
             "s3fs==2021.11.0",
         ],
+        extras_require={"sql": ["duckdb>=0.9"]},
         python_requires=">3.7",
     )
     setup(**metadata)
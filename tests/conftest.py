@@ -0,0 +1,31 @@
+import pandas as pd
+import pytest
+
+from ukbb_parser.updater import manifest
+from ukbb_parser.updater.utils import save_final_table
+
+
+@pytest.fixture()
+def final_dir(request, tmp_path):
+    """
+    A final directory holding an ehr_diagnosis_icd10 table.
+
+    Defaults to four events of three patients without a manifest. Tests give their own events and
+    ask for a manifest by parametrising the fixture indirectly:
+    >>> @pytest.mark.parametrize("final_dir", [{"events": df, "manifest": True}], indirect=True)
+    """
+    param = getattr(request, "param", {})
+    events = param.get("events")
+    if events is None:
+        events = pd.DataFrame(
+            {
+                "eid": [1, 2, 3, 3],
+                "feature": ["N181", "N182", "N181", "I10"],
+                "date": pd.to_datetime(["2010-02-16", "2015-03-31", "1913-09-04", "2001-01-01"]),
+                "source": [1, 2, 2, 1],
+            }
+        ).set_index("eid")
+    save_final_table(events, final_dir=str(tmp_path), name="ehr_diagnosis_icd10")
+    if param.get("manifest", False):
+        manifest.main(final_dir=str(tmp_path))
+    return str(tmp_path)
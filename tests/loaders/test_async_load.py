@@ -0,0 +1,113 @@
+import asyncio
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ukbb_loaders.loaders.async_load import AsyncDataLoader
+from ukbb_loaders.loaders.load import DataLoader
+from ukbb_loaders.utilities import filesystem
+
+
+def _events():
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(
+        {
+            "eid": np.sort(rng.integers(1000000, 1000500, 5000)),
+            "feature": rng.choice(["N181", "N182", "E11", "I10", "J45"], 5000),
+            "date": pd.Timestamp("2000-01-01") + pd.to_timedelta(rng.integers(0, 5000, 5000), unit="D"),
+            "source": 1,
+        }
+    ).set_index("eid")
+
+
+# The final directory of every test holds these events and a manifest
+with_events = pytest.mark.parametrize("final_dir", [{"events": _events(), "manifest": True}], indirect=True)
+
+
+def _cohorts():
+    return [np.arange(1000000 + 50 * i, 1000050 + 50 * i) for i in range(10)]
+
+
+@with_events
+def test_concurrent_queries(final_dir):
+    async def query():
+        async with AsyncDataLoader(final_dir, max_workers=2) as dl:
+            results = await asyncio.gather(
+                *(dl.get_hospital_data("icd10", patient_list=eids) for eids in _cohorts()),
+                dl.patients_with("icd10", "N18", prefix=True),
+            )
+            with pytest.raises(ValueError):
+                await dl.get_hospital_data("icd11")
+            return results
+
+    results = asyncio.run(query())
+    dl = DataLoader(final_dir)
+    for eids, actual in zip(_cohorts(), results):
+        pd.testing.assert_frame_equal(actual, dl.get_hospital_data("icd10", patient_list=eids))
+    np.testing.assert_array_equal(results[-1], dl.patients_with("icd10", "N18", prefix=True))
+
+
+@with_events
+def test_cancel_queued_query(final_dir, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow(source, patient_list=None, codes=None, prefix=False):
+        calls.append(source)
+        started.set()
+        release.wait(5)
+        return source
+
+    async def query():
+        async with AsyncDataLoader(final_dir, max_workers=1) as dl:
+            monkeypatch.setattr(dl.loader, "get_hospital_data", slow)
+            running = asyncio.ensure_future(dl.get_hospital_data("icd10"))
+            await asyncio.get_running_loop().run_in_executor(None, started.wait)
+            queued = asyncio.ensure_future(dl.get_hospital_data("icd9"))
+            await asyncio.sleep(0)
+            queued.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await queued
+            release.set()
+            return await running
+
+    assert asyncio.run(query()) == "icd10"
+    # The cancelled query never took a thread
+    assert calls == ["icd10"]
+
+
+@with_events
+def test_s3_fetches_on_event_loop(final_dir, monkeypatch):
+    moto_server = pytest.importorskip("moto.server")
+    server = moto_server.ThreadedMotoServer(port=0)
+    server.start()
+    try:
+        host, port = server.get_host_and_port()
+        filesystem.configure(key="testing", secret="testing", client_kwargs={"endpoint_url": f"http://{host}:{port}"})
+        fs = filesystem.get_filesystem("s3://async-bucket")
+        fs.mkdir("async-bucket")
+        fs.put(final_dir, "async-bucket/final", recursive=True)
+
+        dl = DataLoader("s3://async-bucket/final")
+        expect = dl.get_hospital_data("icd10", patient_list=_cohorts()[0])
+        expect_codes = dl.get_hospital_data("icd10", codes="E11")
+        # Every byte range is fetched on the event loop, not by the shared thread pool
+        monkeypatch.setattr(filesystem, "_executor", None)
+        monkeypatch.setattr(filesystem.RangeFile, "_fetch", None)
+
+        async def query():
+            async with AsyncDataLoader("s3://async-bucket/final") as dl:
+                return await asyncio.gather(
+                    dl.get_hospital_data("icd10", patient_list=_cohorts()[0]),
+                    dl.get_hospital_data("icd10", codes="E11"),
+                )
+
+        actual, actual_codes = asyncio.run(query())
+        pd.testing.assert_frame_equal(actual, expect)
+        pd.testing.assert_frame_equal(actual_codes, expect_codes)
+    finally:
+        monkeypatch.undo()
+        filesystem.configure(max_concurrency=16)
+        server.stop()
@@ -0,0 +1,103 @@
+"""
+Testing ukbb_loaders/loaders/cohort.py
+"""
+import pytest
+import pandas as pd
+import numpy as np
+
+from unittest.mock import Mock
+
+from ukbb_loaders.loaders import cohort
+
+
+def _entries(eids, features, dates):
+    return pd.DataFrame({"feature": features, "eid": eids, "date": pd.to_datetime(dates)})
+
+
+@pytest.fixture()
+def mock_loader():
+    entries = {
+        "icd10": _entries([1, 2, 3, 3], ['E110', 'E119', 'N181', 'E11'], ['2001-01-01', '2002-01-01', '2003-01-01', None]),
+        "read_2": _entries([4, 5], ['C10..', 'C101.'], ['2004-01-01', '2005-01-01']),
+        "death": _entries([2, 4], ['I21', 'I21'], ['2008-05-01', '2012-05-01']),
+    }
+    dl = Mock()
+    dl.get_code_index.side_effect = lambda source, dates=False: (
+        entries[source] if dates else entries[source][["feature", "eid"]]
+    )
+    return dl
+
+
+@pytest.fixture()
+def cohort_index(mock_loader):
+    return cohort.CohortIndex.from_loader(
+        mock_loader, sources=["icd10", "read_2", "death"], universe=np.arange(1, 7)
+    )
+
+
+def test_query_prefix(cohort_index):
+    np.testing.assert_array_equal(cohort_index.query("icd10:E11*"), [1, 2, 3])
+    np.testing.assert_array_equal(cohort_index.query("icd10:E11"), [3])
+    np.testing.assert_array_equal(cohort_index.query("icd10:E1"), [])
+
+
+def test_query_boolean(cohort_index):
+    actual = cohort_index.query("(icd10:E11* | read_2:C10..) & ~death:*<2010-01-01")
+    np.testing.assert_array_equal(actual, [1, 3, 4])
+    actual = cohort_index.query(
+        (cohort.Code("icd10", "E11*") | cohort.Code("read_2", "C10..")) & ~cohort.Code("death", "*")
+    )
+    np.testing.assert_array_equal(actual, [1, 3])
+
+
+def test_query_not_is_relative_to_universe(cohort_index):
+    np.testing.assert_array_equal(cohort_index.query("NOT icd10:*"), [4, 5, 6])
+    assert cohort_index.count("~icd10:* AND ~read_2:*") == 1
+
+
+def test_query_dates(cohort_index):
+    np.testing.assert_array_equal(cohort_index.query("death:I21>2010-01-01"), [4])
+    np.testing.assert_array_equal(cohort_index.query("icd10:E11*<2001-06-01"), [1])
+
+
+def test_dates_are_loaded_on_first_dated_query(mock_loader, cohort_index):
+    cohort_index.query("icd10:E11* | death:*")
+    assert all(not kwargs.get("dates") for _, kwargs in mock_loader.get_code_index.call_args_list)
+    np.testing.assert_array_equal(cohort_index.query("death:I21>2010-01-01"), [4])
+    mock_loader.get_code_index.assert_called_with("death", dates=True)
+    cohort_index.query("death:I21<2010-01-01")
+    assert mock_loader.get_code_index.call_count == 4
+
+
+def test_cache_is_bounded(mock_loader):
+    index = cohort.CohortIndex.from_loader(mock_loader, sources=["icd10"], universe=np.arange(1, 7), cache_size=2)
+    for pattern in ["E110", "E119", "N181", "E110"]:
+        index.query(f"icd10:{pattern}")
+    assert list(index._cache) == [("icd10", "N181", None, None), ("icd10", "E110", None, None)]
+
+
+def test_dense_codes_match_sparse():
+    rng = np.random.default_rng(0)
+    eids = rng.integers(0, 1000, 5000)
+    features = rng.choice(['A', 'AB', 'B'], 5000, p=[0.8, 0.1, 0.1])
+    index = cohort.CohortIndex(np.arange(1000))
+    index.add_source("src", eids, features)
+
+    assert 0 in index.sources["src"].dense
+    for pattern in ["A", "A*", "*", "B"]:
+        expect = np.unique(eids[pd.Series(features).str.match(pattern.replace("*", ".*") + "$")])
+        np.testing.assert_array_equal(index.query(f"src:{pattern}"), expect)
+
+
+def test_parse_errors():
+    with pytest.raises(ValueError):
+        cohort.parse("(icd10:E11* | read_2:C10..")
+    with pytest.raises(ValueError):
+        cohort.parse("icd10:E11* read_2:C10..")
+    with pytest.raises(ValueError):
+        cohort.parse("E11")
+
+
+def test_unknown_source(cohort_index):
+    with pytest.raises(ValueError):
+        cohort_index.query("opcs4:X403")
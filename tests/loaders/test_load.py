@@ -1,6 +1,10 @@
 """
 Testing datasets/ukbb/loaders/load.py
 """
+import json
+import os
+import warnings
+
 import pytest
 import pandas as pd
 import numpy as np
@@ -10,12 +14,17 @@ from unittest.mock import patch, Mock
 from ukbb_loaders.loaders import load
 
 DATA_DIR = "s3://data_path"
-@pytest.fixture()
-def mock_s3_contents():
-    return [
-        "data_path/random.parquet"
-        "data_path/versioned_data/random2.parquet"
-    ]
+
+
+@pytest.fixture(autouse=True)
+def no_s3_manifest(monkeypatch):
+    # The mocked s3 directories have no manifest, and looking for one would reach out to s3
+    load_manifest = load.Manifest.load
+    monkeypatch.setattr(
+        load.Manifest,
+        "load",
+        staticmethod(lambda data_dir: None if data_dir.startswith("s3://") else load_manifest(data_dir)),
+    )
 
 
 @pytest.fixture()
@@ -91,25 +100,13 @@ def dummy_opcs_codes():
 
 
 @pytest.fixture()
-def raw_death_icd10_primary():
-    df = pd.DataFrame(
-        {
-            "eid": [1, 2, 3],
-            "feature": ['N181', 'N182', 'N181'],
-            "date": ['2016-07-10', '2015-04-25', '2014-01-14'],
-        }
-    ).set_index("eid")
-    df['date'] = pd.to_datetime(df['date'])
-    return df
-
-
-@pytest.fixture()
-def raw_death_icd10_secondary():
+def raw_death_icd10():
     df = pd.DataFrame(
         {
-            "eid": [1, 2, 3],
-            "feature": ['N181', 'N182', 'N181'],
-            "date": ['2016-07-10', '2015-04-25', '2014-01-14'],
+            "eid": [1, 1, 2, 2, 3, 3],
+            "feature": ['N181', 'N181', 'N182', 'N182', 'N181', 'N181'],
+            "date": ['2016-07-10', '2016-07-10', '2015-04-25', '2015-04-25', '2014-01-14', '2014-01-14'],
+            "level": np.array([1, 2, 1, 2, 1, 2], dtype=np.int8),
         }
     ).set_index("eid")
     df['date'] = pd.to_datetime(df['date'])
@@ -174,9 +171,8 @@ def raw_medications():
 
 
 
-@patch("ukbb_loaders.loaders.load.S3FileSystem")
-def test_init_data_path(mock_s3fs: Mock, mock_s3_contents: list):
-    mock_s3fs().ls.return_value = mock_s3_contents
+@patch("ukbb_loaders.loaders.load.is_nonempty_dir", return_value=True)
+def test_init_data_path(mock_is_nonempty_dir: Mock):
     actual = load.DataLoader(DATA_DIR).data_path
     expect = "s3://data_path"
     assert actual == expect
@@ -187,9 +183,8 @@ def test_error_local_directory():
         load.DataLoader("fake_dir")
 
 
-@patch("ukbb_loaders.loaders.load.S3FileSystem")
-def test_init_hospital_map(mock_s3fs: Mock, mock_s3_contents: list):
-    mock_s3fs().ls.return_value = mock_s3_contents
+@patch("ukbb_loaders.loaders.load.is_nonempty_dir", return_value=True)
+def test_init_hospital_map(mock_is_nonempty_dir: Mock):
     actual = load.DataLoader("s3://data_path").hospital_map
     expect = {
         "icd9": "ehr_diagnosis_icd9.parquet",
@@ -200,22 +195,21 @@ def test_init_hospital_map(mock_s3fs: Mock, mock_s3_contents: list):
     assert actual == expect
 
 
-@patch("ukbb_loaders.loaders.load.S3FileSystem")
-def test_init_gp_map(mock_s3fs: Mock, mock_s3_contents: list):
-    mock_s3fs().ls.return_value = mock_s3_contents
+@patch("ukbb_loaders.loaders.load.is_nonempty_dir", return_value=True)
+def test_init_gp_map(mock_is_nonempty_dir: Mock):
     actual = load.DataLoader(DATA_DIR).gp_map
     expect = {"read_2": "ehr_diagnosis_read2.parquet", "read_3": "ehr_diagnosis_read3.parquet"}
     assert actual == expect
 
 
-@patch("ukbb_loaders.loaders.load.S3FileSystem")
-@patch("ukbb_loaders.loaders.load.pd.read_parquet")
+@patch("ukbb_loaders.loaders.load.is_nonempty_dir", return_value=True)
+@patch("ukbb_loaders.loaders.load.read_parquet")
 def test_get_death_data(
-    mock_read_parquet: Mock, mock_s3fs: Mock, raw_death_icd10_primary, mock_s3_contents: list
+    mock_read_parquet: Mock, mock_is_nonempty_dir: Mock, raw_death_icd10
 ):
-    mock_s3fs().ls.return_value = mock_s3_contents
-    mock_read_parquet.return_value = raw_death_icd10_primary
+    mock_read_parquet.return_value = raw_death_icd10.query("level == 1 & eid < 3")
     actual = load.DataLoader(DATA_DIR).get_death_data(level='primary', patient_list=np.array([1, 2]))
+    assert mock_read_parquet.call_args.kwargs["filters"] == [("level", "in", [1])]
     expect = pd.DataFrame(
         {
             "eid": [1, 2],
@@ -230,31 +224,28 @@ def test_get_death_data(
     pd.testing.assert_frame_equal(actual, expect)
 
 
-@patch("ukbb_loaders.loaders.load.S3FileSystem")
-@patch("ukbb_loaders.loaders.load.pd.read_parquet")
+@patch("ukbb_loaders.loaders.load.is_nonempty_dir", return_value=True)
+@patch("ukbb_loaders.loaders.load.read_parquet")
 def test_get_death_data_all(
     mock_read_parquet: Mock,
-    mock_s3fs: Mock,
-    raw_death_icd10_primary,
-    raw_death_icd10_secondary,
-    mock_s3_contents: list,
+    mock_is_nonempty_dir: Mock,
+    raw_death_icd10,
 ):
-    mock_s3fs().ls.return_value = mock_s3_contents
-    mock_read_parquet.side_effect = [raw_death_icd10_primary, raw_death_icd10_secondary]
+    mock_read_parquet.return_value = raw_death_icd10
     actual = load.DataLoader(DATA_DIR).get_death_data()
     expect = pd.DataFrame(
         {
-            "eid": [1, 2, 3, 1, 2, 3],
-            "feature": ['N181', 'N182', 'N181', 'N181', 'N182', 'N181'],
+            "eid": [1, 1, 2, 2, 3, 3],
+            "feature": ['N181', 'N181', 'N182', 'N182', 'N181', 'N181'],
             "date_of_death": [
                 '2016-07-10',
-                '2015-04-25',
-                '2014-01-14',
                 '2016-07-10',
                 '2015-04-25',
+                '2015-04-25',
+                '2014-01-14',
                 '2014-01-14',
             ],
-            "source": ['primary', 'primary', 'primary', 'secondary', 'secondary', 'secondary'],
+            "source": ['primary', 'secondary', 'primary', 'secondary', 'primary', 'secondary'],
             "value": [1, 1, 1, 1, 1, 1],
         }
     ).set_index(['eid'])
@@ -263,15 +254,34 @@ def test_get_death_data_all(
     pd.testing.assert_frame_equal(actual, expect)
 
 
-@patch("ukbb_loaders.loaders.load.S3FileSystem")
-@patch("ukbb_loaders.loaders.load.pd.read_parquet")
+@patch("ukbb_loaders.loaders.load.is_nonempty_dir", return_value=True)
+@patch("ukbb_loaders.loaders.load.read_parquet")
+def test_get_death_data_legacy_tables(mock_read_parquet: Mock, mock_is_nonempty_dir: Mock, raw_death_icd10):
+    primary = raw_death_icd10.query("level == 1").drop(columns="level")
+    secondary = raw_death_icd10.query("level == 2").drop(columns="level")
+    mock_read_parquet.side_effect = [FileNotFoundError(), primary, secondary]
+    actual = load.DataLoader(DATA_DIR).get_death_data()
+
+    assert [call.args[0] for call in mock_read_parquet.call_args_list] == [
+        f"{DATA_DIR}/death_icd10.parquet",
+        f"{DATA_DIR}/death_icd10_primary.parquet",
+        f"{DATA_DIR}/death_icd10_secondary.parquet",
+    ]
+    assert list(actual.columns) == ["feature", "date_of_death", "source", "value"]
+    assert actual["source"].tolist() == ["primary"] * 3 + ["secondary"] * 3
+
+    mock_read_parquet.side_effect = FileNotFoundError()
+    with pytest.raises(FileNotFoundError, match="Re-run derive_death.py"):
+        load.DataLoader(DATA_DIR).get_death_data()
+
+
+@patch("ukbb_loaders.loaders.load.is_nonempty_dir", return_value=True)
+@patch("ukbb_loaders.loaders.load.read_parquet")
 def test_get_hospital_data(
     mock_read_parquet: Mock,
-    mock_s3fs: Mock,
+    mock_is_nonempty_dir: Mock,
     raw_ehr_diagnosis_icd9,
-    mock_s3_contents: list,
 ):
-    mock_s3fs().ls.return_value = mock_s3_contents
     mock_read_parquet.return_value = raw_ehr_diagnosis_icd9
     actual = load.DataLoader(DATA_DIR).get_hospital_data(
         source="icd9", level="primary", patient_list=np.array([1, 2]),
@@ -290,16 +300,14 @@ def test_get_hospital_data(
     pd.testing.assert_frame_equal(actual, expect)
 
 
-@patch("ukbb_loaders.loaders.load.S3FileSystem")
-@patch("ukbb_loaders.loaders.load.pd.read_parquet")
+@patch("ukbb_loaders.loaders.load.is_nonempty_dir", return_value=True)
+@patch("ukbb_loaders.loaders.load.read_parquet")
 def test_get_hospital_data_all(
     mock_read_parquet: Mock,
-    mock_s3fs: Mock,
+    mock_is_nonempty_dir: Mock,
     raw_ehr_diagnosis_icd10,
     raw_ehr_diagnosis_icd9,
-    mock_s3_contents: list,
 ):
-    mock_s3fs().ls.return_value = mock_s3_contents
     mock_read_parquet.side_effect = [raw_ehr_diagnosis_icd10, raw_ehr_diagnosis_icd9]
     actual = load.DataLoader(DATA_DIR).get_hospital_data(
         source=["icd10", "icd9"], level=["primary", "secondary"]
@@ -326,12 +334,11 @@ def test_get_hospital_data_all(
 
 
 
-@patch("ukbb_loaders.loaders.load.S3FileSystem")
-@patch("ukbb_loaders.loaders.load.pd.read_parquet")
+@patch("ukbb_loaders.loaders.load.is_nonempty_dir", return_value=True)
+@patch("ukbb_loaders.loaders.load.read_parquet")
 def test_get_gp_clinical_data(
-    mock_read_parquet: Mock, mock_s3fs: Mock, raw_ehr_diagnosis_read2, mock_s3_contents: list
+    mock_read_parquet: Mock, mock_is_nonempty_dir: Mock, raw_ehr_diagnosis_read2
 ):
-    mock_s3fs().ls.return_value = mock_s3_contents
     mock_read_parquet.return_value = raw_ehr_diagnosis_read2
     actual = load.DataLoader(DATA_DIR).get_gp_clinical_data(source='read_2', patient_list=np.array([1, 2]))
     expect = pd.DataFrame(
@@ -348,16 +355,14 @@ def test_get_gp_clinical_data(
     pd.testing.assert_frame_equal(actual, expect)
 
 
-@patch("ukbb_loaders.loaders.load.S3FileSystem")
-@patch("ukbb_loaders.loaders.load.pd.read_parquet")
+@patch("ukbb_loaders.loaders.load.is_nonempty_dir", return_value=True)
+@patch("ukbb_loaders.loaders.load.read_parquet")
 def test_get_gp_clinical_data_all(
     mock_read_parquet: Mock,
-    mock_s3fs: Mock,
+    mock_is_nonempty_dir: Mock,
     raw_ehr_diagnosis_read2,
     raw_ehr_diagnosis_read3,
-    mock_s3_contents: list,
 ):
-    mock_s3fs().ls.return_value = mock_s3_contents
     mock_read_parquet.side_effect = [raw_ehr_diagnosis_read2, raw_ehr_diagnosis_read3]
     actual = load.DataLoader(DATA_DIR).get_gp_clinical_data()
     expect = pd.DataFrame(
@@ -387,3 +392,236 @@ def test_check_arg():
     assert str(context.value) == "The test argument should be one of ['a', 'b', 'c']"
 
 
+
+
+@pytest.fixture()
+def final_dir(tmp_path, raw_ehr_diagnosis_icd10, raw_ehr_diagnosis_read2):
+    from ukbb_parser.updater.utils import save_final_table
+
+    save_final_table(raw_ehr_diagnosis_icd10, final_dir=str(tmp_path), name="ehr_diagnosis_icd10")
+    raw_ehr_diagnosis_read2.to_parquet(tmp_path / "ehr_diagnosis_read2.parquet")
+    return str(tmp_path)
+
+
+def test_patients_with(final_dir):
+    dl = load.DataLoader(final_dir)
+    np.testing.assert_array_equal(dl.patients_with("icd10", ["N181"]), [1, 3])
+    np.testing.assert_array_equal(dl.patients_with("icd10", "N18", prefix=True), [1, 2, 3])
+    np.testing.assert_array_equal(dl.patients_with("icd10", "N19", prefix=True), [])
+
+
+def test_patients_with_without_code_index(final_dir):
+    dl = load.DataLoader(final_dir)
+    np.testing.assert_array_equal(dl.patients_with("read_2", "790", prefix=True), [1, 2, 3])
+    np.testing.assert_array_equal(dl.patients_with("read_2", "XaA1S"), [])
+
+
+def test_get_code_index(final_dir):
+    dl = load.DataLoader(final_dir)
+    for source in ["icd10", "read_2"]:
+        data = dl.get_hospital_data("icd10") if source == "icd10" else dl.get_gp_clinical_data("read_2")
+        actual = dl.get_code_index(source, dates=True).sort_values(["eid", "feature", "date"], ignore_index=True)
+        expect = pd.DataFrame(
+            {"feature": data["feature"].astype(str).to_numpy(), "eid": data.index.to_numpy(), "date": data["date_of_visit"].to_numpy()}
+        ).sort_values(["eid", "feature", "date"], ignore_index=True)
+        pd.testing.assert_frame_equal(actual.astype({"feature": str}), expect, check_dtype=False)
+        assert list(dl.get_code_index(source).columns) == ["feature", "eid"]
+
+
+def test_code_index_skips_missing_codes(tmp_path):
+    from ukbb_parser.updater.utils import save_final_table
+
+    df = pd.DataFrame(
+        {"eid": [1, 2, 3], "feature": ["N181", None, "I10"], "date": pd.to_datetime(["2010-01-01"] * 3), "source": 1}
+    ).set_index("eid")
+    save_final_table(df, final_dir=str(tmp_path), name="ehr_diagnosis_icd10")
+    index = pd.read_parquet(tmp_path / "ehr_diagnosis_icd10.code_index.parquet")
+    assert index.values.tolist() == [["I10", 3, 2], ["N181", 1, 0]]
+    dl = load.DataLoader(str(tmp_path))
+    assert dl.get_hospital_data("icd10", codes=["nan", "None"]).empty
+    assert dl.get_hospital_data("icd10", codes="I10").index.tolist() == [3]
+
+
+def test_assign_source_to_slice(final_dir):
+    dl = load.DataLoader(final_dir)
+    df = pd.read_parquet(f"{final_dir}/ehr_diagnosis_icd10.parquet")
+    rows = df.loc[df["source"].isin([1])]
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", pd.errors.SettingWithCopyWarning)
+        actual = dl._assign_source(rows, "icd10", ["icd10"])
+    assert (actual["source"] == "icd10").all()
+    assert df["source"].tolist() == pd.read_parquet(f"{final_dir}/ehr_diagnosis_icd10.parquet")["source"].tolist()
+
+
+def test_get_hospital_data_codes(final_dir):
+    actual = load.DataLoader(final_dir).get_hospital_data(source="icd10", codes=["N182"])
+    expect = pd.DataFrame(
+        {
+            "eid": [2],
+            "feature": ['N182'],
+            "date_of_visit": ['2015-03-31'],
+            "source": ['icd10'],
+            "value": [1],
+        }
+    ).set_index(['eid'])
+    expect['date_of_visit'] = pd.to_datetime(expect['date_of_visit'])
+
+    pd.testing.assert_frame_equal(actual, expect)
+
+
+def test_get_gp_measurement_data(tmp_path):
+    from ukbb_parser.updater.utils import save_final_table
+
+    df = pd.DataFrame(
+        {
+            "eid": [1, 1, 2, 2],
+            "date": pd.to_datetime(['2010-01-01', '2012-01-01', '2011-06-01', '2013-01-01']),
+            "feature": pd.Categorical(['42W5.', '246..', '42W5.', '42W5.']),
+            "source": pd.Categorical(['read_2', 'read_2', 'read_2', 'read_3'], categories=['read_2', 'read_3']),
+            "value": np.array([48, 130, 52, 61], dtype=np.float32),
+            "slot": np.array([1, 1, 1, 1], dtype=np.int8),
+        }
+    ).set_index("eid")
+    save_final_table(df, final_dir=str(tmp_path), name="gp_measurements")
+
+    actual = load.DataLoader(str(tmp_path)).get_gp_measurement_data(
+        codes="42W5.", start_date="2010-06-01", end_date="2012-12-31"
+    )
+    assert actual.index.tolist() == [2]
+    assert actual["date_of_measurement"].tolist() == [pd.Timestamp('2011-06-01')]
+    assert actual["value"].dtype == np.float32
+    assert actual["value"].tolist() == [52]
+
+    actual = load.DataLoader(str(tmp_path)).get_gp_measurement_data("read_3", codes="42W5.")
+    assert actual["value"].tolist() == [61]
+    assert actual["source"].astype(str).tolist() == ["read_3"]
+
+
+def test_read_rows(tmp_path):
+    df = pd.DataFrame({"eid": np.arange(100), "feature": np.arange(100).astype(str)}).set_index("eid")
+    df.to_parquet(tmp_path / "table.parquet", row_group_size=10)
+    actual = load._read_rows(str(tmp_path / "table.parquet"), np.array([3, 45, 47, 99]))
+
+    pd.testing.assert_frame_equal(actual, df.iloc[[3, 45, 47, 99]])
+
+
+def test_manifest(final_dir):
+    from ukbb_parser.updater import manifest
+
+    manifest.main(final_dir=final_dir)
+    dl = load.DataLoader(final_dir)
+    table = dl.manifest.tables["ehr_diagnosis_icd10.parquet"]
+
+    assert (table["rows"], table["eid_min"], table["eid_max"]) == (3, 1, 3)
+    assert dl.manifest.metadata("ehr_diagnosis_icd10.parquet").num_rows == 3
+    assert len(dl.get_hospital_data(source="icd10", patient_list=np.array([2]))) == 1
+    dl.validate(checksums=True)
+
+    os.remove(os.path.join(final_dir, "ehr_diagnosis_read2.parquet"))
+    with pytest.raises(ValueError, match="ehr_diagnosis_read2.parquet is missing"):
+        dl.validate()
+
+
+def test_manifest_missing_table(final_dir):
+    from ukbb_parser.updater import manifest
+
+    os.remove(os.path.join(final_dir, "ehr_diagnosis_read2.parquet"))
+    manifest.main(final_dir=final_dir)
+    with pytest.raises(FileNotFoundError, match="ehr_diagnosis_read2.parquet"):
+        load.DataLoader(final_dir).get_gp_clinical_data()
+
+
+def test_manifest_stale_table(final_dir):
+    from ukbb_parser.updater import manifest
+    from ukbb_parser.updater.utils import save_final_table
+
+    manifest.main(final_dir=final_dir)
+    events = load.DataLoader(final_dir).get_hospital_data(source="icd10")[["feature", "date_of_visit"]]
+    events = pd.concat([events] * 50).reset_index(drop=True).rename_axis("eid")
+    events = events.rename(columns={"date_of_visit": "date"}).assign(source=1)
+    save_final_table(events, final_dir=final_dir, name="ehr_diagnosis_icd10")
+    dl = load.DataLoader(final_dir)
+    with pytest.raises(ValueError, match="ehr_diagnosis_icd10.parquet has changed since the manifest"):
+        dl.get_hospital_data(source="icd10")
+
+    manifest.refresh(final_dir=final_dir)
+    assert len(load.DataLoader(final_dir).get_hospital_data(source="icd10")) == 150
+
+
+def test_manifest_incompatible_version(tmp_path):
+    (tmp_path / "manifest.json").write_text(json.dumps({"format_version": 99, "tables": {}}))
+    with pytest.raises(ValueError, match="format version 99"):
+        load.DataLoader(str(tmp_path))
+
+
+def test_trace(final_dir):
+    from ukbb_parser.updater import manifest
+
+    manifest.main(final_dir=final_dir)
+    dl = load.DataLoader(final_dir)
+    with dl.trace() as t:
+        dl.get_hospital_data(source="icd10", patient_list=np.array([2]))
+    summary = t.summary().set_index("name")
+
+    assert summary.loc["get_hospital_data", "rows"] == 1
+    assert summary.loc["filter_patients", "rows_before"] == 3
+    assert summary.loc["filter_patients", "rows_after"] == 1
+    assert summary.loc["decode", "row_groups_scanned"] == 1
+    assert not summary.loc["manifest_metadata", "cache_hit"]
+    assert (summary["duration_ms"] >= 0).all()
+
+
+def test_compact(final_dir, raw_ehr_diagnosis_icd9):
+    from ukbb_parser.updater.utils import save_final_table
+
+    save_final_table(raw_ehr_diagnosis_icd9, final_dir=final_dir, name="ehr_diagnosis_icd9")
+    expect = load.DataLoader(final_dir).get_hospital_data(source=["icd10", "icd9"])
+    actual = load.DataLoader(final_dir, compact=True).get_hospital_data(source=["icd10", "icd9"])
+
+    # Indexes of every integer width only exist from pandas 2
+    eid_dtype = np.int32 if int(pd.__version__.split(".")[0]) >= 2 else np.int64
+    assert actual.index.dtype == eid_dtype
+    assert list(actual["feature"].cat.categories) == ['N181', 'N182', '585']
+    assert list(actual["source"].cat.categories) == ["icd10", "icd9"]
+    assert actual["value"].dtype == np.int8
+    pd.testing.assert_frame_equal(actual, expect, check_dtype=False, check_index_type=False, check_categorical=False)
+
+    actual = load.DataLoader(final_dir, compact=True).get_hospital_data(source="icd10", codes=["N182"])
+    assert actual.index.dtype == eid_dtype
+    assert list(actual["feature"].astype(str)) == ['N182']
+
+
+def test_get_batch(final_dir):
+    dl = load.DataLoader(final_dir)
+    cohorts = {"a": np.array([1, 3]), "b": np.array([3, 2, 3]), "empty": np.array([], dtype=int)}
+    with dl.trace() as t:
+        batch = dl.get_batch("get_hospital_data", cohorts, source="icd10")
+    assert (t.summary()["name"] == "read_table").sum() == 1
+
+    assert list(batch) == ["a", "b", "empty"]
+    for name, eids in cohorts.items():
+        expect = dl.get_hospital_data(source="icd10", patient_list=eids) if len(eids) else batch[name].iloc[:0]
+        pd.testing.assert_frame_equal(batch[name], expect)
+    assert batch["empty"].empty
+
+    combined = dl.get_batch("get_hospital_data", cohorts, combine=True, source="icd10", codes=["N181"])
+    assert list(zip(combined.index, combined["cohort"])) == [(1, "a"), (3, "a"), (3, "b")]
+    assert list(combined["cohort"].cat.categories) == ["a", "b", "empty"]
+
+
+def test_get_batch_without_patients(final_dir):
+    dl = load.DataLoader(final_dir)
+    with dl.trace() as t:
+        batch = dl.get_batch("get_hospital_data", {"a": np.array([], dtype=int)}, source="icd10", codes="N181")
+    decoded = t.summary().query("name == 'decode'")
+    assert decoded["row_groups_scanned"].sum() == 0
+    expect = dl.get_hospital_data(source="icd10").iloc[:0]
+    pd.testing.assert_frame_equal(batch["a"], expect)
+    combined = dl.get_batch("get_hospital_data", {}, combine=True, source="icd10")
+    assert combined.empty
+    assert list(combined.columns) == list(expect.columns) + ["cohort"]
+
+
+def test_route():
+    rows, cohorts = load._route(np.array([5, 1, 2, 5]), [np.array([1, 5]), np.array([5]), np.array([3])])
+    assert list(zip(rows, cohorts)) == [(0, 0), (0, 1), (1, 0), (3, 0), (3, 1)]
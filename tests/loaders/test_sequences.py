@@ -0,0 +1,49 @@
+import json
+import pickle
+
+import numpy as np
+import pytest
+
+from ukbb_loaders.loaders.sequences import SequenceReader
+
+
+@pytest.fixture()
+def sequences_dir(tmp_path):
+    lengths = np.array([5, 1, 0, 3, 7, 2, 2])
+    arrays = {
+        "eids": np.arange(1000000, 1000007, dtype=np.int64),
+        "offsets": np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        "tokens": np.arange(1, lengths.sum() + 1, dtype=np.int32),
+        "days": np.arange(lengths.sum(), dtype=np.int32),
+    }
+    for name, array in arrays.items():
+        np.save(tmp_path / f"{name}.npy", array)
+    metadata = {"format_version": 1, "patients": 7, "events": int(lengths.sum()), "missing_day": 2 ** 31 - 1}
+    (tmp_path / "metadata.json").write_text(json.dumps(metadata))
+    return str(tmp_path)
+
+
+def test_random_access(sequences_dir):
+    reader = SequenceReader(sequences_dir)
+    assert len(reader) == 7
+    tokens, days = reader[3]
+    np.testing.assert_array_equal(tokens, [7, 8, 9])
+    np.testing.assert_array_equal(days, [6, 7, 8])
+    assert len(reader.get(1000002)[0]) == 0
+    np.testing.assert_array_equal(reader[-1][0], reader.get(1000006)[0])
+    with pytest.raises(KeyError):
+        reader.get(1000007)
+    with pytest.raises(IndexError):
+        reader[7]
+
+
+def test_shard(sequences_dir):
+    reader = SequenceReader(sequences_dir)
+    shards = [reader.shard(i, 3) for i in range(3)]
+    # The shards cover every patient once, with balanced numbers of events
+    np.testing.assert_array_equal(np.concatenate([shard.eids for shard in shards]), reader.eids)
+    assert [shard.lengths().sum() for shard in shards] == [9, 7, 4]
+    # A shard is pickled as its range, and maps the files again when unpickled
+    shard = pickle.loads(pickle.dumps(shards[1]))
+    np.testing.assert_array_equal(shard[0][0], reader[4][0])
+    assert shard.get(1000004)[0].tolist() == reader.get(1000004)[0].tolist()
@@ -0,0 +1,104 @@
+"""
+Testing ukbb_loaders/loaders/server.py
+"""
+import json
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+flight = pytest.importorskip("pyarrow.flight")
+
+from ukbb_loaders.loaders import load, server  # noqa: E402
+
+
+@pytest.fixture()
+def query_server(final_dir):
+    query_server = server.QueryServer(final_dir, location="grpc://127.0.0.1:0", max_concurrency=1)
+    thread = threading.Thread(target=query_server.serve, daemon=True)
+    thread.start()
+    yield query_server
+    query_server.shutdown()
+
+
+def test_remote_data_loader(query_server, final_dir):
+    dl = load.DataLoader(final_dir)
+    remote = server.RemoteDataLoader(f"grpc://127.0.0.1:{query_server.port}")
+
+    assert remote.tables() == {"ehr_diagnosis_icd10.parquet": 4, "ehr_diagnosis_icd10.code_index.parquet": 4}
+    pd.testing.assert_frame_equal(remote.get_hospital_data("icd10"), dl.get_hospital_data("icd10"))
+    pd.testing.assert_frame_equal(
+        remote.get_hospital_data("icd10", patient_list=np.array([3]), codes="N1", prefix=True),
+        dl.get_hospital_data("icd10", patient_list=np.array([3]), codes="N1", prefix=True),
+    )
+    np.testing.assert_array_equal(remote.patients_with("icd10", ["N181"]), [1, 3])
+    batch = remote.get_batch("get_hospital_data", {"a": np.array([1, 3]), "b": np.array([2])}, source="icd10")
+    assert {name: list(df.index) for name, df in batch.items()} == {"a": [1, 3, 3], "b": [2]}
+    with pytest.raises(ValueError, match="The source argument should be one of"):
+        remote.get_hospital_data("icd11")
+
+
+def test_remote_data_loader_arguments(query_server, final_dir):
+    dl = load.DataLoader(final_dir)
+    remote = server.RemoteDataLoader(f"grpc://127.0.0.1:{query_server.port}")
+
+    patients = pd.Series([1, 3])
+    pd.testing.assert_frame_equal(
+        remote.get_hospital_data("icd10", patient_list=patients), dl.get_hospital_data("icd10", patient_list=patients)
+    )
+    np.testing.assert_array_equal(remote.patients_with("icd10", [np.str_("I10")]), [3])
+    assert server._decode(server._encode(np.datetime64("2010-02-16"))) == pd.Timestamp("2010-02-16")
+
+
+def test_remote_data_loader_compact(query_server, final_dir):
+    dl = load.DataLoader(final_dir, compact=True)
+    remote = server.RemoteDataLoader(f"grpc://127.0.0.1:{query_server.port}", compact=True)
+
+    pd.testing.assert_frame_equal(remote.get_hospital_data("icd10"), dl.get_hospital_data("icd10"))
+    pd.testing.assert_frame_equal(
+        remote.get_hospital_data("icd10", codes=["N181", "I10"]), dl.get_hospital_data("icd10", codes=["N181", "I10"])
+    )
+
+
+def test_warm_loader_returns_arrow(query_server):
+    table = query_server.loaders[False].get_hospital_data("icd10", codes="N181")
+    assert sorted(table.column_names) == ["date_of_visit", "eid", "feature", "source", "value"]
+    assert table.column("eid").to_pylist() == [1, 3]
+
+
+def test_structured_errors():
+    error = server._server_error(FileNotFoundError("No table. Detail: none"))
+    assert json.loads(error.extra_info) == {"type": "FileNotFoundError", "message": "No table. Detail: none"}
+
+
+def test_warm_code_index(query_server, final_dir):
+    expect = load.DataLoader(final_dir).get_code_index("icd10", dates=True)
+    pd.testing.assert_frame_equal(query_server.loaders[False].get_code_index("icd10", dates=True), expect)
+    assert list(query_server.loaders[False].get_code_index("icd10").columns) == ["feature", "eid"]
+
+
+def test_concurrency_limit(query_server, monkeypatch):
+    def slow(*args, **kwargs):
+        time.sleep(0.5)
+        return np.array([1])
+
+    monkeypatch.setattr(query_server.loaders[False], "patients_with", slow)
+    remote = server.RemoteDataLoader(f"grpc://127.0.0.1:{query_server.port}")
+    thread = threading.Thread(target=remote.patients_with, args=("icd10", "N181"))
+    thread.start()
+    time.sleep(0.1)
+    with pytest.raises(flight.FlightUnavailableError):
+        server.RemoteDataLoader(f"grpc://127.0.0.1:{query_server.port}", retry_timeout=0).patients_with("icd10", "N181")
+    np.testing.assert_array_equal(
+        server.RemoteDataLoader(f"grpc://127.0.0.1:{query_server.port}").patients_with("icd10", "N181"), [1]
+    )
+    thread.join()
+
+
+def test_only_local_locations():
+    with pytest.raises(ValueError, match="location"):
+        server.RemoteDataLoader("grpc://10.0.0.1:8815")
+    server._check_local("grpc+unix:///tmp/ukbb.sock")
+    server._check_local("grpc://localhost:8815")
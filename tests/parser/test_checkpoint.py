@@ -0,0 +1,75 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from ukbb_parser.updater import checkpoint
+from ukbb_parser.updater.checkpoint import Checkpoints, atomic_write, remove_temporary_files
+
+
+def _write(path, rows):
+    with atomic_write(str(path)) as tmp_path:
+        pd.DataFrame({"eid": range(rows)}).to_parquet(tmp_path)
+
+
+def test_atomic_write(tmp_path):
+    path = tmp_path / "table.parquet"
+    with pytest.raises(RuntimeError):
+        with atomic_write(str(path)) as tmp_path_:
+            pd.DataFrame({"eid": range(10)}).to_parquet(tmp_path_)
+            raise RuntimeError()
+    assert os.listdir(tmp_path) == []
+
+    _write(path, 10)
+    assert os.listdir(tmp_path) == ["table.parquet"]
+    assert len(pd.read_parquet(path)) == 10
+
+
+def test_remove_temporary_files(tmp_path):
+    (tmp_path / ".table.parquet.tmp-1234abcd").write_bytes(b"PAR1")
+    _write(tmp_path / "table.parquet", 1)
+    assert remove_temporary_files(str(tmp_path)) == 1
+    assert os.listdir(tmp_path) == ["table.parquet"]
+    assert remove_temporary_files(str(tmp_path / "missing")) == 0
+
+
+def test_resume(tmp_path):
+    runs = []
+
+    def stage(name, fail=False):
+        def run():
+            runs.append(name)
+            _write(tmp_path / f"{name}.parquet", 5)
+            if fail:
+                raise MemoryError()
+
+        return run
+
+    checkpoints = Checkpoints(str(tmp_path))
+    checkpoints.run("first", stage("first"))
+    with pytest.raises(MemoryError):
+        checkpoints.run("second", stage("second", fail=True))
+    assert checkpoint._outputs is None
+    recorded = json.loads((tmp_path / "_checkpoints" / "first.json").read_text())
+    assert recorded["outputs"] == {str(tmp_path / "first.parquet"): os.path.getsize(tmp_path / "first.parquet")}
+    assert not (tmp_path / "_checkpoints" / "second.json").exists()
+
+    # Resuming skips the completed stage and runs from the failed one
+    checkpoints = Checkpoints(str(tmp_path), resume=True)
+    for name in ["first", "second", "third"]:
+        checkpoints.run(name, stage(name))
+    assert runs == ["first", "second", "second", "third"]
+
+    # A stage whose outputs changed runs again, as do the stages after it
+    _write(tmp_path / "second.parquet", 500)
+    checkpoints = Checkpoints(str(tmp_path), resume=True)
+    for name in ["first", "second", "third"]:
+        checkpoints.run(name, stage(name))
+    assert runs[4:] == ["second", "third"]
+
+    # Without resuming, every stage runs
+    checkpoints = Checkpoints(str(tmp_path))
+    assert os.listdir(tmp_path / "_checkpoints") == []
+    checkpoints.run("first", stage("first"))
+    assert runs[6:] == ["first"]
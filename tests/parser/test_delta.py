@@ -0,0 +1,142 @@
+import os
+import shutil
+from os.path import join as pjoin
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from ukbb_parser import synthetic
+from ukbb_parser.updater import (
+    delta,
+    derive_death,
+    derive_first_occurrence,
+    derive_gp,
+    derive_hospital,
+    standardise_raw,
+)
+from ukbb_parser.updater.utils import CODE_INDEX_SUFFIX
+
+
+def test_changed_eids(tmp_path):
+    old = pd.DataFrame(
+        {
+            "eid": [1, 1, 2, 3, 4],
+            "ins_index": [0, 1, 0, 0, 0],
+            "diag_icd10": pd.Categorical(["I21", "E11", "C34", "J45", "I10"]),
+        }
+    )
+    # Reordered records with a different index, a new episode for 1, a changed code for 3,
+    # patient 4 removed and patient 5 added
+    new = pd.DataFrame(
+        {
+            "eid": [2, 1, 1, 1, 3, 5],
+            "ins_index": [0, 1, 0, 2, 0, 0],
+            "diag_icd10": pd.Categorical(["C34", "E11", "I21", "I21", "J44", "I10"]),
+        },
+        index=[10, 11, 12, 13, 14, 15],
+    )
+    old.to_parquet(tmp_path / "old.parquet")
+    new.to_parquet(tmp_path / "new.parquet")
+
+    actual = delta.changed_eids(str(tmp_path / "old.parquet"), str(tmp_path / "new.parquet"))
+    np.testing.assert_array_equal(actual, [1, 3, 4, 5])
+
+
+def test_merge_table(tmp_path):
+    final = pd.DataFrame(
+        {
+            "eid": [1, 1, 3, 4, 6, 7, 9, 9],
+            "feature": pd.Categorical(["A", "B", "C", "D", "E", "F", "G", "H"]),
+            "value": np.arange(8, dtype=np.int32),
+        }
+    ).set_index("eid")
+    path = str(tmp_path / "final.parquet")
+    final.to_parquet(path, row_group_size=2)
+    new_rows = pd.DataFrame(
+        {
+            "eid": [3, 3, 5, 10],
+            "feature": pd.Categorical(["X", "C", "Y", "Z"]),
+            "value": np.array([10, 11, 12, 13], dtype=np.int32),
+        }
+    ).set_index("eid")
+    delta_path = str(tmp_path / "delta.parquet")
+    new_rows.to_parquet(delta_path)
+
+    # 3 is in the second row group, 5 goes before 6 in the third one, and 9 and 10 in the last one
+    counters = delta.merge_table(path, delta_path, np.array([3, 5, 9, 10]))
+    assert counters == {"rows_in": 4, "row_groups": 4, "row_groups_rebuilt": 3}
+
+    actual = pd.read_parquet(path)
+    assert list(actual.index) == [1, 1, 3, 3, 4, 5, 6, 7, 10]
+    assert actual["feature"].astype(str).tolist() == ["A", "B", "X", "C", "D", "Y", "E", "F", "Z"]
+    assert actual["value"].tolist() == [0, 1, 10, 11, 3, 12, 4, 5, 13]
+    assert actual["feature"].dtype == "category"
+    metadata = pq.ParquetFile(path).metadata
+    assert [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)] == [2, 3, 3, 1]
+
+
+def test_merge_table_patient_across_row_groups(tmp_path):
+    final = pd.DataFrame(
+        {"eid": [1, 1, 2, 2, 2, 3], "feature": pd.Categorical(["a", "b", "c", "d", "e", "f"])}
+    ).set_index("eid")
+    path = str(tmp_path / "final.parquet")
+    final.to_parquet(path, row_group_size=3)
+    delta_path = str(tmp_path / "delta.parquet")
+    pd.DataFrame({"eid": [2], "feature": pd.Categorical(["n"])}).set_index("eid").to_parquet(delta_path)
+
+    counters = delta.merge_table(path, delta_path, np.array([2]))
+    assert counters == {"rows_in": 1, "row_groups": 2, "row_groups_rebuilt": 2}
+
+    actual = pd.read_parquet(path)
+    assert list(actual.index) == [1, 1, 2, 3]
+    assert actual["feature"].astype(str).tolist() == ["a", "b", "n", "f"]
+
+
+def _standardise_and_derive(raw_dir, std_dir, final_dir):
+    os.makedirs(std_dir, exist_ok=True)
+    os.makedirs(final_dir, exist_ok=True)
+    standardise_raw.main(raw_dir=raw_dir, std_dir=std_dir, withdrawn_file=pjoin(raw_dir, synthetic.WITHDRAWN_FILE))
+    for stage in [derive_gp, derive_hospital, derive_death]:
+        stage.main(std_dir=std_dir, final_dir=final_dir)
+    derive_first_occurrence.main(final_dir=final_dir)
+
+
+def test_delta_matches_full_derivation(tmp_path):
+    raw_dir, new_raw_dir = str(tmp_path / "raw"), str(tmp_path / "new_raw")
+    synthetic.main(raw_dir, n_participants=150, seed=2)
+    shutil.copytree(raw_dir, new_raw_dir)
+    # The new release has a new episode for one patient and a new patient in gp_clinical
+    hesin = pd.read_table(pjoin(raw_dir, "hesin.txt"), dtype=str)
+    patient = hesin["eid"].iloc[0]
+    for name in ["hesin.txt", "hesin_diag.txt"]:
+        df = pd.read_table(pjoin(raw_dir, name), dtype=str)
+        episode = df.loc[df["eid"] == patient].assign(ins_index=lambda d: d["ins_index"].astype(int) + 100)
+        pd.concat([df, episode]).to_csv(pjoin(new_raw_dir, name), sep="\t", index=False)
+    gp_clinical = pd.read_table(pjoin(raw_dir, "gp_clinical.txt"), dtype=str)
+    new_patient = gp_clinical.loc[gp_clinical["eid"] == gp_clinical["eid"].iloc[0]].assign(eid="9999999")
+    pd.concat([gp_clinical, new_patient]).to_csv(pjoin(new_raw_dir, "gp_clinical.txt"), sep="\t", index=False)
+
+    std_dir, final_dir = str(tmp_path / "standardised"), str(tmp_path / "final")
+    _standardise_and_derive(raw_dir, std_dir, final_dir)
+    new_std_dir, changed_dir, delta_final_dir = (str(tmp_path / "delta" / name) for name in ["std", "changed", "final"])
+    os.makedirs(new_std_dir)
+    standardise_raw.main(
+        raw_dir=new_raw_dir, std_dir=new_std_dir, withdrawn_file=pjoin(new_raw_dir, synthetic.WITHDRAWN_FILE)
+    )
+    changed = delta.find_changes(std_dir=std_dir, new_std_dir=new_std_dir, changed_dir=changed_dir)
+    np.testing.assert_array_equal(changed, sorted([int(patient), 9999999]))
+    os.makedirs(delta_final_dir)
+    for stage in [derive_gp, derive_hospital, derive_death]:
+        stage.main(std_dir=changed_dir, final_dir=delta_final_dir)
+    derive_first_occurrence.main(final_dir=delta_final_dir)
+    delta.merge(final_dir=final_dir, delta_final_dir=delta_final_dir, changed_dir=changed_dir)
+
+    expect_dir = str(tmp_path / "expect")
+    _standardise_and_derive(new_raw_dir, str(tmp_path / "expect_std"), expect_dir)
+    for file_name in sorted(os.listdir(expect_dir)):
+        actual = pd.read_parquet(pjoin(final_dir, file_name))
+        expect = pd.read_parquet(pjoin(expect_dir, file_name))
+        if not file_name.endswith(CODE_INDEX_SUFFIX):
+            actual, expect = (df.astype({"feature": str}) for df in (actual, expect))
+        pd.testing.assert_frame_equal(actual, expect)
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+from ukbb_parser.updater.derive_death import derive_deaths
+
+
+def test_derive_deaths():
+    causes = pd.DataFrame(
+        {
+            "eid": [2, 1, 1, 1, 2, 3, 1],
+            "level": [1, 2, 1, 2, 1, 1, 2],
+            "cause_icd10": ["I21", "E11", "I21", "E11", "I21", "C34", None],
+        }
+    )
+    dates = pd.DataFrame(
+        {
+            "eid": [1, 2, 1, 2],
+            "date_of_death": pd.to_datetime(["2015-03-01", None, "2014-06-01", "2016-01-01"]),
+        }
+    )
+    actual = derive_deaths(causes, dates)
+
+    assert list(actual.index) == [1, 1, 2, 3]
+    assert actual["feature"].astype(str).tolist() == ["I21", "E11", "I21", "C34"]
+    assert actual["level"].dtype == np.int8
+    assert actual["level"].tolist() == [1, 2, 1, 1]
+    # The earliest record wins, a missing date only when the patient has no other record
+    expect = pd.to_datetime(["2014-06-01", "2014-06-01", "2016-01-01", None])
+    pd.testing.assert_series_equal(actual["date"], pd.Series(expect, index=actual.index, name="date"))
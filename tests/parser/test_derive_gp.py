@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+
+from ukbb_parser.updater.derive_gp import derive_measurements
+
+
+def test_derive_measurements():
+    df = pd.DataFrame(
+        {
+            "eid": [2, 1, 1, 3],
+            "event_dt": pd.to_datetime(["2001-01-01", "2002-01-01", "2003-01-01", "2004-01-01"]),
+            "read_2": ["246..", None, "22K..", None],
+            "read_3": [None, "XaJ0i", None, None],
+            "value1": ["120", " 5.5 ", "n/a", "7"],
+            "value2": ["80", None, "", "8"],
+            "value3": [None, "1e400", None, None],
+        }
+    )
+    expect = pd.DataFrame(
+        {
+            "eid": [2, 1, 2],
+            "date": pd.to_datetime(["2001-01-01", "2002-01-01", "2001-01-01"]),
+            "feature": pd.Categorical(["246..", "XaJ0i", "246.."], categories=["22K..", "246..", "XaJ0i"]),
+            "source": pd.Categorical(["read_2", "read_3", "read_2"], categories=["read_2", "read_3"]),
+            "value": np.array([120, 5.5, 80], dtype=np.float32),
+            "slot": np.array([1, 1, 2], dtype=np.int8),
+        }
+    ).set_index("eid")
+
+    # Records without a read code and values that are not finite numbers are dropped
+    pd.testing.assert_frame_equal(derive_measurements(df), expect)
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+
+from ukbb_loaders.loaders.sequences import SequenceReader
+from ukbb_loaders.utilities.tombstones import Tombstones
+from ukbb_parser.updater import export_sequences
+from ukbb_parser.updater.export_sequences import MISSING_DAY, SEQUENCE_SOURCES, build_vocabulary
+from ukbb_parser.updater.utils import save_final_table
+
+
+def _events(eids, features, dates):
+    return pd.DataFrame({"eid": eids, "feature": features, "date": pd.to_datetime(dates)}).set_index("eid")
+
+
+def test_build_vocabulary():
+    vocabulary = build_vocabulary({"icd10": np.array(["N181", "ZZZ9"]), "medication": np.array(["b", "a"])})
+    assert vocabulary.iloc[0].tolist() == ["", ""]
+    assert vocabulary.iloc[1]["source"] == "icd9"
+    # Codes only found in the data come last, after every lookup code
+    assert vocabulary.iloc[-3:].values.tolist() == [["icd10", "ZZZ9"], ["medication", "a"], ["medication", "b"]]
+    assert vocabulary.duplicated().sum() == 0
+
+
+def test_export_sequences(tmp_path):
+    (tmp_path / "final").mkdir()
+    final_dir, sequences_dir = str(tmp_path / "final"), str(tmp_path / "sequences")
+    tables = {table: _events([], [], []) for table, _ in SEQUENCE_SOURCES.values()}
+    tables["ehr_diagnosis_icd10"] = _events(
+        [1, 2, 2, 4], ["N181", "E11", "I10", "E11"], ["2010-01-01", None, "2001-01-01", "2000-01-01"]
+    )
+    tables["gp_medications"] = _events([2, 1], ["metformin", "aspirin"], ["2005-01-01", "2009-12-31"])
+    for table, df in tables.items():
+        save_final_table(df, final_dir=final_dir, name=table)
+    with open(f"{final_dir}/tombstones.npz", "wb") as f:
+        Tombstones.from_eids([4]).write(f)
+
+    export_sequences.main(final_dir=final_dir, sequences_dir=sequences_dir)
+    reader = SequenceReader(sequences_dir)
+    np.testing.assert_array_equal(reader.eids, [1, 2])
+
+    tokens, days = reader.get(2)
+    vocabulary = reader.vocabulary.loc[tokens]
+    assert vocabulary["code"].tolist() == ["I10", "metformin", "E11"]
+    assert vocabulary["source"].tolist() == ["icd10", "medication", "icd10"]
+    np.testing.assert_array_equal(days, [11323, 12784, MISSING_DAY])
+    assert tokens.dtype == np.int32 and days.dtype == np.int32
+    assert reader.vocabulary.loc[reader.get(1)[0], "code"].tolist() == ["aspirin", "N181"]
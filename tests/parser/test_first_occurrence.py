@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+
+from ukbb_loaders.loaders.load import DataLoader
+from ukbb_parser.updater import derive_first_occurrence
+from ukbb_parser.updater.derive_first_occurrence import first_occurrence
+from ukbb_parser.updater.utils import save_final_table
+
+
+def test_first_occurrence():
+    df = pd.DataFrame(
+        {
+            "eid": [2, 1, 1, 1, 2, 3],
+            "feature": pd.Categorical(["B", "A", "A", "C", "B", "A"]),
+            "date": pd.to_datetime(["2001-01-01", None, "2005-01-01", "2003-01-01", "1999-01-01", None]),
+        }
+    ).set_index("eid")
+    expect = pd.DataFrame(
+        {
+            "eid": [1, 1, 2, 3],
+            "feature": pd.Categorical(["A", "C", "B", "A"], categories=["A", "B", "C"]),
+            "date": pd.to_datetime(["2005-01-01", "2003-01-01", "1999-01-01", None]),
+            "count": np.array([2, 1, 2, 1], dtype=np.int32),
+        }
+    ).set_index("eid")
+
+    pd.testing.assert_frame_equal(first_occurrence(df), expect)
+
+
+def test_first_occurrence_matches_groupby():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {
+            "eid": rng.integers(0, 50, 5000),
+            "feature": pd.Categorical(rng.choice(["I10", "E11", "N181", "J45"], 5000)),
+            "date": pd.Timestamp("2000-01-01") + pd.to_timedelta(rng.integers(0, 5000, 5000), unit="D"),
+        }
+    ).set_index("eid")
+    expect = df.reset_index().groupby(["eid", "feature"], observed=True)["date"].agg(["min", "size"]).sort_index()
+    actual = first_occurrence(df)
+
+    np.testing.assert_array_equal(actual["date"].to_numpy(), expect["min"].to_numpy())
+    np.testing.assert_array_equal(actual["count"].to_numpy(), expect["size"].to_numpy())
+
+
+def test_mapped_first_occurrence(tmp_path):
+    events = pd.DataFrame(
+        {
+            "eid": [1, 1, 2],
+            "feature": ["A000", "A001", "A000"],
+            "date": pd.to_datetime(["2010-01-01", "2005-01-01", "2012-01-01"]),
+            "source": [1, 1, 2],
+        }
+    ).set_index("eid")
+    save_final_table(events, final_dir=str(tmp_path), name="ehr_diagnosis_icd10")
+    deaths = events.iloc[:0][["date", "feature"]].assign(level=np.array([], dtype=np.int8))
+    save_final_table(deaths, final_dir=str(tmp_path), name="death_icd10")
+    derive_first_occurrence._derive_ontology(str(tmp_path), "phecode")
+
+    df = pd.read_parquet(tmp_path / "first_occurrence_phecode.parquet")
+    assert list(df.index) == [1, 2]
+    assert df["feature"].astype(str).nunique() == 1
+    assert list(df["date"]) == list(pd.to_datetime(["2005-01-01", "2012-01-01"]))
+    assert list(df["count"]) == [2, 1]
+
+
+def test_query_phecode_first_occurrence(tmp_path):
+    events = pd.DataFrame(
+        {
+            "eid": [1, 2, 2],
+            "feature": ["A000", "E11", "E112"],
+            "date": pd.to_datetime(["2010-01-01", "2005-01-01", "2012-01-01"]),
+            "source": [1, 1, 2],
+        }
+    ).set_index("eid")
+    save_final_table(events, final_dir=str(tmp_path), name="ehr_diagnosis_icd10")
+    deaths = events.iloc[:0][["date", "feature"]].assign(level=np.array([], dtype=np.int8))
+    save_final_table(deaths, final_dir=str(tmp_path), name="death_icd10")
+    derive_first_occurrence._derive_ontology(str(tmp_path), "phecode")
+    dl = DataLoader(str(tmp_path))
+
+    df = dl.get_first_occurrence_data("phecode", codes="PHECODE_250", prefix=True)
+    assert list(df.index) == [2, 2]
+    assert sorted(df["feature"].astype(str)) == ["PHECODE_250.2", "PHECODE_250.22"]
+    np.testing.assert_array_equal(dl.patients_with("phecode", "PHECODE_250.2"), [2])
@@ -0,0 +1,77 @@
+from os.path import join as pjoin
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from ukbb_parser import synthetic
+from ukbb_parser.updater import standardise_raw
+
+
+def test_split_ranges(tmp_path):
+    path = tmp_path / "table.txt"
+    lines = [b"eid\tcode\n"] + [f"{i}\t{'x' * (i % 7)}\n".encode() for i in range(200)]
+    path.write_bytes(b"".join(lines))
+    ranges, header = standardise_raw._split_ranges(str(path), range_bytes=100)
+
+    assert header == lines[0]
+    assert ranges[0][0] == len(header) and ranges[-1][1] == path.stat().st_size
+    assert all(end == start for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]))
+    data = path.read_bytes()
+    assert all(data[end - 1:end] == b"\n" for _, end in ranges)
+
+
+def test_standardise_parallel(tmp_path):
+    synthetic.main(str(tmp_path), n_participants=100, seed=2)
+    raw_path = str(tmp_path / "gp_clinical.txt")
+    withdrawn = list(pd.read_csv(tmp_path / synthetic.WITHDRAWN_FILE, header=None)[0])
+    dtypes, dates, categories = standardise_raw.get_gp_clinical_dtypes()
+    read_kwargs = dict(dtype=dtypes, encoding="latin1", parse_dates=dates, dayfirst=True, usecols=dtypes.keys())
+
+    expect = pd.read_table(raw_path, **read_kwargs)
+    expect = standardise_raw._postprocess_df(expect, categories=categories, withdrawn_eids=withdrawn)
+    rows = standardise_raw._standardise_parallel(
+        raw_path,
+        pjoin(tmp_path, "gp_clinical.parquet"),
+        withdrawn,
+        categories,
+        2,
+        range_bytes=50_000,
+        row_group_size=1000,
+        **read_kwargs,
+    )
+    actual = pd.read_parquet(tmp_path / "gp_clinical.parquet")
+
+    assert rows[1] == len(expect) < rows[0]
+    metadata = pq.ParquetFile(tmp_path / "gp_clinical.parquet").metadata
+    group_rows = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    assert len(group_rows) > 1
+    assert all(count == 1000 for count in group_rows[:-1]) and 0 < group_rows[-1] <= 1000
+    for col in categories:
+        assert list(actual[col].cat.categories) == sorted(expect[col].cat.categories)
+    pd.testing.assert_frame_equal(actual, expect.reset_index(drop=True), check_categorical=False)
+
+
+def test_standardise_schema_does_not_depend_on_workers(tmp_path, monkeypatch):
+    raw_dir = str(tmp_path / "raw")
+    synthetic.main(raw_dir, n_participants=50, seed=2)
+    withdrawn = list(pd.read_csv(pjoin(raw_dir, synthetic.WITHDRAWN_FILE), header=None)[0])
+    dtypes, _, categories = standardise_raw.get_hesin_diag_dtypes()
+    schemas = []
+    for n_workers in [1, 2]:
+        std_dir = tmp_path / f"std_{n_workers}"
+        std_dir.mkdir()
+        # Every file takes the parallel path with two workers
+        monkeypatch.setattr(standardise_raw, "PARALLEL_MIN_BYTES", 0 if n_workers > 1 else 2 ** 62)
+        standardise_raw._standardise(
+            "hesin_diag",
+            raw_dir=raw_dir,
+            std_dir=str(std_dir),
+            withdrawn_eids=withdrawn,
+            categories=categories,
+            n_workers=n_workers,
+            dtype=dtypes,
+            usecols=dtypes.keys(),
+        )
+        schemas.append(pq.read_schema(std_dir / "hesin_diag.parquet"))
+
+    assert schemas[0].names == schemas[1].names == list(dtypes)
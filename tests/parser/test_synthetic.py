@@ -0,0 +1,73 @@
+import os
+from os.path import join as pjoin
+
+import numpy as np
+import pandas as pd
+
+from ukbb_loaders.loaders import load
+from ukbb_parser import synthetic
+from ukbb_parser.updater import (
+    derive_death,
+    derive_first_occurrence,
+    derive_gp,
+    derive_hospital,
+    manifest,
+    standardise_raw,
+)
+
+
+def test_generate_is_seeded(tmp_path):
+    first = synthetic.main(str(tmp_path / "first"), n_participants=50, seed=3)
+    second = synthetic.main(str(tmp_path / "second"), n_participants=50, seed=3)
+
+    assert first == second
+    for file_name in synthetic.RAW_COLUMNS:
+        with open(tmp_path / "first" / file_name) as f, open(tmp_path / "second" / file_name) as g:
+            assert f.read() == g.read()
+
+
+def test_generate_raw_files(tmp_path):
+    rows = synthetic.main(str(tmp_path), n_participants=200, seed=0)
+
+    for file_name, columns in synthetic.RAW_COLUMNS.items():
+        df = pd.read_table(tmp_path / file_name, dtype=str)
+        assert list(df.columns) == columns
+        assert len(df) == rows[file_name]
+    gp_clinical = pd.read_table(tmp_path / "gp_clinical.txt", dtype=str)
+    assert gp_clinical["event_dt"].isin(synthetic.SENTINEL_DATES).any()
+    assert gp_clinical[["read_2", "read_3"]].notna().sum(axis=1).eq(1).all()
+
+
+def test_pipeline_on_synthetic_data(tmp_path):
+    raw_dir, std_dir, final_dir = (str(tmp_path / name) for name in ["raw", "standardised", "final"])
+    os.makedirs(std_dir)
+    os.makedirs(final_dir)
+    synthetic.main(raw_dir, n_participants=300, seed=1)
+
+    standardise_raw.main(raw_dir=raw_dir, std_dir=std_dir, withdrawn_file=pjoin(raw_dir, synthetic.WITHDRAWN_FILE))
+    for stage in [derive_gp, derive_hospital, derive_death]:
+        stage.main(std_dir=std_dir, final_dir=final_dir)
+    derive_first_occurrence.main(final_dir=final_dir)
+    manifest.main(final_dir=final_dir)
+
+    dl = load.DataLoader(final_dir)
+    withdrawn = pd.read_csv(pjoin(raw_dir, synthetic.WITHDRAWN_FILE), header=None)[0]
+    hospital = dl.get_hospital_data(["icd9", "icd10", "opcs3", "opcs4"])
+    assert set(hospital["source"]) == {"icd9", "icd10", "opcs3", "opcs4"}
+    assert not hospital.index.isin(withdrawn).any()
+    assert len(dl.get_gp_clinical_data()) > 0
+    assert len(dl.get_gp_medication_data()) > 0
+    measurements = dl.get_gp_measurement_data(start_date="2000-01-01")
+    assert len(measurements) > 0
+    assert measurements["value"].dtype == np.float32
+    assert measurements.index.is_monotonic_increasing
+    assert (measurements["date_of_measurement"] >= pd.Timestamp("2000-01-01")).all()
+    assert len(dl.get_death_data()) > 0
+
+    first = dl.get_first_occurrence_data("icd10").reset_index()
+    expect = hospital.loc[hospital["source"] == "icd10"].reset_index()
+    expect = expect.groupby(["eid", "feature"], observed=True)["date_of_visit"].min().reset_index()
+    first, expect = (df.astype({"feature": str}).sort_values(["eid", "feature"]) for df in (first, expect))
+    assert len(first) == len(expect)
+    assert first["date_of_first_occurrence"].tolist() == expect["date_of_visit"].tolist()
+    assert len(dl.get_first_occurrence_data(["phecode", "mondo"])) > 0
@@ -0,0 +1,136 @@
+import json
+import os
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join as pjoin
+
+import pytest
+
+from ukbb_parser import synthetic
+from ukbb_parser.updater import derive_death, derive_gp, derive_hospital, standardise_raw, telemetry
+
+
+@pytest.fixture()
+def collector(tmp_path):
+    collector = telemetry.Telemetry()
+    collector.configure(report_path=str(tmp_path / "telemetry.json"))
+    return collector
+
+
+def test_stage(collector, tmp_path):
+    path = tmp_path / "table.txt"
+    path.write_text("x" * 100)
+    with collector.stage("stage") as stage:
+        stage.read(str(path))
+        stage.add(rows_in=10, rows_out=8, rows_withdrawn=2)
+        data = bytearray(50 * 2 ** 20)
+    del data
+
+    (record,) = json.loads((tmp_path / "telemetry.json").read_text())["stages"]
+    assert record["status"] == "done"
+    assert (record["rows_in"], record["rows_out"], record["rows_withdrawn"], record["bytes_read"]) == (10, 8, 2, 100)
+    assert record["peak_rss_bytes"] > 50 * 2 ** 20
+    assert record["wall_seconds"] >= 0
+
+
+def _allocate_and_spin(size: int) -> int:
+    data = bytearray(size)
+    deadline = time.process_time() + 0.3
+    while time.process_time() < deadline:
+        pass
+    time.sleep(0.2)
+    return len(data)
+
+
+def test_stage_measures_worker_processes(collector, tmp_path):
+    with collector.stage("stage"):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            assert executor.submit(_allocate_and_spin, 100 * 2 ** 20).result() == 100 * 2 ** 20
+
+    (record,) = json.loads((tmp_path / "telemetry.json").read_text())["stages"]
+    assert record["children_cpu_seconds"] >= 0.3
+    assert record["cpu_seconds"] >= record["children_cpu_seconds"]
+    assert record["children_peak_rss_bytes"] > 100 * 2 ** 20
+    assert record["peak_rss_bytes"] > record["children_peak_rss_bytes"]
+
+
+def test_children_rss_only_reads_children(monkeypatch):
+    child = subprocess.Popen(["sleep", "5"])
+    opened = []
+    real_open = open
+
+    def tracked_open(path, *args, **kwargs):
+        opened.append(path)
+        return real_open(path, *args, **kwargs)
+
+    monkeypatch.setattr("builtins.open", tracked_open)
+    try:
+        rss = telemetry._children_rss()
+    finally:
+        monkeypatch.undo()
+        child.kill()
+        child.wait()
+
+    if rss is None:
+        pytest.skip("The kernel does not list the children of a process.")
+    assert rss > 0
+    assert [path for path in opened if not path.startswith("/proc/self/")] == [f"/proc/{child.pid}/statm"]
+
+
+def test_children_peak_without_listing(collector, tmp_path, monkeypatch):
+    monkeypatch.setattr(telemetry, "_children_rss", lambda: None)
+    with collector.stage("stage"):
+        pass
+
+    (record,) = json.loads((tmp_path / "telemetry.json").read_text())["stages"]
+    assert record["children_peak_rss_bytes"] == telemetry._max_rss(telemetry.resource.RUSAGE_CHILDREN)
+
+
+def test_failed_stage_is_reported(collector, tmp_path):
+    records = []
+    collector.sinks.append(records.append)
+    with pytest.raises(KeyError):
+        with collector.stage("stage"):
+            raise KeyError()
+
+    report = json.loads((tmp_path / "telemetry.json").read_text())
+    assert report["stages"][0]["status"] == "failed"
+    assert records[0]["name"] == "stage"
+
+
+def test_unknown_counter(collector):
+    with pytest.raises(ValueError):
+        with collector.stage("stage") as stage:
+            stage.add(rows=1)
+
+
+def test_pipeline_telemetry(tmp_path):
+    raw_dir, std_dir, final_dir = (str(tmp_path / name) for name in ["raw", "standardised", "final"])
+    os.makedirs(std_dir)
+    os.makedirs(final_dir)
+    synthetic.main(raw_dir, n_participants=300, seed=1)
+
+    telemetry.telemetry.configure(report_path=str(tmp_path / "telemetry.json"))
+    try:
+        standardise_raw.main(raw_dir=raw_dir, std_dir=std_dir, withdrawn_file=pjoin(raw_dir, synthetic.WITHDRAWN_FILE))
+        for stage in [derive_gp, derive_hospital, derive_death]:
+            stage.main(std_dir=std_dir, final_dir=final_dir)
+    finally:
+        telemetry.telemetry.configure()
+
+    stages = {record["name"]: record for record in json.loads((tmp_path / "telemetry.json").read_text())["stages"]}
+    assert set(stages) == {
+        *(f"standardise_raw.{name[:-4]}" for name in synthetic.RAW_COLUMNS),
+        "derive_gp.diagnoses",
+        "derive_gp.measurements",
+        "derive_gp.medications",
+        "derive_hospital.diagnoses",
+        "derive_hospital.procedures",
+        "derive_death",
+    }
+    hesin = stages["standardise_raw.hesin"]
+    assert hesin["rows_in"] == hesin["rows_out"] + hesin["rows_withdrawn"]
+    assert hesin["bytes_read"] == os.path.getsize(pjoin(raw_dir, "hesin.txt"))
+    assert stages["derive_death"]["bytes_written"] > 0
+    assert all(record["status"] == "done" for record in stages.values())
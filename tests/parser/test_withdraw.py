@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ukbb_loaders.loaders.load import DataLoader
+from ukbb_loaders.loaders.sequences import SequenceReader
+from ukbb_parser.updater import export_sequences, manifest, withdraw
+from ukbb_parser.updater.utils import save_final_table
+
+
+EVENTS = pd.DataFrame(
+    {
+        "eid": [1, 1, 2, 3, 3],
+        "feature": ["N181", "N182", "N181", "E11", "N181"],
+        "date": pd.to_datetime(["2010-02-16", "2011-01-01", "2015-03-31", "1913-09-04", "2001-01-01"]),
+        "source": [1, 2, 2, 1, 1],
+    }
+).set_index("eid")
+
+
+@pytest.fixture()
+def withdrawn_file(final_dir):
+    """
+    Adds an ehr_diagnosis_icd9 table without rows of patient 3 and a manifest to the final
+    directory, and returns a withdrawn consent file of patient 3.
+    """
+    save_final_table(EVENTS.iloc[[2]], final_dir=final_dir, name="ehr_diagnosis_icd9")
+    manifest.main(final_dir=final_dir)
+    path = f"{final_dir}/withdrawn.csv"
+    with open(path, "w") as f:
+        f.write("3\n")
+    return path
+
+
+with_events = pytest.mark.parametrize("final_dir", [{"events": EVENTS}], indirect=True)
+
+
+@with_events
+def test_withdraw(final_dir, withdrawn_file):
+    withdraw.main(final_dir=final_dir, withdrawn_file=withdrawn_file)
+    # The tables are untouched, and the withdrawn patients are dropped as they are read
+    assert pd.read_parquet(f"{final_dir}/ehr_diagnosis_icd10.parquet").index.tolist() == [1, 1, 2, 3, 3]
+    dl = DataLoader(final_dir)
+    dl.validate()
+    assert dl.get_hospital_data("icd10").index.tolist() == [1, 1, 2]
+    assert dl.get_hospital_data("icd10", codes="N181").index.tolist() == [1, 2]
+    np.testing.assert_array_equal(dl.patients_with("icd10", "N18", prefix=True), [1, 2])
+
+    withdraw.main(final_dir=final_dir, withdrawn_file=withdrawn_file, compact=True)
+    assert pd.read_parquet(f"{final_dir}/ehr_diagnosis_icd10.parquet").index.tolist() == [1, 1, 2]
+    dl = DataLoader(final_dir)
+    dl.validate()
+    assert dl.manifest.tombstones["withdrawn"] == 1
+    assert dl.get_hospital_data("icd10", codes="N181").index.tolist() == [1, 2]
+
+
+@with_events
+def test_withdraw_removes_sequences(final_dir, withdrawn_file, tmp_path):
+    sequences_dir = str(tmp_path / "sequences")
+    arrays = {
+        "eids": np.array([1, 2, 3], dtype=np.int64),
+        "offsets": np.array([0, 2, 3, 5], dtype=np.int64),
+        "tokens": np.array([1, 2, 1, 3, 2], dtype=np.int32),
+        "days": np.arange(5, dtype=np.int32),
+    }
+    vocabulary = pd.DataFrame({"source": ["", "icd10", "icd10", "icd10"], "code": ["", "N181", "N182", "E11"]})
+    export_sequences.write_sequences(sequences_dir, arrays, vocabulary)
+
+    withdraw.main(final_dir=final_dir, withdrawn_file=withdrawn_file, sequences_dir=sequences_dir)
+    reader = SequenceReader(sequences_dir)
+    np.testing.assert_array_equal(reader.eids, [1, 2])
+    np.testing.assert_array_equal(reader.get(2)[0], [1])
+    np.testing.assert_array_equal(reader.get(1)[1], [0, 1])
+    assert reader.vocabulary["code"].tolist() == vocabulary["code"].tolist()
+
+
+def test_withdraw_without_manifest(tmp_path):
+    (tmp_path / "withdrawn.csv").write_text("3\n")
+    with pytest.raises(ValueError):
+        withdraw.main(final_dir=str(tmp_path), withdrawn_file=str(tmp_path / "withdrawn.csv"))
@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ukbb_loaders.utilities import filesystem
+from ukbb_loaders.utilities.filesystem import (
+    COALESCE_GAP,
+    PART_SIZE,
+    RangeFile,
+    get_filesystem,
+    open_parquet,
+    read_parquet,
+    read_table,
+    select_row_groups,
+)
+
+
+@pytest.fixture()
+def table_path(tmp_path):
+    df = pd.DataFrame(
+        {
+            "eid": np.repeat(np.arange(100), 10),
+            "feature": np.tile(["N181", "N182", "E11", "I10", "J45"], 200),
+            "value": 1,
+        }
+    ).set_index("eid")
+    path = tmp_path / "ehr_diagnosis_icd10.parquet"
+    df.to_parquet(path, row_group_size=100)
+    return str(path)
+
+
+def test_plan_requests_coalesces_and_splits():
+    ranges = [(0, 10), (20, 30), (COALESCE_GAP * 4, COALESCE_GAP * 4 + 2 * PART_SIZE + 1), (5, 5)]
+    actual = filesystem._plan_requests(ranges)
+    start = COALESCE_GAP * 4
+    expect = [
+        (0, 30),
+        (start, start + PART_SIZE),
+        (start + PART_SIZE, start + 2 * PART_SIZE),
+        (start + 2 * PART_SIZE, start + 2 * PART_SIZE + 1),
+    ]
+    assert actual == expect
+
+
+def test_range_file(table_path):
+    with open(table_path, "rb") as f:
+        content = f.read()
+    range_file = RangeFile(get_filesystem(table_path), table_path)
+    range_file.prefetch([(0, 100), (200, 300)])
+
+    assert range_file.read_range(50, 250) == content[50:250]
+    assert range_file.read_range(len(content) - 10, len(content)) == content[-10:]
+    range_file.seek(-4, 2)
+    assert range_file.read() == b"PAR1"
+    assert range_file.requests == 2
+
+
+def test_select_row_groups(table_path):
+    parquet_file = open_parquet(table_path)
+    assert select_row_groups(parquet_file, np.array([3, 55, 56])) == [0, 5]
+    assert select_row_groups(parquet_file) == list(range(10))
+
+
+def test_read_parquet_prunes_row_groups(table_path):
+    actual = read_parquet(table_path, columns=["feature"], patient_list=np.array([12]))
+    assert actual.index.name == "eid"
+    assert list(actual.columns) == ["feature"]
+    assert sorted(actual.index.unique()) == list(range(10, 20))
+
+
+def test_read_table_s3(table_path):
+    moto_server = pytest.importorskip("moto.server")
+    server = moto_server.ThreadedMotoServer(port=0)
+    server.start()
+    try:
+        host, port = server.get_host_and_port()
+        filesystem.configure(
+            max_concurrency=4, key="testing", secret="testing", client_kwargs={"endpoint_url": f"http://{host}:{port}"}
+        )
+        fs = get_filesystem("s3://bucket")
+        fs.mkdir("bucket")
+        fs.put(table_path, "bucket/final/ehr_diagnosis_icd10.parquet")
+
+        assert filesystem.is_nonempty_dir("s3://bucket/final")
+        parquet_file = open_parquet("s3://bucket/final/ehr_diagnosis_icd10.parquet")
+        actual = read_table(parquet_file, columns=["feature"], row_groups=[5]).to_pandas()
+        expect = pd.read_parquet(table_path, columns=["feature"]).loc[50:59]
+
+        pd.testing.assert_frame_equal(actual, expect)
+        # The footer prefetch covers the whole of this small file
+        assert parquet_file.range_file.requests == 1
+
+        # With known metadata, as from the manifest, only the column chunks are fetched
+        parquet_file = open_parquet(
+            "s3://bucket/final/ehr_diagnosis_icd10.parquet",
+            size=parquet_file.range_file.size,
+            metadata=parquet_file.metadata,
+        )
+        assert parquet_file.range_file.requests == 0
+        read_table(parquet_file, columns=["feature"], row_groups=[5])
+        assert parquet_file.range_file.requests == 1
+    finally:
+        filesystem.configure(max_concurrency=16)
+        server.stop()
+
+
+def test_read_parquet_filters(table_path):
+    actual = read_parquet(
+        table_path, columns=["value"], patient_list=np.array([12]), filters=[("feature", "in", ["E11", "J45"])]
+    )
+    assert list(actual.columns) == ["value"]
+    assert len(actual) == 40
+    assert read_parquet(table_path, filters=[("feature", "==", "E11")])["feature"].unique().tolist() == ["E11"]
+    with pytest.raises(ValueError):
+        read_parquet(table_path, filters=[("feature", "<", "E11")])
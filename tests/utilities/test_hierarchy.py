@@ -0,0 +1,58 @@
+"""
+Testing ukbb_loaders/utilities/hierarchy.py
+"""
+import pytest
+import numpy as np
+
+from ukbb_loaders.utilities import hierarchy
+
+
+@pytest.fixture()
+def atc():
+    return hierarchy.HierarchyIndex.from_edges(
+        children=np.array(['A10B', 'A10BA', 'A10BA02', 'A10BA02', 'N06A', 'N06AX', 'N06AX11']),
+        parents=np.array(['A10', 'A10B', 'A10BA', 'A10', 'N06', 'N06A', 'N06AX']),
+        root_level=2,
+    )
+
+
+def test_rollup(atc):
+    actual = atc.rollup(['A10BA02', 'N06AX11', 'A10', 'X99'], level=3)
+    np.testing.assert_array_equal(actual, ['A10B', 'N06A', 'A10', 'X99'])
+
+    actual = atc.rollup(['A10BA02', 'A10', 'X99'], level=3, strict=True)
+    np.testing.assert_array_equal(actual, ['A10B', None, None])
+
+
+def test_level(atc):
+    np.testing.assert_array_equal(atc.level(['A10', 'A10BA02', 'X99']), [2, 5, -1])
+
+
+def test_is_descendant(atc):
+    codes = ['A10BA02', 'A10B', 'N06AX11', 'X99']
+    np.testing.assert_array_equal(atc.is_descendant(codes, 'A10B'), [True, True, False, False])
+    np.testing.assert_array_equal(atc.is_descendant(codes, 'A10B', include_self=False), [True, False, False, False])
+    np.testing.assert_array_equal(atc.is_descendant(codes, 'X99'), [False, False, False, False])
+
+
+def test_descendants_and_ancestors(atc):
+    np.testing.assert_array_equal(atc.descendants('A10'), ['A10', 'A10B', 'A10BA', 'A10BA02'])
+    np.testing.assert_array_equal(atc.ancestors_of('N06AX11', include_self=False), ['N06', 'N06A', 'N06AX'])
+
+
+def test_from_prefixes():
+    index = hierarchy.HierarchyIndex.from_prefixes(np.array(['250', '250.2', '250.21', '401', '250.1']))
+    np.testing.assert_array_equal(index.ancestors_of('250.21'), ['250', '250.2', '250.21'])
+    np.testing.assert_array_equal(index.rollup(['250.21', '250.1', '401'], level=0), ['250', '250', '401'])
+
+
+def test_phecode_hierarchy():
+    phecodes = hierarchy.phecode_hierarchy()
+    codes = ['250.21', 'PHECODE_250.21', 'PHECODE_401.1']
+    np.testing.assert_array_equal(phecodes.rollup(codes, level=0), ['250', 'PHECODE_250', 'PHECODE_401'])
+    np.testing.assert_array_equal(phecodes.level(codes), [2, 2, 1])
+
+
+def test_cycle():
+    with pytest.raises(ValueError):
+        hierarchy.HierarchyIndex(np.array(['a', 'b']), np.array([1, 0]))
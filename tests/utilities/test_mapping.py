@@ -0,0 +1,85 @@
+"""
+Testing ukbb_loaders/utilities/mapping.py
+"""
+import pytest
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+
+from ukbb_loaders.utilities import mapping
+
+
+@pytest.fixture()
+def read_to_icd10():
+    return mapping.CompiledMapper.from_pairs(
+        name="read_to_icd10",
+        sources=np.array(['C10..', 'C10..', 'G20..', 'G20..', None]),
+        targets=np.array(['E11', 'E10', 'I10', 'I10', 'I11']),
+        target_name="icd10",
+    )
+
+
+@pytest.fixture()
+def icd10_to_phecode():
+    return mapping.CompiledMapper.from_pairs(
+        name="icd10_to_phecode",
+        sources=np.array(['E10', 'E11', 'I10']),
+        targets=np.array(['250.1', '250.2', '401']),
+        target_name="phecode",
+    )
+
+
+@pytest.fixture()
+def gp_data():
+    return pd.DataFrame(
+        {
+            "eid": [1, 2, 3],
+            "feature": ['C10..', 'G20..', 'XaA1S'],
+            "source": ['read_2', 'read_2', 'read_2'],
+        }
+    ).set_index("eid")
+
+
+def test_apply_one_to_many(read_to_icd10, gp_data):
+    actual = read_to_icd10.apply(gp_data)
+
+    assert actual.index.tolist() == [1, 1, 2]
+    assert actual["icd10"].tolist() == ['E10', 'E11', 'I10']
+    assert actual["feature"].tolist() == ['C10..', 'C10..', 'G20..']
+
+
+def test_apply_keep_unmapped(read_to_icd10, gp_data):
+    actual = read_to_icd10.apply(gp_data, target_column="feature", keep_unmapped=True)
+
+    assert actual.index.tolist() == [1, 1, 2, 3]
+    assert actual["feature"].tolist()[:3] == ['E10', 'E11', 'I10']
+    assert pd.isna(actual["feature"].iloc[3])
+
+
+def test_apply_arrow(read_to_icd10, gp_data):
+    table = pa.Table.from_pandas(gp_data.reset_index())
+    actual = read_to_icd10.apply(table)
+
+    assert actual.column("eid").to_pylist() == [1, 1, 2]
+    assert actual.column("icd10").to_pylist() == ['E10', 'E11', 'I10']
+
+
+def test_chain(read_to_icd10, icd10_to_phecode, gp_data):
+    chain = read_to_icd10.then(icd10_to_phecode)
+    actual = chain.apply(gp_data)
+
+    assert chain.name == "read_to_icd10->icd10_to_phecode"
+    assert actual.index.tolist() == [1, 1, 2]
+    assert actual["phecode"].tolist() == ['250.1', '250.2', '401']
+
+
+def test_get_chain_is_cached():
+    chain = mapping.get_chain("readcode_to_icd10", "icd10_to_phecodes")
+
+    assert mapping.get_chain("readcode_to_icd10", "icd10_to_phecodes") is chain
+    assert chain.target_name == "phecode"
+
+
+def test_get_mapper_unknown():
+    with pytest.raises(ValueError):
+        mapping.get_mapper("icd9_to_icd10")
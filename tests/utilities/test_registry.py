@@ -0,0 +1,45 @@
+"""
+Testing ukbb_loaders/utilities/registry.py
+"""
+import subprocess
+import sys
+
+import pytest
+import numpy as np
+
+from ukbb_loaders.utilities import util
+from ukbb_loaders.utilities.registry import registry
+
+
+def test_lookups_config_use():
+    actual = registry.lookups(config_use=True)["lookup"].tolist()
+
+    assert "ehr_diagnosis_icd10" in actual
+    assert "ehr_diagnosis_phecodes" not in actual
+    # Listed in the parent lookup but not bundled
+    assert "ehr_diagnosis_read3" not in actual
+
+
+def test_meaning():
+    actual = registry.meaning("ehr_diagnosis_icd10", ["N181", "not_a_code"])
+    np.testing.assert_array_equal(actual, ["N18.1 Chronic kidney disease, stage 1", None])
+
+
+def test_meaning_unknown_lookup():
+    with pytest.raises(ValueError):
+        registry.meaning("ehr_diagnosis_icd11", ["N181"])
+
+
+def test_load_lookup_is_memoised():
+    first = util.load_lookup("ehr_diagnosis_icd10")
+    first["meaning"] = None
+
+    assert util.load_lookup("ehr_diagnosis_icd10")["meaning"].notna().all()
+    assert util._read_cached.cache_info().hits > 0
+
+
+def test_s3fs_is_imported_lazily():
+    code = "import sys, ukbb_loaders.loaders.load, ukbb_loaders.utilities.registry; print('s3fs' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+
+    assert output.strip() == "False"
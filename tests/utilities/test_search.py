@@ -0,0 +1,75 @@
+"""
+Testing ukbb_loaders/utilities/search.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from ukbb_loaders.utilities import search
+
+
+@pytest.fixture()
+def icd10_search(tmp_path, monkeypatch):
+    monkeypatch.setattr(search, "CACHE_DIR", tmp_path)
+    search.get_search.cache_clear()
+    yield search.get_search(("ehr_diagnosis_icd10",))
+    search.get_search.cache_clear()
+
+
+def test_search_text(icd10_search):
+    actual = icd10_search.search_text("chronic kidney disease", limit=50)
+
+    assert len(actual) > 0
+    assert actual["coding"].str.startswith("N18").all()
+    assert actual["meaning"].str.lower().str.contains("chronic kidney disease").all()
+
+
+def test_search_text_prefix_tokens(icd10_search):
+    actual = icd10_search.search_text("chron kidn", limit=50)
+
+    assert "N181" in actual["coding"].tolist()
+
+
+def test_search_code(icd10_search):
+    actual = icd10_search.search_code("N18")
+
+    assert actual["coding"].iloc[0] == "N18"
+    assert actual["coding"].str.startswith("N18").all()
+
+
+def test_search_ranks_codes_first(icd10_search):
+    actual = icd10_search.search("N18")
+
+    assert actual["coding"].iloc[0] == "N18"
+    assert (actual["score"] > 100).all()
+
+
+def test_search_index_is_cached_on_disk(icd10_search, tmp_path):
+    assert len(list(tmp_path.glob("search_index_*.npz"))) == 1
+    assert len(list(tmp_path.glob("search_index_*.parquet"))) == 1
+    search.get_search.cache_clear()
+
+    cached = search.get_search(("ehr_diagnosis_icd10",))
+    assert cached is not icd10_search
+    assert cached.search("N181")["coding"].iloc[0] == "N181"
+    pd.testing.assert_frame_equal(cached.search("chronic kidney"), icd10_search.search("chronic kidney"))
+
+
+def test_search_index_cache_of_another_format_is_rebuilt(icd10_search, tmp_path):
+    (cache_path,) = tmp_path.glob("search_index_*.npz")
+    np.savez(cache_path, format=np.int64(search.INDEX_FORMAT - 1))
+    search.get_search.cache_clear()
+
+    assert search.get_search(("ehr_diagnosis_icd10",)).search("N181")["coding"].iloc[0] == "N181"
+
+
+def test_search_index_is_written_through_files_of_the_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(search, "CACHE_DIR", tmp_path)
+    replaced = []
+    monkeypatch.setattr(search.os, "replace", lambda src, dst: replaced.append(src.name))
+    search.get_search.cache_clear()
+    search.get_search(("ehr_diagnosis_icd10",))
+    search.get_search.cache_clear()
+
+    pid = search.os.getpid()
+    assert [name.split(".")[-2:] for name in replaced] == [[str(pid), "parquet"], [str(pid), "npz"]]
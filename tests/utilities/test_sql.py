@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+pytest.importorskip("duckdb")
+
+from ukbb_loaders.loaders import load  # noqa: E402
+from ukbb_loaders.utilities import sql  # noqa: E402
+from ukbb_loaders.utilities.util import load_mapper  # noqa: E402
+
+
+def test_connect(final_dir):
+    con = sql.connect(final_dir, threads=2)
+    views = set(con.execute("SELECT view_name FROM duckdb_views() WHERE NOT internal").df()["view_name"])
+
+    assert "ehr_diagnosis_icd10" in views
+    assert "ehr_diagnosis_icd10_code_index" not in views
+    assert {"lookup_ehr_diagnosis_icd10", "mapper_icd10_to_phecodes"} <= views
+
+
+def test_data_loader_sql(final_dir):
+    dl = load.DataLoader(final_dir)
+    df = dl.sql(
+        "SELECT m.phecode, count(DISTINCT d.eid) AS patients FROM ehr_diagnosis_icd10 d "
+        "JOIN mapper_icd10_to_phecodes m ON d.feature = m.icd10_code GROUP BY m.phecode"
+    )
+    mapper = load_mapper("icd10_to_phecodes")
+    events = pd.DataFrame({"eid": [1, 2, 3, 3], "icd10_code": ["N181", "N182", "N181", "I10"]})
+    expect = events.merge(mapper, on="icd10_code").groupby("phecode")["eid"].nunique()
+    assert df.set_index("phecode")["patients"].sort_index().tolist() == expect.sort_index().tolist()
+
+    table = dl.sql("SELECT eid FROM ehr_diagnosis_icd10 WHERE feature = ? ORDER BY eid", params=["N181"], arrow=True)
+    assert isinstance(table, pa.Table)
+    np.testing.assert_array_equal(table.column("eid").to_numpy(), [1, 3])
+
+
+def test_connect_tombstones(final_dir):
+    from ukbb_loaders.utilities.tombstones import Tombstones
+
+    with open(f"{final_dir}/tombstones.npz", "wb") as f:
+        Tombstones.from_eids([3]).write(f)
+    con = sql.connect(final_dir)
+    assert con.cursor().execute("SELECT DISTINCT eid FROM ehr_diagnosis_icd10 ORDER BY eid").df()["eid"].tolist() == [1, 2]
@@ -0,0 +1,22 @@
+import numpy as np
+
+from ukbb_loaders.utilities.tombstones import Tombstones
+
+
+def test_withdrawn():
+    tombstones = Tombstones.from_eids(np.array([1000020, 1000003, 1000011, 1000003]))
+    assert len(tombstones) == 3
+    np.testing.assert_array_equal(tombstones.eids(), [1000003, 1000011, 1000020])
+    np.testing.assert_array_equal(
+        tombstones.withdrawn(np.array([1000003, 1000004, 1000020, 1000021, 1000002, 5])),
+        [True, False, True, False, False, False],
+    )
+    np.testing.assert_array_equal(tombstones.union([1000004]).eids(), [1000003, 1000004, 1000011, 1000020])
+    assert not Tombstones.from_eids([]).withdrawn(np.array([1000003])).any()
+
+
+def test_load(tmp_path):
+    assert Tombstones.load(str(tmp_path)) is None
+    with open(tmp_path / "tombstones.npz", "wb") as f:
+        Tombstones.from_eids([7, 9]).write(f)
+    np.testing.assert_array_equal(Tombstones.load(str(tmp_path)).eids(), [7, 9])
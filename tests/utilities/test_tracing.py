@@ -0,0 +1,67 @@
+import contextvars
+import threading
+
+import pytest
+
+from ukbb_loaders.utilities import tracing
+from ukbb_loaders.utilities.tracing import span, trace
+
+
+def test_span_without_trace_is_noop():
+    assert not tracing.is_tracing()
+    with span("read", rows=1) as s:
+        s.set(rows=2)
+    assert s is tracing._NOOP
+
+
+def test_nested_spans():
+    records = []
+    with trace(callback=records.append) as t:
+        with span("outer", file="a.parquet") as outer:
+            with span("inner") as inner:
+                inner.set(rows=3)
+            outer.set(rows=3)
+    with span("after"):
+        pass
+
+    summary = t.summary()
+    assert list(summary["name"]) == ["outer", "inner"]
+    assert list(summary["depth"]) == [0, 1]
+    assert summary.loc[1, "parent"] == summary.loc[0, "id"]
+    assert summary.loc[0, "file"] == "a.parquet"
+    assert [record["name"] for record in records] == ["inner", "outer"]
+    assert not tracing.is_tracing()
+
+
+def test_span_records_errors():
+    with trace() as t:
+        with pytest.raises(KeyError):
+            with span("read"):
+                raise KeyError()
+    assert t.spans[0]["attributes"]["error"] == "KeyError"
+
+
+def test_concurrent_queries_nest_their_own_spans():
+    barrier = threading.Barrier(2)
+
+    def query(name):
+        with span(name):
+            barrier.wait()
+            with span(f"{name}.read"):
+                barrier.wait()
+
+    with trace() as t:
+        threads = [
+            threading.Thread(target=contextvars.copy_context().run, args=(query, name)) for name in ["a", "b"]
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    summary = t.summary().set_index("name")
+    assert summary["id"].is_unique
+    for name in ["a", "b"]:
+        assert summary.loc[f"{name}.read", "parent"] == summary.loc[name, "id"]
+        assert summary.loc[f"{name}.read", "depth"] == 1
+        assert summary.loc[name, "depth"] == 0
@@ -0,0 +1,101 @@
+"""
+Testing ukbb_loaders/utilities/windows.py
+"""
+import pytest
+import pandas as pd
+import numpy as np
+
+from ukbb_loaders.utilities import windows
+
+
+@pytest.fixture()
+def hospital_data():
+    df = pd.DataFrame(
+        {
+            "eid": [1, 1, 1, 2, 2, 3, 4],
+            "feature": ['N181', 'N181', 'E11', 'N181', 'N181', 'N181', 'N181'],
+            "date_of_visit": [
+                '2009-01-01', '2009-12-31', '2005-06-01', '2010-01-05', None, '2001-01-01', '2010-01-01',
+            ],
+            "source": ['icd10'] * 7,
+            "value": [1] * 7,
+        }
+    ).set_index("eid")
+    df['date_of_visit'] = pd.to_datetime(df['date_of_visit'])
+    return df
+
+
+@pytest.fixture()
+def index_dates():
+    return pd.Series(pd.to_datetime(['2010-01-01', '2010-01-01', '2010-01-01']), index=[1, 2, 3])
+
+
+def test_aggregate_windows(hospital_data, index_dates):
+    actual = windows.aggregate_windows(
+        hospital_data,
+        index_dates,
+        [windows.Window("1y_before", -365, -1), ("after", 0, 30)],
+    )
+    expect = pd.DataFrame(
+        {
+            "eid": [1, 2],
+            "feature": ['N181', 'N181'],
+            "window": ['1y_before', 'after'],
+            "count": [2, 1],
+            "exists": [True, True],
+            "first_date": pd.to_datetime(['2009-01-01', '2010-01-05']),
+            "last_date": pd.to_datetime(['2009-12-31', '2010-01-05']),
+        }
+    ).set_index("eid")
+
+    pd.testing.assert_frame_equal(actual, expect)
+
+
+def test_aggregate_windows_skips_missing_codes(hospital_data, index_dates):
+    df = hospital_data.assign(feature=['N181', None, 'E11', 'N181', 'N181', None, 'N181'])
+    actual = windows.aggregate_windows(df, index_dates, [("1y_before", -365, -1)])
+
+    assert actual["feature"].tolist() == ['N181']
+    assert actual["count"].tolist() == [1]
+    actual = windows.aggregate_windows(df.loc[[3]], index_dates, [("10y_before", -3650, -1)])
+    assert actual.empty
+
+
+def test_aggregate_windows_keep_empty(hospital_data, index_dates):
+    actual = windows.aggregate_windows(
+        hospital_data, index_dates, [("5y_before", -5 * 365, -1)], codes=['N181'], keep_empty=True
+    )
+
+    assert actual.index.tolist() == [1, 2, 3]
+    assert actual["count"].tolist() == [2, 0, 0]
+    assert actual["exists"].tolist() == [True, False, False]
+    assert actual["first_date"].isna().tolist() == [False, True, True]
+
+
+def test_aggregate_windows_matches_brute_force():
+    rng = np.random.default_rng(0)
+    n = 2000
+    df = pd.DataFrame(
+        {
+            "eid": rng.integers(0, 50, n),
+            "feature": rng.choice(['a', 'b', 'c'], n),
+            "date": pd.Timestamp('2000-01-01') + pd.to_timedelta(rng.integers(0, 3650, n), unit="D"),
+        }
+    ).set_index("eid")
+    index_dates = pd.Series(
+        pd.Timestamp('2005-01-01') + pd.to_timedelta(rng.integers(0, 365, 50), unit="D"), index=range(50)
+    )
+    actual = windows.aggregate_windows(df, index_dates, [("w", -400, 100)])
+
+    merged = df.join(index_dates.rename("index_date")).rename_axis("eid")
+    delta = (merged["date"] - merged["index_date"]).dt.days
+    expect = merged.loc[(delta >= -400) & (delta <= 100)].groupby(["eid", "feature"])["date"].agg(["count", "min"])
+    actual = actual.reset_index().set_index(["eid", "feature"]).sort_index()
+
+    assert actual["count"].tolist() == expect["count"].tolist()
+    assert actual["first_date"].tolist() == expect["min"].tolist()
+
+
+def test_aggregate_windows_invalid_window(hospital_data, index_dates):
+    with pytest.raises(ValueError):
+        windows.aggregate_windows(hospital_data, index_dates, [("bad", 10, -10)])
@@ -0,0 +1,146 @@
+"""
+An asyncio variant of DataLoader for async services.
+
+Example:
+    >>> async with AsyncDataLoader("s3://<BUCKET>/final", max_workers=4) as dl:
+    ...     icd10, gp = await asyncio.gather(
+    ...         dl.get_hospital_data("icd10", patient_list=eids),
+    ...         dl.get_gp_clinical_data(patient_list=eids),
+    ...     )
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import inspect
+import logging
+import threading
+from typing import List, Set, Tuple
+
+from ukbb_loaders.loaders.load import DataLoader
+from ukbb_loaders.utilities.filesystem import async_s3_filesystem, fetching_with, is_s3
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# The DataLoader methods awaitable on an AsyncDataLoader
+ASYNC_METHODS = [
+    "get_hospital_data",
+    "get_death_data",
+    "get_gp_clinical_data",
+    "get_gp_medication_data",
+    "get_gp_measurement_data",
+    "get_first_occurrence_data",
+    "get_batch",
+    "patients_with",
+]
+
+
+class AsyncDataLoader:
+    def __init__(self, data_dir: str, compact: bool = False, max_workers: int = 4):
+        """
+        A DataLoader whose getters are awaitable and never block the event loop.
+
+        The byte ranges of s3 files are fetched on the event loop with the asynchronous s3
+        filesystem, and decoding runs on a pool of `max_workers` threads, whatever the number of
+        concurrent queries: queries beyond it wait on the event loop for a thread. Cancelling a
+        query drops it if it has not started, and otherwise stops it at its next fetch.
+
+        The manifest is loaded when the loader is created, which blocks, so create it when the
+        service starts.
+
+        Args:
+            data_dir (str): The local or s3 path of the final directory.
+            compact (bool): Whether to return compact dataframes, see DataLoader.
+            max_workers (int): The number of queries decoded at the same time.
+        """
+        self.loader = DataLoader(data_dir, compact=compact)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ukbb_decode")
+        self._s3 = None
+        self._s3_session = None
+
+    async def __aenter__(self) -> "AsyncDataLoader":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """
+        Closes the s3 session and waits for the running queries to finish.
+        """
+        if self._s3_session is not None:
+            await self._s3_session.close()
+            self._s3, self._s3_session = None, None
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+
+    async def _run(self, method: str, args: tuple, kwargs: dict):
+        loop = asyncio.get_running_loop()
+        query = _Query(self, loop) if is_s3(self.loader.data_path) else None
+        call = functools.partial(_call, query, getattr(self.loader, method), args, kwargs)
+        # The context is copied so that a trace started by the caller records the query
+        future = loop.run_in_executor(self._executor, contextvars.copy_context().run, call)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if query is not None:
+                query.cancel()
+            raise
+
+    async def _fetch(self, path: str, parts: List[Tuple[int, int]]) -> List[bytes]:
+        if self._s3 is None:
+            self._s3 = async_s3_filesystem(asyncio.get_running_loop())
+            self._s3_session = await self._s3.set_session()
+        return await asyncio.gather(*(self._s3._cat_file(path, start=start, end=end) for start, end in parts))
+
+
+class _Query:
+    def __init__(self, loader: AsyncDataLoader, loop: asyncio.AbstractEventLoop):
+        """
+        The fetches of one query, run on the event loop and cancelled together with the query.
+        """
+        self.loader = loader
+        self.loop = loop
+        self.cancelled = False
+        self._futures: Set[concurrent.futures.Future] = set()
+        self._lock = threading.Lock()
+
+    def fetch(self, path: str, parts: List[Tuple[int, int]]) -> List[bytes]:
+        with self._lock:
+            if self.cancelled:
+                raise concurrent.futures.CancelledError()
+            future = asyncio.run_coroutine_threadsafe(self.loader._fetch(path, parts), self.loop)
+            self._futures.add(future)
+        try:
+            return future.result()
+        finally:
+            with self._lock:
+                self._futures.discard(future)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for future in self._futures:
+                future.cancel()
+
+
+def _call(query: _Query, method, args: tuple, kwargs: dict):
+    with fetching_with(None if query is None else query.fetch):
+        return method(*args, **kwargs)
+
+
+def _async(method: str):
+    signature = inspect.signature(getattr(DataLoader, method))
+
+    async def call(self, *args, **kwargs):
+        signature.bind(self, *args, **kwargs)
+        return await self._run(method, args, kwargs)
+
+    call.__name__ = method
+    call.__doc__ = getattr(DataLoader, method).__doc__
+    call.__signature__ = signature
+    return call
+
+
+for _method in ASYNC_METHODS:
+    setattr(AsyncDataLoader, _method, _async(_method))
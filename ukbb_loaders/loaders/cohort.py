@@ -0,0 +1,397 @@
+"""
+Bitmap-indexed cohort queries over coded events.
+"""
+import logging
+import re
+from collections import OrderedDict
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from ukbb_loaders.loaders.load import DataLoader
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# The DataLoader sources indexed by default, read from the code indexes of their tables
+SOURCES = ["icd9", "icd10", "opcs3", "opcs4", "read_2", "read_3", "medication", "death"]
+# The number of code bitmaps kept across queries, the least recently used being evicted first
+CACHE_SIZE = 256
+_NO_FIRST_DAY = np.iinfo(np.int32).max
+_NO_LAST_DAY = np.iinfo(np.int32).min
+
+
+class Expression:
+    """
+    Base class of cohort expressions, which combine with `&`, `|` and `~`.
+    """
+
+    def __and__(self, other: "Expression") -> "Expression":
+        return And(self, other)
+
+    def __or__(self, other: "Expression") -> "Expression":
+        return Or(self, other)
+
+    def __invert__(self) -> "Expression":
+        return Not(self)
+
+
+class Code(Expression):
+    def __init__(self, source: str, pattern: str, before: str = None, after: str = None):
+        """
+        Patients with at least one matching code in a source.
+
+        Args:
+            source (str): The source the code is recorded in, e.g. icd10 or read_2.
+            pattern (str): The code to match. A trailing `*` matches every code with that prefix,
+                and `*` alone matches every code in the source.
+            before (str): Only match patients whose first matching event is before this date.
+            after (str): Only match patients whose last matching event is after this date.
+        """
+        self.source = source
+        self.pattern = pattern
+        self.before = before
+        self.after = after
+
+    def key(self) -> tuple:
+        return self.source, self.pattern, self.before, self.after
+
+    def __repr__(self) -> str:
+        return f"Code({', '.join(repr(k) for k in self.key() if k is not None)})"
+
+
+class And(Expression):
+    def __init__(self, *operands: Expression):
+        self.operands = operands
+
+
+class Or(Expression):
+    def __init__(self, *operands: Expression):
+        self.operands = operands
+
+
+class Not(Expression):
+    def __init__(self, operand: Expression):
+        self.operand = operand
+
+
+class _SourceIndex:
+    """
+    Per-source index of the patients having each code.
+
+    Codes are sorted so a prefix is a contiguous range of codes, and the patient positions of each
+    code are stored CSR-style, so a prefix resolves to one contiguous slice of `positions`.
+    Codes held by many patients additionally get a precomputed packed bitmap, whichever of the two
+    representations is smaller, as in roaring bitmaps.
+    """
+
+    def __init__(self, codes, offsets, positions, first_days, last_days, n_bits: int):
+        self.codes = codes
+        self.offsets = offsets
+        self.positions = positions
+        self.first_days = first_days
+        self.last_days = last_days
+        self.n_bits = n_bits
+        sizes = np.diff(offsets)
+        self.dense = {
+            int(i): _pack(positions[offsets[i]: offsets[i + 1]], n_bits)
+            for i in np.flatnonzero(sizes * positions.itemsize * 8 > n_bits)
+        }
+
+    def code_range(self, pattern: str) -> slice:
+        if pattern == "*":
+            return slice(0, len(self.codes))
+        if pattern.endswith("*"):
+            prefix = pattern[:-1]
+            start = np.searchsorted(self.codes, prefix, side="left")
+            stop = np.searchsorted(self.codes, prefix + "\U0010ffff", side="left")
+            return slice(start, stop)
+        start = np.searchsorted(self.codes, pattern, side="left")
+        stop = start + int(start < len(self.codes) and self.codes[start] == pattern)
+        return slice(start, stop)
+
+    def bitmap(self, code: Code) -> np.ndarray:
+        codes = self.code_range(code.pattern)
+        entries = slice(self.offsets[codes.start], self.offsets[codes.stop])
+        if code.before is None and code.after is None:
+            dense = [self.dense[i] for i in range(codes.start, codes.stop) if i in self.dense]
+            if len(dense) == codes.stop - codes.start and dense:
+                return np.bitwise_or.reduce(dense)
+            mask = np.zeros(self.n_bits, dtype=bool)
+            mask[self.positions[entries]] = True
+            return np.packbits(mask)
+
+        keep = np.ones(entries.stop - entries.start, dtype=bool)
+        if code.before is not None:
+            keep &= self.first_days[entries] < _to_day(code.before)
+        if code.after is not None:
+            keep &= self.last_days[entries] > _to_day(code.after)
+        mask = np.zeros(self.n_bits, dtype=bool)
+        mask[self.positions[entries][keep]] = True
+        return np.packbits(mask)
+
+
+class CohortIndex:
+    def __init__(self, universe: Iterable[int], cache_size: int = CACHE_SIZE):
+        """
+        Bitmap index resolving boolean cohort definitions over coded events.
+
+        Every patient is a bit in a packed bitmap, so AND/OR/NOT are evaluated as bitwise
+        operations over a few tens of kilobytes, and code bitmaps are cached across queries.
+
+        Args:
+            universe (np.ndarray): All patients a cohort can be drawn from. NOT is evaluated
+                relative to this set of patients.
+            cache_size (int): The number of code bitmaps to cache, the least recently used being
+                evicted first.
+        """
+        self.universe = np.unique(np.asarray(universe))
+        self.n_bits = len(self.universe)
+        self.sources: Dict[str, _SourceIndex] = {}
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+        self._date_loaders: Dict[str, Callable[[], pd.DataFrame]] = {}
+        self._all = np.packbits(np.ones(self.n_bits, dtype=bool))
+
+    @classmethod
+    def from_loader(
+            cls,
+            data_loader: DataLoader,
+            sources: List[str] = None,
+            universe: Iterable[int] = None,
+            cache_size: int = CACHE_SIZE,
+    ) -> "CohortIndex":
+        """
+        Builds a cohort index from the code indexes of the source tables, reading only their
+        feature and eid columns. The dates of a source are read the first time a query of that
+        source is bounded by dates.
+
+        Args:
+            data_loader (DataLoader): The loader to fetch the sources from.
+            sources (list): The sources to index, any of SOURCES. Defaults to all of them.
+            universe (np.ndarray): All patients a cohort can be drawn from. Defaults to the patients
+                found in the indexed sources.
+            cache_size (int): The number of code bitmaps to cache.
+        Returns:
+            (CohortIndex): The cohort index over the requested sources.
+        """
+        if sources is None:
+            sources = SOURCES
+        for source in sources:
+            if source not in SOURCES:
+                raise ValueError(f"The source argument should be one of {SOURCES}")
+
+        frames = {}
+        for source in sources:
+            logger.info(f"Loading the code index of {source} for the cohort index.")
+            frames[source] = data_loader.get_code_index(source)
+        if universe is None:
+            universe = np.concatenate([df["eid"].to_numpy() for df in frames.values()])
+
+        index = cls(universe, cache_size=cache_size)
+        for source, df in frames.items():
+            index.add_source(
+                source,
+                df["eid"].to_numpy(),
+                df["feature"].to_numpy(),
+                load_dates=partial(data_loader.get_code_index, source, dates=True),
+            )
+        return index
+
+    def add_source(
+            self,
+            source: str,
+            eids: np.ndarray,
+            features: np.ndarray,
+            dates: np.ndarray = None,
+            load_dates: Callable[[], pd.DataFrame] = None,
+    ):
+        """
+        Indexes the codes of one source.
+
+        Args:
+            source (str): The name the source will be queried by.
+            eids (np.ndarray): The patient of each event.
+            features (np.ndarray): The code of each event.
+            dates (np.ndarray): The date of each event, if any.
+            load_dates (callable): If `dates` is not given, a function returning the eid, feature
+                and date of every event as a dataframe. It is called to index the source again the
+                first time a query of the source is bounded by dates.
+        """
+        self._date_loaders.pop(source, None)
+        if dates is None and load_dates is not None:
+            self._date_loaders[source] = load_dates
+
+        eids = np.asarray(eids)
+        positions = np.searchsorted(self.universe, eids)
+        in_universe = positions < self.n_bits
+        in_universe[in_universe] = self.universe[positions[in_universe]] == eids[in_universe]
+        if dates is None:
+            days = np.full(len(eids), np.iinfo(np.int64).min)
+        else:
+            days = np.asarray(dates).astype("datetime64[D]").astype(np.int64)
+        features = pd.Series(features).astype(str).to_numpy()
+        positions, features, days = positions[in_universe], features[in_universe], days[in_universe]
+
+        # One entry per (code, patient) keeping its first and last event day
+        feature_codes, codes = pd.factorize(features, sort=True)
+        order = np.lexsort((positions, feature_codes))
+        feature_codes, positions, days = feature_codes[order], positions[order], days[order]
+        new_entry = np.ones(len(positions), dtype=bool)
+        new_entry[1:] = (feature_codes[1:] != feature_codes[:-1]) | (positions[1:] != positions[:-1])
+        starts = np.flatnonzero(new_entry)
+        dated = days != np.iinfo(np.int64).min
+        first_days = np.where(dated, days, _NO_FIRST_DAY)
+        last_days = np.where(dated, days, _NO_LAST_DAY)
+        if len(starts):
+            first_days = np.minimum.reduceat(first_days, starts)
+            last_days = np.maximum.reduceat(last_days, starts)
+        offsets = np.searchsorted(feature_codes[starts], np.arange(len(codes) + 1))
+
+        self.sources[source] = _SourceIndex(
+            codes=np.asarray(codes, dtype=object),
+            offsets=offsets,
+            positions=positions[starts].astype(np.int32),
+            first_days=first_days.astype(np.int32),
+            last_days=last_days.astype(np.int32),
+            n_bits=self.n_bits,
+        )
+        for key in [key for key in self._cache if key[0] == source]:
+            del self._cache[key]
+
+    def bitmap(self, expression: Union[str, Expression]) -> np.ndarray:
+        """
+        Evaluates a cohort expression into a packed bitmap over the universe.
+        """
+        if isinstance(expression, str):
+            expression = parse(expression)
+        if isinstance(expression, Code):
+            key = expression.key()
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            if expression.source not in self.sources:
+                raise ValueError(f"The source argument should be one of {list(self.sources)}")
+            dated = expression.before is not None or expression.after is not None
+            if dated and expression.source in self._date_loaders:
+                logger.info(f"Loading the dates of {expression.source} for the cohort index.")
+                df = self._date_loaders[expression.source]()
+                self.add_source(
+                    expression.source, df["eid"].to_numpy(), df["feature"].to_numpy(), df["date"].to_numpy()
+                )
+            bits = self.sources[expression.source].bitmap(expression)
+            self._cache[key] = bits
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return bits
+        if isinstance(expression, And):
+            return np.bitwise_and.reduce([self.bitmap(operand) for operand in expression.operands])
+        if isinstance(expression, Or):
+            return np.bitwise_or.reduce([self.bitmap(operand) for operand in expression.operands])
+        if isinstance(expression, Not):
+            return self._all & ~self.bitmap(expression.operand)
+        raise TypeError(f"Unsupported cohort expression {expression!r}")
+
+    def query(self, expression: Union[str, Expression]) -> np.ndarray:
+        """
+        Returns the patients matching a cohort expression.
+
+        Args:
+            expression (str or Expression): The cohort definition, either built from Code objects
+                or as a string understood by `parse`.
+        Returns:
+            (np.ndarray): The sorted eids of the patients in the cohort.
+
+        Example:
+            Patients with type 2 diabetes in hospital or hypothyroidism in GP records, and who did
+            not die before 2010:
+            >>> index.query("(icd10:E11* | read_2:C10..) & ~death:*<2010-01-01")
+        """
+        bits = np.unpackbits(self.bitmap(expression), count=self.n_bits).astype(bool)
+        return self.universe[bits]
+
+    def count(self, expression: Union[str, Expression]) -> int:
+        """
+        Returns the number of patients matching a cohort expression.
+        """
+        return int(np.unpackbits(self.bitmap(expression), count=self.n_bits).sum())
+
+
+_TOKEN = re.compile(r"\s*(\(|\)|&|\||~|[^\s()&|~]+)")
+_TERM = re.compile(r"^(?P<source>[^:]+):(?P<pattern>[^<>]+)(?:(?P<op>[<>])(?P<date>.+))?$")
+
+
+def parse(definition: str) -> Expression:
+    """
+    Parses a cohort definition string into an expression.
+
+    Terms are written as `source:code`, where a trailing `*` matches a code prefix, and may be
+    restricted to events before or after a date with `<date` or `>date`. Terms combine with
+    `&`/`AND`, `|`/`OR`, `~`/`NOT` and parentheses, with NOT binding tightest and OR loosest.
+
+    Args:
+        definition (str): The cohort definition, e.g. "icd10:E11* | read_2:C10.. & ~death:*<2010-01-01".
+    Returns:
+        (Expression): The parsed cohort expression.
+    """
+    tokens = _TOKEN.findall(definition)
+    tokens = [{"AND": "&", "OR": "|", "NOT": "~"}.get(token.upper(), token) for token in tokens]
+    position = 0
+
+    def peek() -> Optional[str]:
+        return tokens[position] if position < len(tokens) else None
+
+    def take() -> str:
+        nonlocal position
+        if position >= len(tokens):
+            raise ValueError(f"Unexpected end of cohort definition: {definition}")
+        position += 1
+        return tokens[position - 1]
+
+    def parse_or() -> Expression:
+        operands = [parse_and()]
+        while peek() == "|":
+            take()
+            operands.append(parse_and())
+        return operands[0] if len(operands) == 1 else Or(*operands)
+
+    def parse_and() -> Expression:
+        operands = [parse_not()]
+        while peek() == "&":
+            take()
+            operands.append(parse_not())
+        return operands[0] if len(operands) == 1 else And(*operands)
+
+    def parse_not() -> Expression:
+        if peek() == "~":
+            take()
+            return Not(parse_not())
+        token = take()
+        if token == "(":
+            expression = parse_or()
+            if take() != ")":
+                raise ValueError(f"Unbalanced parentheses in cohort definition: {definition}")
+            return expression
+        match = _TERM.match(token)
+        if match is None:
+            raise ValueError(f"Invalid term {token} in cohort definition: {definition}")
+        before = match["date"] if match["op"] == "<" else None
+        after = match["date"] if match["op"] == ">" else None
+        return Code(match["source"], match["pattern"], before=before, after=after)
+
+    expression = parse_or()
+    if position != len(tokens):
+        raise ValueError(f"Unexpected {tokens[position]} in cohort definition: {definition}")
+    return expression
+
+
+def _pack(positions: np.ndarray, n_bits: int) -> np.ndarray:
+    mask = np.zeros(n_bits, dtype=bool)
+    mask[positions] = True
+    return np.packbits(mask)
+
+
+def _to_day(date: str) -> int:
+    return int(np.datetime64(pd.Timestamp(date).date(), "D").astype(np.int64))
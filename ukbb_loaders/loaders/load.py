@@ -2,22 +2,47 @@
 Loaders for versioned UKBB data.
 """
 import logging
-import os
+from contextlib import contextmanager
 from os.path import join as pjoin
-from typing import List, Union
+from typing import Dict, List, Tuple, Union
 
 import numpy as np
 import pandas as pd
-from s3fs import S3FileSystem
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas.api.types import union_categoricals
+
+from ukbb_loaders.utilities.filesystem import (
+    RangeFile,
+    filter_table,
+    get_filesystem,
+    is_nonempty_dir,
+    is_s3,
+    open_parquet,
+    read_parquet,
+    read_table,
+    to_pandas,
+)
+from ukbb_loaders.utilities.manifest import Manifest
+from ukbb_loaders.utilities.tombstones import Tombstones
+from ukbb_loaders.utilities.tracing import Trace, span
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Suffix of the inverted code index written next to each final table by ukbb_parser
+CODE_INDEX_SUFFIX = ".code_index.parquet"
+# The levels of the causes of death, with their value in the level column of death_icd10
+DEATH_LEVELS = {"primary": 1, "secondary": 2}
+# The death tables of each level written by older versions of ukbb_parser, read when death_icd10 is missing
+LEGACY_DEATH_TABLES = {level: f"death_icd10_{level}.parquet" for level in DEATH_LEVELS}
+
 
 class DataLoader:
     def __init__(
             self,
             data_dir: str,
+            compact: bool = False,
     ):
         """
         Class for loading UKBB data.
@@ -25,8 +50,20 @@ class DataLoader:
             data_dir (str): The path to the directory containing the processed data.
             Note that on Windows the path must have forward-slashes,
             e.g.  "C:/Users/john/Documents/data_dir"
+            compact (bool): Whether to return compact dataframes, with int32 eids (from pandas 2,
+                whose indexes can be int32), `feature` and `source` as categoricals shared across the
+                concatenated sources, and `value` as int8. This takes several times less memory
+                than the default dtypes.
+
+        The manifest written by update_data.py is loaded to check the format of the data, and its
+        table metadata is used to plan reads. Directories written without a manifest are checked
+        for being non-empty instead. Patients withdrawn since the tables were derived, recorded as
+        tombstones by withdraw.py, are dropped from every read.
         """
-        self.data_path = self._check_if_exists(data_dir=data_dir)
+        self.compact = compact
+        self._sql_connection = None
+        self.manifest = Manifest.load(data_dir)
+        self.data_path = data_dir if self.manifest is not None else self._check_if_exists(data_dir=data_dir)
         self.hospital_map = {
             "icd9": "ehr_diagnosis_icd9.parquet",
             "icd10": "ehr_diagnosis_icd10.parquet",
@@ -37,18 +74,32 @@ class DataLoader:
             "read_2": "ehr_diagnosis_read2.parquet",
             "read_3": "ehr_diagnosis_read3.parquet",
         }
+        self.first_occurrence_map = {
+            src: f"first_occurrence_{src}.parquet"
+            for src in ["icd9", "icd10", "opcs3", "opcs4", "read_2", "read_3", "medication", "death", "phecode", "mondo"]
+        }
+        self.source_map = {
+            **{src: [file_name] for src, file_name in self.hospital_map.items()},
+            **{src: [file_name] for src, file_name in self.gp_map.items()},
+            "medication": ["gp_medications.parquet"],
+            "measurement": ["gp_measurements.parquet"],
+            "death": ["death_icd10.parquet"],
+            "phecode": [self.first_occurrence_map["phecode"]],
+            "mondo": [self.first_occurrence_map["mondo"]],
+        }
+        if self.manifest is not None:
+            missing = self.manifest.missing(sorted({f for files in self.source_map.values() for f in files}))
+            if missing:
+                logger.warning(f"The following tables are missing from {data_dir}: {missing}")
+        self.tombstones = None
+        if self.manifest is not None and self.manifest.tombstones is not None:
+            self.tombstones = Tombstones.load(self.data_path)
 
     def _check_if_exists(self, data_dir: str) -> str:
         """
         Checks if the requested directory exists and returns it.
         """
-        if data_dir.startswith("s3://"):
-            s3_file = S3FileSystem()
-            files_in_version = s3_file.ls(data_dir)
-        else:
-            files_in_version = os.listdir(data_dir)
-
-        if not files_in_version:
+        if not is_nonempty_dir(data_dir):
             raise ValueError(
                 f"""{data_dir} seems to be empty. Check if the files are there of if you have permission access to 
                 {data_dir}."""
@@ -56,11 +107,92 @@ class DataLoader:
 
         return data_dir
 
+    def validate(self, checksums: bool = False):
+        """
+        Checks that every table listed in the manifest is present with the expected size.
+
+        Args:
+            checksums (bool): Whether to also read every table to compare its checksum.
+        """
+        if self.manifest is None:
+            raise ValueError(f"{self.data_path} has no manifest to validate against. Re-run update_data.py.")
+        problems = self.manifest.verify(self.data_path, checksums=checksums)
+        if problems:
+            raise ValueError(f"{self.data_path} does not match its manifest: {' '.join(problems)}")
+
+    def trace(self, callback=None) -> Trace:
+        """
+        Traces the queries run inside the returned context manager, with a span per phase: opening
+        files, bytes fetched, row groups scanned and skipped, decoding, conversion to pandas and
+        patient filtering. Tracing is off otherwise, at near zero cost.
+
+        Args:
+            callback (callable): Called with the record of every span as it finishes.
+        Returns:
+            (Trace): The trace, whose spans are available through `summary()` after the block.
+
+        Example:
+            >>> with dl.trace() as t:
+            ...     dl.get_hospital_data("icd10", patient_list=eids)
+            >>> t.summary()
+        """
+        return Trace(callback=callback)
+
+    def sql(self, query: str, params: list = None, arrow: bool = False) -> Union[pd.DataFrame, pa.Table]:
+        """
+        Runs a SQL query with DuckDB over views of every final table, named after its file, e.g.
+        ehr_diagnosis_icd10, and of every bundled lookup and mapper, e.g. lookup_ehr_diagnosis_icd10
+        and mapper_icd10_to_phecodes. Queries run multi-threaded directly on the parquet files.
+        DuckDB is an optional dependency: pip install ukbiobank_loaders[sql].
+
+        Args:
+            query (str): The query. Final tables have an eid column.
+            params (list): The values of the ? placeholders of the query.
+            arrow (bool): Whether to return an Arrow table rather than a pandas dataframe.
+        Returns:
+            (pd.DataFrame or pa.Table): The result of the query.
+
+        Example:
+            Patients by phecode, from their hospital ICD10 diagnoses:
+            >>> dl.sql(
+            ...     "SELECT m.phecode, count(DISTINCT d.eid) AS patients "
+            ...     "FROM ehr_diagnosis_icd10 d JOIN mapper_icd10_to_phecodes m ON d.feature = m.icd10_code "
+            ...     "GROUP BY m.phecode ORDER BY patients DESC"
+            ... )
+        """
+        if self._sql_connection is None:
+            from ukbb_loaders.utilities.sql import connect
+
+            self._sql_connection = connect(self.data_path)
+        # A cursor per query, as a DuckDB connection is not safe to share between threads
+        with span("sql") as s:
+            result = self._sql_connection.cursor().execute(query, params or [])
+            if arrow:
+                # Newer DuckDB versions renamed fetch_arrow_table to to_arrow_table
+                result = getattr(result, "to_arrow_table", None) or result.fetch_arrow_table
+                result = result()
+            else:
+                result = result.df()
+            s.set(rows=len(result))
+        return result
+
+    def _check_tables(self, file_names: List[str]):
+        """
+        Fails before reading anything if any of the tables is missing from the manifest.
+        """
+        if self.manifest is None:
+            return
+        missing = self.manifest.missing(file_names)
+        if missing:
+            raise FileNotFoundError(f"The following tables are missing from {self.data_path}: {missing}")
+
     def get_hospital_data(
             self,
             source: Union[str, List[str]],
             level=None,
             patient_list: np.ndarray = None,
+            codes: Union[str, List[str]] = None,
+            prefix: bool = False,
     ) -> pd.DataFrame:
         """
         Method that fetches hospital data for the UKBB population.
@@ -81,6 +213,9 @@ class DataLoader:
                 Defaults to all of them.
             patient_list (np.ndarray): The patients to fetch characteristics for. If this is empty,
                 all UKBB patients will be used.
+            codes (str or list): The codes to fetch. If given, only the rows holding these codes
+                are read, through the code index of each table. Defaults to all codes.
+            prefix (bool): Whether `codes` are code prefixes rather than exact codes.
         Returns:
             df (pd.DataFrame): A long canonical dataframe with patients as the index and the
             following columns:
@@ -99,16 +234,17 @@ class DataLoader:
         levels = [{"primary": 1, "secondary": 2, "external": 3}[lev] for lev in levels]
 
         # Reading data
-        df_list: List[pd.DataFrame] = []
-        for src in sources:
-            df = pd.read_parquet(pjoin(self.data_path, self.hospital_map[src]))
-            if (patient_list is not None) and (len(patient_list) > 0):
-                df = df.loc[df.index.isin(patient_list)]
-            df = df.loc[df["source"].isin(levels)]
-            df["source"] = src
-            df_list.append(df)
-        df = pd.concat(df_list).rename({"date": "date_of_visit"}, axis=1)
-        df["value"] = 1
+        self._check_tables([self.hospital_map[src] for src in sources])
+        with span("get_hospital_data", sources=sources) as s:
+            df_list: List[pd.DataFrame] = []
+            for src in sources:
+                df = self._read_table(self.hospital_map[src], patient_list=patient_list, codes=codes, prefix=prefix)
+                with span("filter_level", rows_before=len(df)) as f:
+                    df = self._keep(df, self._isin(df, "source", levels))
+                    f.set(rows_after=len(df))
+                df_list.append(self._assign_source(df, src, sources))
+            df = self._rename(self._concat(df_list), {"date": "date_of_visit"})
+            s.set(rows=len(df))
 
         return df
 
@@ -116,6 +252,8 @@ class DataLoader:
             self,
             level=None,
             patient_list: np.ndarray = None,
+            codes: Union[str, List[str]] = None,
+            prefix: bool = False,
     ) -> pd.DataFrame:
         """
         Method that fetches death information for the UKBB population.
@@ -125,30 +263,78 @@ class DataLoader:
                 It needs to be one or both of: primary (main reason of death), secondary. Defaults to both.
             patient_list (np.ndarray): The patients to fetch characteristics for.
                 If this is empty, all UKBB patients will be used.
+            codes (str or list): The ICD10 codes to fetch, read through the code index of each
+                table. Defaults to all codes.
+            prefix (bool): Whether `codes` are code prefixes rather than exact codes.
         Returns:
             df (pd.DataFrame): A long canonical dataframe with patients as the index and all
-                recorded death information including death date in the right format.
+                recorded death information including death date in the right format, sorted by
+                eid, with the level of each cause as its source.
+
+        Raises:
+            FileNotFoundError: If the directory has neither death_icd10.parquet nor the death
+                tables of each level written by older versions of ukbb_parser.
         """
         if level is None:
-            level = ["primary", "secondary"]
-        _check_arg(given=level, accepted=["primary", "secondary"], arg_type="level")
+            level = list(DEATH_LEVELS)
+        _check_arg(given=level, accepted=list(DEATH_LEVELS), arg_type="level")
         levels = _to_list_type(level)
 
+        self._check_tables(["death_icd10.parquet"])
+        with span("get_death_data", levels=levels) as s:
+            # Both levels are in the same table, so a single level is kept before conversion to pandas
+            filters = None
+            if set(levels) != set(DEATH_LEVELS):
+                filters = [("level", "in", [DEATH_LEVELS[level] for level in levels])]
+            try:
+                df = self._read_table(
+                    "death_icd10.parquet", patient_list=patient_list, codes=codes, prefix=prefix, filters=filters
+                )
+            except FileNotFoundError:
+                if self.manifest is not None:
+                    raise
+                df = self._read_legacy_death_tables(levels, patient_list=patient_list, codes=codes, prefix=prefix)
+            else:
+                with span("assign", rows=len(df)):
+                    positions = np.searchsorted(list(DEATH_LEVELS.values()), self._column(df, "level"))
+                    df = self._assign_codes(
+                        self._select(df, ["feature", "date"]),
+                        "source",
+                        positions.astype(np.int8),
+                        list(DEATH_LEVELS),
+                        categorical=self.compact,
+                    )
+                df = self._concat([df])
+            s.set(rows=len(df))
+
+        return self._rename(df, {"date": "date_of_death"})
+
+    def _read_legacy_death_tables(
+            self,
+            levels: List[str],
+            patient_list: np.ndarray = None,
+            codes: Union[str, List[str]] = None,
+            prefix: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Reads the death tables of each level of final directories derived before death_icd10.
+        """
         df_list: List[pd.DataFrame] = []
         for level in levels:
-            df = pd.read_parquet(pjoin(self.data_path, f"death_icd10_{level}.parquet"))
-            if (patient_list is not None) and (len(patient_list) > 0):
-                df = df.loc[df.index.isin(patient_list)]
-            df["source"] = level
-            df_list.append(df)
-        df = pd.concat(df_list)
-        df["value"] = 1
-
-        return df.rename({"date": "date_of_death"}, axis=1)
+            try:
+                df = self._read_table(LEGACY_DEATH_TABLES[level], patient_list=patient_list, codes=codes, prefix=prefix)
+            except FileNotFoundError:
+                raise FileNotFoundError(
+                    f"{self.data_path} has no death_icd10.parquet. Re-run derive_death.py to derive it."
+                )
+            df_list.append(self._assign_source(df, level, levels))
+        return self._concat(df_list)
 
     def get_gp_clinical_data(
             self, source=None,
-            patient_list: np.ndarray = None
+            patient_list: np.ndarray = None,
+            codes: Union[str, List[str]] = None,
+            prefix: bool = False,
     ):
         """
         Method that fetches GP diagnosis information for the UKBB population.
@@ -157,6 +343,9 @@ class DataLoader:
             source (str or list): Whether to load read_2, read_3 or both. Defaults to both.
             patient_list (np.ndarray): The patients to fetch characteristics for.
                 If this is empty, all UKBB patients will be used.
+            codes (str or list): The read codes to fetch, read through the code index of each
+                table. Defaults to all codes.
+            prefix (bool): Whether `codes` are code prefixes rather than exact codes.
         Returns:
             df (pd.DataFrame): A long canonical dataframe with patients as the index and all
                 recorded gp information including date in the right format.
@@ -167,35 +356,546 @@ class DataLoader:
         _check_arg(given=source, accepted=self.gp_map, arg_type="source")
         sources = _to_list_type(source)
 
-        df_list: List[pd.DataFrame] = []
-        for src in sources:
-            df = pd.read_parquet(pjoin(self.data_path, self.gp_map[src]))
-            if (patient_list is not None) and (len(patient_list) > 0):
-                df = df.loc[df.index.isin(patient_list)]
-            df["source"] = src
-            df_list.append(df)
-        df = pd.concat(df_list)
-        df["value"] = 1
+        self._check_tables([self.gp_map[src] for src in sources])
+        with span("get_gp_clinical_data", sources=sources) as s:
+            df_list: List[pd.DataFrame] = []
+            for src in sources:
+                df = self._read_table(self.gp_map[src], patient_list=patient_list, codes=codes, prefix=prefix)
+                df_list.append(self._assign_source(df, src, sources))
+            df = self._concat(df_list)
+            s.set(rows=len(df))
 
-        return df.rename({"date": "date_of_visit"}, axis=1)
+        return self._rename(df, {"date": "date_of_visit"})
 
-    def get_gp_medication_data(self, patient_list: np.ndarray = None) -> pd.DataFrame:
+    def get_gp_medication_data(
+            self,
+            patient_list: np.ndarray = None,
+            codes: Union[str, List[str]] = None,
+            prefix: bool = False,
+    ) -> pd.DataFrame:
         """
         Method that fetches GP medication data for the UKBB population.
 
         Args:
             patient_list (np.ndarray): The patients to fetch medication data for.
                 If this is empty, all UKBB patients will be used.
+            codes (str or list): The medications to fetch, read through the code index of the
+                table. Defaults to all medications.
+            prefix (bool): Whether `codes` are name prefixes rather than exact names.
         Returns:
             df (pd.DataFrame): A canonical long dataframe with patients as the index and
                 features as columns.
         """
-        df = pd.read_parquet(pjoin(self.data_path, "gp_medications.parquet"))
-        if (patient_list is not None) and (len(patient_list) > 0):
-            df = df.loc[df.index.isin(patient_list)]
-        df = df.rename({"date": "date_of_issue"}, axis=1)
+        self._check_tables(["gp_medications.parquet"])
+        with span("get_gp_medication_data") as s:
+            df = self._read_table("gp_medications.parquet", patient_list=patient_list, codes=codes, prefix=prefix)
+            df = self._rename(df, {"date": "date_of_issue"})
+            s.set(rows=len(df))
+        return df
+
+    def get_gp_measurement_data(
+            self,
+            source: Union[str, List[str]] = None,
+            patient_list: np.ndarray = None,
+            codes: Union[str, List[str]] = None,
+            prefix: bool = False,
+            start_date: Union[str, pd.Timestamp] = None,
+            end_date: Union[str, pd.Timestamp] = None,
+    ) -> pd.DataFrame:
+        """
+        Method that fetches the numeric values recorded in GP records, such as blood pressures,
+        BMI or HbA1c, for the UKBB population.
+
+        Args:
+            source (str or list): Whether to load the measurements of read_2 codes, read_3 codes
+                or both. Defaults to both.
+            patient_list (np.ndarray): The patients to fetch measurements for.
+                If this is empty, all UKBB patients will be used.
+            codes (str or list): The read codes to fetch, read through the code index of the
+                table. Defaults to all codes.
+            prefix (bool): Whether `codes` are code prefixes rather than exact codes.
+            start_date (str or pd.Timestamp): The earliest date of measurement to keep, inclusive.
+            end_date (str or pd.Timestamp): The latest date of measurement to keep, inclusive.
+        Returns:
+            df (pd.DataFrame): A long dataframe with patients as the index and one row per value,
+            with the following columns:
+                - date_of_measurement: the date of the record
+                - feature: the read code of the record, read_2 if given and read_3 otherwise
+                - source: the coding of the read code, read_2 or read_3
+                - value: the value, as a float32
+                - slot: the gp_clinical value column holding the value, from 1 to 3
+
+        Example:
+            The HbA1c measurements of 2015 (read_2 code 42W5.):
+            >>> dl.get_gp_measurement_data("read_2", codes="42W5.", start_date="2015-01-01", end_date="2015-12-31")
+        """
+        if source is None:
+            source = ["read_2", "read_3"]
+        _check_arg(given=source, accepted=self.gp_map, arg_type="source")
+        sources = _to_list_type(source)
+
+        self._check_tables(["gp_measurements.parquet"])
+        with span("get_gp_measurement_data", sources=sources) as s:
+            df = self._read_table("gp_measurements.parquet", patient_list=patient_list, codes=codes, prefix=prefix)
+            if len(sources) < len(self.gp_map):
+                df = self._keep(df, self._isin(df, "source", sources))
+            if (start_date is not None) or (end_date is not None):
+                with span("filter_dates", rows_before=len(df)) as f:
+                    dates = self._column(df, "date")
+                    keep = np.ones(len(df), dtype=bool)
+                    if start_date is not None:
+                        keep &= dates >= np.datetime64(pd.Timestamp(start_date))
+                    if end_date is not None:
+                        keep &= dates <= np.datetime64(pd.Timestamp(end_date))
+                    df = self._keep(df, keep)
+                    f.set(rows_after=len(df))
+            df = self._rename(df, {"date": "date_of_measurement"})
+            s.set(rows=len(df))
+        return df
+
+    def get_first_occurrence_data(
+            self,
+            source: Union[str, List[str]],
+            patient_list: np.ndarray = None,
+            codes: Union[str, List[str]] = None,
+            prefix: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Method that fetches the first occurrence of every code for the UKBB population, precomputed
+        by update_data.py.
+
+        Args:
+            source (str or list): The sources to fetch, one or more of the keys of
+                `first_occurrence_map`: icd9, icd10, opcs3, opcs4, read_2, read_3, medication and
+                death, or phecode and mondo, mapped from the hospital and death ICD10 codes.
+            patient_list (np.ndarray): The patients to fetch first occurrences for.
+                If this is empty, all UKBB patients will be used.
+            codes (str or list): The codes to fetch, read through the code index of each table.
+                Defaults to all codes.
+            prefix (bool): Whether `codes` are code prefixes rather than exact codes.
+        Returns:
+            df (pd.DataFrame): A long canonical dataframe with patients as the index and one row
+            per patient and code, with the following columns:
+                - feature: the code
+                - date_of_first_occurrence: the earliest date the code was recorded, missing if
+                  none of its records has a date
+                - count: the number of times the code was recorded
+                - source: the source of the code (e.g. phecode)
+                - value: the occurrence value for each row combination (initially 1.)
+
+        Example:
+            The first time every patient was diagnosed with type 2 diabetes, as phecodes, which
+            are stored with the PHECODE_ prefix of the icd10_to_phecodes mapper:
+            >>> dl.get_first_occurrence_data("phecode", codes="PHECODE_250.2", prefix=True)
+        """
+        _check_arg(given=source, accepted=self.first_occurrence_map, arg_type="source")
+        sources = _to_list_type(source)
+
+        self._check_tables([self.first_occurrence_map[src] for src in sources])
+        with span("get_first_occurrence_data", sources=sources) as s:
+            df_list: List[pd.DataFrame] = []
+            for src in sources:
+                df = self._read_table(
+                    self.first_occurrence_map[src], patient_list=patient_list, codes=codes, prefix=prefix
+                )
+                df_list.append(self._assign_source(df, src, sources))
+            df = self._concat(df_list)
+            s.set(rows=len(df))
+
+        return self._rename(df, {"date": "date_of_first_occurrence"})
+
+    def get_batch(
+            self,
+            getter: str,
+            cohorts: Dict[str, np.ndarray],
+            combine: bool = False,
+            **kwargs,
+    ) -> Union[Dict[str, pd.DataFrame], pd.DataFrame]:
+        """
+        Method that fetches data for many cohorts with a single scan of each table.
+
+        The getter runs once for the union of the cohorts, and every row is routed to each cohort
+        holding its patient by a single vectorised eid to cohort lookup.
+
+        Args:
+            getter (str): The getter to run, one of get_hospital_data, get_death_data,
+                get_gp_clinical_data, get_gp_medication_data, get_gp_measurement_data and
+                get_first_occurrence_data.
+            cohorts (dict): The patient list of every cohort, by cohort name. Cohorts may overlap.
+            combine (bool): Whether to return a single dataframe with a `cohort` column rather than
+                a dataframe per cohort. Rows of patients in several cohorts are repeated.
+            **kwargs: The other arguments of the getter, e.g. the source or codes.
+        Returns:
+            (dict or pd.DataFrame): The result of the getter for every cohort, by cohort name, or
+                their concatenation with a categorical `cohort` column.
+
+        Example:
+            >>> dl.get_batch("get_hospital_data", {"cases": case_eids, "controls": control_eids}, source="icd10")
+            {'cases': ..., 'controls': ...}
+        """
+        getters = [
+            "get_hospital_data",
+            "get_death_data",
+            "get_gp_clinical_data",
+            "get_gp_medication_data",
+            "get_gp_measurement_data",
+            "get_first_occurrence_data",
+        ]
+        _check_arg(given=getter, accepted=getters, arg_type="getter")
+        if "patient_list" in kwargs:
+            raise ValueError("The patient_list argument is given by the cohorts of get_batch.")
+        names = list(cohorts)
+        members = [np.unique(np.asarray(cohorts[name], dtype=np.int64)) for name in names]
+        patients = np.unique(np.concatenate(members)) if members else np.array([], dtype=np.int64)
+
+        with span("get_batch", getter=getter, cohorts=len(names), patients=len(patients)) as s:
+            if len(patients):
+                df = getattr(self, getter)(patient_list=patients, **kwargs)
+            else:
+                # An empty patient list means all patients to the getters, so without any patient
+                # the getter is asked for no code instead, which reads no row but gives its columns
+                df = getattr(self, getter)(**{**kwargs, "codes": []})
+            with span("route", rows_before=len(df)) as r:
+                rows, cohort_ids = _route(self._eids(df), members)
+                r.set(rows_after=len(rows))
+            s.set(rows=len(rows))
+
+        if combine:
+            return self._assign_codes(self._take(df, rows), "cohort", cohort_ids, names, categorical=True)
+        order = np.argsort(cohort_ids, kind="stable")
+        bounds = np.cumsum(np.bincount(cohort_ids, minlength=len(names)))[:-1]
+        return {name: self._take(df, rows[chunk]) for name, chunk in zip(names, np.split(order, bounds))}
+
+    def patients_with(
+            self,
+            source: str,
+            codes: Union[str, List[str]],
+            prefix: bool = False,
+    ) -> np.ndarray:
+        """
+        Method that finds the patients who ever had any of the given codes.
+
+        Args:
+            source (str): The source to search, one of the keys of `source_map`, e.g. icd10,
+                read_2, medication or death.
+            codes (str or list): The codes to search for.
+            prefix (bool): Whether `codes` are code prefixes rather than exact codes.
+        Returns:
+            (np.ndarray): The sorted eids of the patients with at least one of the codes.
+
+        Example:
+            Patients with any chronic kidney disease diagnosis in hospital records:
+            >>> dl.patients_with("icd10", "N18", prefix=True)
+        """
+        _check_arg(given=source, accepted=self.source_map, arg_type="source")
+        self._check_tables(self.source_map[source])
+        eids = [
+            self._read_code_index(file_name, codes=codes, prefix=prefix)["eid"].to_numpy()
+            for file_name in self.source_map[source]
+        ]
+        return np.unique(np.concatenate(eids))
+
+    def get_code_index(self, source: str, dates: bool = False) -> pd.DataFrame:
+        """
+        Method that reads the (code, patient) entries of a source from the code indexes of its
+        tables, without reading the tables themselves.
+
+        Args:
+            source (str): The source to read, one of the keys of `source_map`.
+            dates (bool): Whether to also read the date of every entry, which only reads the date
+                column of the tables.
+        Returns:
+            (pd.DataFrame): The feature and eid of every entry, and its date if `dates`.
+        """
+        _check_arg(given=source, accepted=self.source_map, arg_type="source")
+        self._check_tables(self.source_map[source])
+        columns = ["feature", "eid", "row"] if dates else ["feature", "eid"]
+        with span("get_code_index", source=source, dates=dates) as s:
+            df_list: List[pd.DataFrame] = []
+            for file_name in self.source_map[source]:
+                df = self._read_code_index_entries(file_name, columns=columns)
+                if dates:
+                    size, metadata = self._table_metadata(file_name)
+                    with self._check_manifest(file_name):
+                        table = read_table(
+                            pjoin(self.data_path, file_name), columns=["date"], size=size, metadata=metadata
+                        )
+                    table_dates = to_pandas(table)["date"].to_numpy()
+                    df = df[["feature", "eid"]].assign(date=table_dates[df["row"].to_numpy()])
+                if self.tombstones is not None:
+                    df = df.loc[~self.tombstones.withdrawn(df["eid"].to_numpy())]
+                df_list.append(df)
+            df = pd.concat(df_list, ignore_index=True)
+            s.set(rows=len(df))
         return df
 
+    def _assign_source(self, df: pd.DataFrame, source: str, sources: List[str]) -> pd.DataFrame:
+        """
+        Sets the source column of the rows read from one source, as a categorical of all the
+        requested sources in compact mode. The rows are often a filtered slice of a table, so a
+        new dataframe is returned rather than the slice being written to.
+        """
+        with span("assign", rows=len(df)):
+            codes = np.full(len(df), sources.index(source), dtype=np.int8)
+            return self._assign_codes(df, "source", codes, sources, categorical=self.compact)
+
+    def _concat(self, df_list: List[pd.DataFrame]) -> pd.DataFrame:
+        """
+        Concatenates the rows read from each source and adds their occurrence value. In compact
+        mode, the feature categories are unified first so the concatenation stays categorical.
+        """
+        with span("concat", frames=len(df_list)):
+            if self.compact:
+                df_list = _unify_categories(df_list, column="feature")
+            df = pd.concat(df_list)
+        with span("assign", rows=len(df)):
+            df["value"] = np.ones(len(df), dtype=np.int8) if self.compact else 1
+        return df
+
+    def _read_table(
+            self,
+            file_name: str,
+            patient_list: np.ndarray = None,
+            codes: Union[str, List[str]] = None,
+            prefix: bool = False,
+            filters: List[Tuple[str, str, object]] = None,
+    ) -> pd.DataFrame:
+        """
+        Reads a final table, only reading the rows holding `codes` if given, and keeping the rows
+        meeting `filters` before converting them to pandas.
+        """
+        path = pjoin(self.data_path, file_name)
+        with span("read_table", file=file_name), self._check_manifest(file_name):
+            size, metadata = self._table_metadata(file_name)
+            if codes is None:
+                df = read_parquet(
+                    path,
+                    patient_list=patient_list,
+                    size=size,
+                    metadata=metadata,
+                    compact=self.compact,
+                    filters=filters,
+                )
+                df = self._drop_withdrawn(df)
+            else:
+                rows = self._read_code_index(file_name, codes=codes, prefix=prefix)["row"].to_numpy()
+                df = _read_rows(
+                    path, np.sort(rows), size=size, metadata=metadata, compact=self.compact, filters=filters
+                )
+            if (patient_list is not None) and (len(patient_list) > 0):
+                with span("filter_patients", rows_before=len(df)) as s:
+                    df = df.loc[df.index.isin(patient_list)]
+                    s.set(rows_after=len(df))
+        return df
+
+    def _drop_withdrawn(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Drops the rows of the patients withdrawn since the tables were derived.
+        """
+        if self.tombstones is None:
+            return df
+        with span("filter_withdrawn", rows_before=len(df)) as s:
+            df = self._keep(df, ~self.tombstones.withdrawn(self._eids(df)))
+            s.set(rows_after=len(df))
+        return df
+
+    # The getters only handle the rows read by _read_table through the methods below, so a
+    # subclass reading Arrow tables, such as the query server's, keeps them in Arrow throughout.
+
+    def _eids(self, df: pd.DataFrame) -> np.ndarray:
+        return df.index.to_numpy()
+
+    def _column(self, df: pd.DataFrame, column: str) -> np.ndarray:
+        return df[column].to_numpy()
+
+    def _isin(self, df: pd.DataFrame, column: str, values: list) -> np.ndarray:
+        return df[column].isin(values).to_numpy()
+
+    def _keep(self, df: pd.DataFrame, mask: np.ndarray) -> pd.DataFrame:
+        return df.loc[mask]
+
+    def _take(self, df: pd.DataFrame, rows: np.ndarray) -> pd.DataFrame:
+        return df.iloc[rows]
+
+    def _select(self, df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+        return df[columns]
+
+    def _rename(self, df: pd.DataFrame, columns: Dict[str, str]) -> pd.DataFrame:
+        return df.rename(columns, axis=1)
+
+    def _assign_codes(
+            self, df: pd.DataFrame, column: str, codes: np.ndarray, categories: List[str], categorical: bool
+    ) -> pd.DataFrame:
+        """
+        Sets a column to the categories at the given codes, as a categorical or as strings.
+        """
+        if categorical:
+            return df.assign(**{column: pd.Categorical.from_codes(codes, categories=categories)})
+        return df.assign(**{column: np.asarray(categories, dtype=object)[codes]})
+
+    def _table_metadata(self, file_name: str):
+        """
+        Returns the size and parquet metadata of a table from the manifest, or Nones without one.
+        """
+        if self.manifest is None:
+            return None, None
+        return self.manifest.size(file_name), self.manifest.metadata(file_name)
+
+    @contextmanager
+    def _check_manifest(self, file_name: str):
+        """
+        Turns the errors of decoding a table through the size and footer stored in the manifest into
+        a clear error when the table was rewritten after the manifest, e.g. by a standalone derive script.
+
+        Raises:
+            ValueError: If the table no longer has the size recorded in the manifest.
+        """
+        try:
+            yield
+        except FileNotFoundError:
+            raise
+        except (OSError, pa.ArrowException) as e:
+            if self.manifest is None or self.manifest.size(file_name) is None:
+                raise
+            path = pjoin(self.data_path, file_name)
+            if get_filesystem(path).size(path) == self.manifest.size(file_name):
+                raise
+            raise ValueError(
+                f"{file_name} has changed since the manifest of {self.data_path} was written. Re-run "
+                f"python -m ukbb_parser.updater.manifest --final_dir {self.data_path}."
+            ) from e
+
+    def _read_code_index(
+            self,
+            file_name: str,
+            codes: Union[str, List[str]],
+            prefix: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Reads the (feature, eid, row) entries of the given codes from the code index of a table.
+        """
+        codes = [str(code) for code in _to_list_type(codes)]
+        if prefix:
+            filters = [[("feature", ">=", code), ("feature", "<", code + "\U0010ffff")] for code in codes]
+        else:
+            filters = [("feature", "in", codes)]
+
+        if not codes:
+            return pd.DataFrame(
+                {"feature": pd.Series(dtype=object), "eid": pd.Series(dtype=np.int64), "row": pd.Series(dtype=np.int64)}
+            )
+
+        with span("read_code_index", file=file_name, codes=len(codes), prefix=prefix) as s:
+            df = self._read_code_index_entries(file_name, codes=codes, prefix=prefix, filters=filters)
+            if self.tombstones is not None:
+                df = df.loc[~self.tombstones.withdrawn(df["eid"].to_numpy())]
+            s.set(rows=len(df))
+        return df
+
+    def _read_code_index_entries(
+            self,
+            file_name: str,
+            codes: List[str] = None,
+            prefix: bool = False,
+            filters: list = None,
+            columns: List[str] = None,
+    ) -> pd.DataFrame:
+        """
+        Reads the entries of the code index of a table matching `filters`, or all of them.
+        """
+        index_name = file_name[: -len(".parquet")] + CODE_INDEX_SUFFIX
+        path = pjoin(self.data_path, index_name)
+        filesystem = get_filesystem(path)
+        if not filesystem.exists(path):
+            # Tables derived before code indexes existed are scanned instead
+            logger.warning(f"No code index found for {file_name}, scanning the whole table.")
+            df = read_parquet(pjoin(self.data_path, file_name), columns=["feature"])
+            features = df["feature"].astype(str)
+            if codes is None:
+                mask = df["feature"].notna()
+            else:
+                mask = features.str.startswith(tuple(codes)) if prefix else features.isin(codes)
+            df = pd.DataFrame(
+                {"feature": features[mask].to_numpy(), "eid": df.index[mask], "row": np.flatnonzero(mask)}
+            )
+            return df if columns is None else df[columns]
+        if is_s3(path):
+            # Read through a RangeFile, whose size is known from the manifest
+            size, _ = self._table_metadata(index_name)
+            with self._check_manifest(index_name):
+                range_file = RangeFile(filesystem, path, size=size)
+                return pq.read_table(range_file, columns=columns, filters=filters).to_pandas()
+        return pq.read_table(path, columns=columns, filters=filters).to_pandas()
+
+
+def _read_rows(
+        path: str,
+        rows: np.ndarray,
+        size: int = None,
+        metadata: pq.FileMetaData = None,
+        compact: bool = False,
+        filters: List[Tuple[str, str, object]] = None,
+) -> pd.DataFrame:
+    """
+    Reads the given sorted row positions of a parquet file, only decoding the row groups holding them.
+    """
+    parquet_file = open_parquet(path, size=size, metadata=metadata)
+    group_sizes = [parquet_file.metadata.row_group(i).num_rows for i in range(parquet_file.num_row_groups)]
+    group_starts = np.concatenate([[0], np.cumsum(group_sizes)])
+    groups = np.unique(np.searchsorted(group_starts, rows, side="right") - 1)
+    table = read_table(parquet_file, row_groups=list(groups))
+
+    # Position of each requested row within the concatenation of the row groups read
+    read_starts = np.concatenate([[0], np.cumsum(np.asarray(group_sizes)[groups])])
+    group_of_row = np.searchsorted(group_starts, rows, side="right") - 1
+    local = read_starts[np.searchsorted(groups, group_of_row)] + rows - group_starts[group_of_row]
+    table = table.take(local)
+    if filters:
+        table = filter_table(table, filters)
+    return to_pandas(table, compact=compact)
+
+
+def _unify_categories(df_list: List[pd.DataFrame], column: str) -> List[pd.DataFrame]:
+    """
+    Gives the categorical `column` of every dataframe the union of their categories, so that
+    concatenating them keeps the column categorical.
+    """
+    columns = [df[column] for df in df_list if column in df.columns]
+    if len(columns) < 2 or not all(isinstance(c.dtype, pd.CategoricalDtype) for c in columns):
+        return df_list
+    categories = union_categoricals(columns).categories
+    return [
+        df.assign(**{column: df[column].cat.set_categories(categories)}) if column in df.columns else df
+        for df in df_list
+    ]
+
+
+def _route(eids: np.ndarray, members: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Routes rows to the cohorts holding their patients.
+
+    The (eid, cohort) memberships are sorted by eid, so the cohorts of every row are found by two
+    binary searches, and rows are repeated once per cohort in a single gather.
+
+    Args:
+        eids (np.ndarray): The eid of every row.
+        members (list): The sorted unique eids of every cohort.
+    Returns:
+        (np.ndarray, np.ndarray): For every (row, cohort) pair, the position of the row and the
+            index of the cohort.
+    """
+    member_eids = np.concatenate(members) if members else np.array([], dtype=np.int64)
+    member_cohorts = np.repeat(np.arange(len(members)), [len(m) for m in members])
+    order = np.argsort(member_eids, kind="stable")
+    member_eids, member_cohorts = member_eids[order], member_cohorts[order]
+
+    eids = np.asarray(eids, dtype=np.int64)
+    starts = np.searchsorted(member_eids, eids, side="left")
+    counts = np.searchsorted(member_eids, eids, side="right") - starts
+    rows = np.repeat(np.arange(len(eids)), counts)
+    within = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, member_cohorts[starts[rows] + within].astype(np.int32)
+
 
 def _to_list_type(value: Union[int, str, list, np.ndarray]) -> Union[list, np.ndarray]:
     """
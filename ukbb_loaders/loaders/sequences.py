@@ -0,0 +1,149 @@
+"""
+Random access to the packed patient sequences exported by ukbb_parser's export_sequences.py.
+
+Example:
+    >>> reader = SequenceReader("<OUTPUT_DIR_FOLDER>/sequences")
+    >>> tokens, days = reader.get(1000021)
+    >>> reader.vocabulary.loc[tokens]
+
+    In the worker of a multi-process training loader, e.g. in a torch worker_init_fn:
+    >>> shard = reader.shard(worker_id, num_workers)
+    >>> for i in range(len(shard)):
+    ...     tokens, days = shard[i]
+"""
+import json
+import logging
+from os.path import join as pjoin
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from ukbb_loaders.utilities.filesystem import is_s3
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# The format version of the sequences this version reads
+FORMAT_VERSION = 1
+PAD_TOKEN = 0
+ARRAYS = ["eids", "offsets", "tokens", "days"]
+
+
+class SequenceReader:
+    def __init__(self, sequences_dir: str, start: int = 0, stop: int = None):
+        """
+        Reads the sequences of the patients in positions [start, stop) of a sequences directory.
+
+        The arrays are memory-mapped, so opening a reader reads nothing, and each patient is a
+        zero-copy slice of the token and day arrays. Readers are pickled as their directory and
+        range, so each worker process of a training loader maps the files itself.
+
+        Args:
+            sequences_dir (str): The local sequences directory. Memory maps need local files, so
+                copy the directory from s3 first.
+            start (int): The position of the first patient of the reader.
+            stop (int): The position after the last patient. Defaults to all patients.
+        """
+        if is_s3(sequences_dir):
+            raise ValueError(f"{sequences_dir} should be a local directory, as sequences are memory-mapped.")
+        self.sequences_dir = sequences_dir
+        with open(pjoin(sequences_dir, "metadata.json")) as f:
+            self.metadata = json.load(f)
+        if self.metadata["format_version"] != FORMAT_VERSION:
+            raise ValueError(
+                f"{sequences_dir} was written in format version {self.metadata['format_version']}, but this version "
+                f"of ukbb_loaders reads format version {FORMAT_VERSION}. Export the sequences again."
+            )
+        self.missing_day = self.metadata["missing_day"]
+        self.start = start
+        self.stop = self.metadata["patients"] if stop is None else stop
+        if not 0 <= self.start <= self.stop <= self.metadata["patients"]:
+            raise ValueError(f"The patients [{start}, {stop}) are not within the {self.metadata['patients']} patients.")
+        self._arrays = None
+        self._vocabulary = None
+
+    def __getstate__(self) -> dict:
+        return {"sequences_dir": self.sequences_dir, "start": self.start, "stop": self.stop}
+
+    def __setstate__(self, state: dict):
+        self.__init__(**state)
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __getitem__(self, position: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the tokens and days of the patient at a position of the reader, in time order.
+        """
+        if not -len(self) <= position < len(self):
+            raise IndexError(f"Position {position} is out of range for {len(self)} patients.")
+        position = self.start + position % len(self)
+        arrays = self._mapped()
+        first, last = arrays["offsets"][position], arrays["offsets"][position + 1]
+        return arrays["tokens"][first:last], arrays["days"][first:last]
+
+    @property
+    def eids(self) -> np.ndarray:
+        """
+        The sorted eids of the patients of the reader.
+        """
+        return self._mapped()["eids"][self.start: self.stop]
+
+    def position(self, eid: int) -> int:
+        """
+        Returns the position of a patient in the reader, with a binary search.
+
+        Raises:
+            KeyError: If the patient has no events in the reader.
+        """
+        eids = self.eids
+        position = int(np.searchsorted(eids, eid))
+        if position == len(eids) or eids[position] != eid:
+            raise KeyError(eid)
+        return position
+
+    def get(self, eid: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the tokens and days of a patient, in time order.
+        """
+        return self[self.position(eid)]
+
+    def lengths(self) -> np.ndarray:
+        """
+        Returns the number of events of every patient of the reader.
+        """
+        return np.diff(self._mapped()["offsets"][self.start: self.stop + 1])
+
+    def shard(self, index: int, count: int) -> "SequenceReader":
+        """
+        Splits the reader into `count` contiguous shards with about the same number of events, and
+        returns shard `index`.
+
+        Args:
+            index (int): The shard to return, from 0 to count - 1, e.g. the id of a worker.
+            count (int): The number of shards, e.g. the number of workers.
+        Returns:
+            (SequenceReader): The reader of the patients of the shard.
+        """
+        if not 0 <= index < count:
+            raise ValueError(f"The index argument should be between 0 and {count - 1}")
+        offsets = self._mapped()["offsets"][self.start: self.stop + 1]
+        targets = np.linspace(offsets[0], offsets[-1], count + 1)
+        bounds = np.searchsorted(offsets, targets, side="left")
+        bounds[0], bounds[-1] = 0, len(self)
+        return SequenceReader(self.sequences_dir, start=self.start + bounds[index], stop=self.start + bounds[index + 1])
+
+    @property
+    def vocabulary(self) -> pd.DataFrame:
+        """
+        The source and code of every token, indexed by token.
+        """
+        if self._vocabulary is None:
+            self._vocabulary = pd.read_parquet(pjoin(self.sequences_dir, "vocabulary.parquet"))
+        return self._vocabulary
+
+    def _mapped(self) -> dict:
+        if self._arrays is None:
+            self._arrays = {name: np.load(pjoin(self.sequences_dir, f"{name}.npy"), mmap_mode="r") for name in ARRAYS}
+        return self._arrays
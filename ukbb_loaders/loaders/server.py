@@ -0,0 +1,393 @@
+"""
+A local query server keeping the final tables in memory for many DataLoader clients.
+
+The server answers the DataLoader getters over Arrow Flight. Its loader runs the getters on the
+Arrow tables held in memory, and results travel as Arrow record batches, so they are only converted
+to pandas by the client. It only listens on localhost or on a Unix socket.
+
+Example:
+    Start a server in a terminal:
+    $ python -m ukbb_loaders.loaders.server --data_dir <OUTPUT_DIR_FOLDER>/final --location grpc://127.0.0.1:8815
+
+    and query it from any process on the same host:
+    >>> from ukbb_loaders.loaders.server import RemoteDataLoader
+    >>> dl = RemoteDataLoader("grpc://127.0.0.1:8815")
+    >>> dl.get_hospital_data("icd10", patient_list=eids)
+"""
+import argparse
+import base64
+import inspect
+import json
+import logging
+import threading
+import time
+from datetime import date
+from os.path import join as pjoin
+from typing import Dict, List, Tuple, Union
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.flight as flight
+
+from ukbb_loaders.loaders.load import CODE_INDEX_SUFFIX, DataLoader
+from ukbb_loaders.utilities.filesystem import compact_table, filter_table, get_filesystem, read_table
+from ukbb_loaders.utilities.tracing import span
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_LOCATION = "grpc://127.0.0.1:8815"
+LOCAL_HOSTS = ["127.0.0.1", "localhost", "::1"]
+# The DataLoader methods served, all returning a dataframe, a dataframe per cohort or eids
+SERVED_METHODS = [
+    "get_hospital_data",
+    "get_death_data",
+    "get_gp_clinical_data",
+    "get_gp_medication_data",
+    "get_gp_measurement_data",
+    "get_first_occurrence_data",
+    "get_batch",
+    "patients_with",
+]
+# Errors raised by the getters that are raised again in the client, sent as the JSON extra info of
+# the Flight error
+_ERRORS = {"ValueError": ValueError, "FileNotFoundError": FileNotFoundError}
+# The first and longest waits of a client between retries of a request refused by a busy server
+RETRY_DELAY = 0.01
+MAX_RETRY_DELAY = 1.0
+
+
+class WarmDataLoader(DataLoader):
+    def __init__(self, data_dir: str, tables: Dict[str, pa.Table], compact: bool = False):
+        """
+        A DataLoader reading its tables and code indexes from memory rather than from parquet.
+
+        The getters run on the Arrow tables and return Arrow tables with an eid column rather than
+        dataframes, so the server sends their results without converting them to pandas.
+
+        Args:
+            data_dir (str): The directory the tables were loaded from.
+            tables (dict): The Arrow tables, by file name, shared between loaders.
+            compact (bool): Whether to return compact tables, see DataLoader.
+        """
+        super().__init__(data_dir, compact=compact)
+        self.tables = tables
+
+    def _read_table(
+            self,
+            file_name: str,
+            patient_list: np.ndarray = None,
+            codes: Union[str, List[str]] = None,
+            prefix: bool = False,
+            filters: List[Tuple[str, str, object]] = None,
+    ) -> pa.Table:
+        table = self.tables.get(file_name)
+        if table is None:
+            # Every table of the directory is loaded at startup
+            raise FileNotFoundError(f"{file_name} is not in {self.data_path}.")
+        with span("read_table", file=file_name, warm=True):
+            if codes is not None:
+                rows = self._read_code_index(file_name, codes=codes, prefix=prefix)["row"].to_numpy()
+                table = table.take(pa.array(np.sort(rows)))
+            if (patient_list is not None) and (len(patient_list) > 0):
+                with span("filter_patients", rows_before=table.num_rows) as s:
+                    eids = table.column("eid")
+                    mask = pc.is_in(eids, value_set=pa.array(np.asarray(patient_list)).cast(eids.type))
+                    table = table.filter(mask)
+                    s.set(rows_after=table.num_rows)
+            if filters:
+                table = filter_table(table, filters)
+            if self.compact:
+                table = compact_table(table)
+            return table if codes is not None else self._drop_withdrawn(table)
+
+    def _eids(self, table: pa.Table) -> np.ndarray:
+        return table.column("eid").to_numpy()
+
+    def _column(self, table: pa.Table, column: str) -> np.ndarray:
+        return table.column(column).to_numpy()
+
+    def _isin(self, table: pa.Table, column: str, values: list) -> np.ndarray:
+        value_type = table.schema.field(column).type
+        if pa.types.is_dictionary(value_type):
+            value_type = value_type.value_type
+        return pc.is_in(table.column(column), value_set=pa.array(values).cast(value_type)).to_numpy()
+
+    def _keep(self, table: pa.Table, mask: np.ndarray) -> pa.Table:
+        return table.filter(pa.array(mask, type=pa.bool_()))
+
+    def _take(self, table: pa.Table, rows: np.ndarray) -> pa.Table:
+        return table.take(pa.array(np.asarray(rows, dtype=np.int64)))
+
+    def _select(self, table: pa.Table, columns: List[str]) -> pa.Table:
+        return table.select(["eid"] + columns)
+
+    def _rename(self, table: pa.Table, columns: Dict[str, str]) -> pa.Table:
+        return table.rename_columns([columns.get(name, name) for name in table.column_names])
+
+    def _assign_codes(
+            self, table: pa.Table, column: str, codes: np.ndarray, categories: List[str], categorical: bool
+    ) -> pa.Table:
+        categories = pa.array(categories, type=pa.string())
+        if categorical:
+            values = pa.DictionaryArray.from_arrays(pa.array(codes), categories)
+        else:
+            values = categories.take(pa.array(codes))
+        if column in table.column_names:
+            return table.set_column(table.column_names.index(column), column, values)
+        return table.append_column(column, values)
+
+    def _concat(self, tables: List[pa.Table]) -> pa.Table:
+        with span("concat", frames=len(tables)):
+            table = pa.concat_tables(tables)
+        with span("assign", rows=table.num_rows):
+            value = np.ones(table.num_rows, dtype=np.int8 if self.compact else np.int64)
+            return table.append_column("value", pa.array(value))
+
+    def _read_code_index_entries(
+            self,
+            file_name: str,
+            codes: List[str] = None,
+            prefix: bool = False,
+            filters: list = None,
+            columns: List[str] = None,
+    ) -> pd.DataFrame:
+        index = self.tables.get(_code_index_name(file_name))
+        if index is None:
+            return super()._read_code_index_entries(
+                file_name, codes=codes, prefix=prefix, filters=filters, columns=columns
+            )
+        if columns is not None:
+            index = index.select(columns)
+        if codes is None:
+            return index.to_pandas()
+        features = index.column("feature")
+        if prefix:
+            mask = pc.starts_with(features, codes[0])
+            for code in codes[1:]:
+                mask = pc.or_(mask, pc.starts_with(features, code))
+        else:
+            mask = pc.is_in(features, value_set=pa.array(codes, type=pa.string()))
+        return index.filter(mask).to_pandas()
+
+
+class QueryServer(flight.FlightServerBase):
+    def __init__(self, data_dir: str, location: str = DEFAULT_LOCATION, max_concurrency: int = 4):
+        """
+        Serves the DataLoader getters of a final directory from memory.
+
+        Every table and code index of the directory is loaded once at startup. Requests are
+        answered concurrently, up to `max_concurrency` at a time. Further requests are refused at
+        once as unavailable rather than holding a gRPC thread while they wait, and
+        RemoteDataLoader retries them.
+
+        Args:
+            data_dir (str): The local or s3 path of the final directory.
+            location (str): Where to listen, either grpc://<host>:<port> on localhost, with port 0
+                for any free port, or grpc+unix://<socket path>.
+            max_concurrency (int): The number of requests answered at the same time.
+        """
+        _check_local(location)
+        super().__init__(location)
+        self.tables = load_tables(data_dir)
+        self.loaders = {
+            compact: WarmDataLoader(data_dir, self.tables, compact=compact) for compact in [False, True]
+        }
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        logger.info(f"Serving {len(self.tables)} tables of {data_dir} on {location}.")
+
+    def do_get(self, context, ticket: flight.Ticket):
+        request = json.loads(ticket.ticket.decode())
+        method = request["method"]
+        if method not in SERVED_METHODS:
+            raise _server_error(ValueError(f"The method argument should be one of {SERVED_METHODS}"))
+        if not self._slots.acquire(blocking=False):
+            raise flight.FlightUnavailableError("The server is answering its maximum number of requests.")
+        try:
+            loader = self.loaders[bool(request.get("compact", False))]
+            kwargs = {name: _decode(value) for name, value in request["kwargs"].items()}
+            if method == "get_batch":
+                kwargs["combine"] = True
+            result = getattr(loader, method)(**kwargs)
+        except tuple(_ERRORS.values()) as e:
+            raise _server_error(e)
+        finally:
+            self._slots.release()
+
+        if isinstance(result, np.ndarray):
+            result = pa.table({"eid": result})
+        return flight.RecordBatchStream(result)
+
+    def do_action(self, context, action: flight.Action):
+        if action.type == "tables":
+            content = {file_name: table.num_rows for file_name, table in self.tables.items()}
+            return [json.dumps(content).encode()]
+        raise _server_error(ValueError(f"Unknown action {action.type}."))
+
+
+def load_tables(data_dir: str) -> Dict[str, pa.Table]:
+    """
+    Reads every final table and code index of a directory into memory. Their pandas metadata is
+    dropped, as the getters of WarmDataLoader add and rename columns; eids are a plain column.
+    """
+    fs = get_filesystem(data_dir)
+    file_names = sorted(
+        path.rstrip("/").split("/")[-1] for path in fs.ls(data_dir, detail=False) if path.endswith(".parquet")
+    )
+    tables = {}
+    for file_name in file_names:
+        logger.info(f"Loading {file_name}.")
+        tables[file_name] = read_table(pjoin(data_dir, file_name)).replace_schema_metadata(None)
+    return tables
+
+
+class RemoteDataLoader:
+    def __init__(self, location: str = DEFAULT_LOCATION, compact: bool = False, retry_timeout: float = 60):
+        """
+        A drop-in replacement of DataLoader answered by a QueryServer on the same host.
+
+        Args:
+            location (str): Where the server listens.
+            compact (bool): Whether to return compact dataframes, see DataLoader.
+            retry_timeout (float): The number of seconds to retry a request refused by a server
+                answering its maximum number of requests, with exponential backoff.
+        """
+        _check_local(location)
+        self.location = location
+        self.compact = compact
+        self.retry_timeout = retry_timeout
+        self.client = flight.FlightClient(location)
+
+    def tables(self) -> Dict[str, int]:
+        """
+        Returns the number of rows of every table held by the server.
+        """
+        (result,) = self.client.do_action(flight.Action("tables", b""))
+        return json.loads(result.body.to_pybytes())
+
+    def _call(self, method: str, kwargs: dict):
+        request = {
+            "method": method,
+            "compact": self.compact,
+            "kwargs": {name: _encode(value) for name, value in kwargs.items()},
+        }
+        ticket = flight.Ticket(json.dumps(request).encode())
+        deadline = time.monotonic() + self.retry_timeout
+        delay = RETRY_DELAY
+        while True:
+            try:
+                table = self.client.do_get(ticket).read_all()
+                break
+            except flight.FlightUnavailableError:
+                if time.monotonic() + delay > deadline:
+                    raise
+                time.sleep(delay)
+                delay = min(2 * delay, MAX_RETRY_DELAY)
+            except flight.FlightServerError as e:
+                error = json.loads(e.extra_info) if e.extra_info else {}
+                if error.get("type") in _ERRORS:
+                    raise _ERRORS[error["type"]](error["message"]) from None
+                raise
+        if method == "patients_with":
+            return table.column("eid").to_numpy()
+        return table.to_pandas().set_index("eid")
+
+
+def _remote(method: str):
+    signature = inspect.signature(getattr(DataLoader, method))
+
+    def call(self, *args, **kwargs):
+        arguments = signature.bind(self, *args, **kwargs).arguments
+        arguments.pop("self")
+        arguments.update(arguments.pop("kwargs", {}))
+        result = self._call(method, arguments)
+        if method == "get_batch" and not arguments.get("combine", False):
+            cohorts = result.pop("cohort")
+            return {name: result.loc[(cohorts == name).to_numpy()] for name in cohorts.cat.categories}
+        return result
+
+    call.__name__ = method
+    call.__doc__ = getattr(DataLoader, method).__doc__
+    call.__signature__ = signature
+    return call
+
+
+for _method in SERVED_METHODS:
+    setattr(RemoteDataLoader, _method, _remote(_method))
+
+
+def _check_local(location: str):
+    """
+    Refuses locations other than localhost and Unix sockets.
+    """
+    parsed = urlparse(location)
+    if parsed.scheme == "grpc+unix":
+        return
+    if parsed.scheme not in ["grpc", "grpc+tcp"] or parsed.hostname not in LOCAL_HOSTS:
+        raise ValueError(f"The location argument should be a Unix socket or on one of {LOCAL_HOSTS}")
+
+
+def _code_index_name(file_name: str) -> str:
+    return file_name[: -len(".parquet")] + CODE_INDEX_SUFFIX
+
+
+def _server_error(error: Exception) -> flight.FlightServerError:
+    """
+    Wraps an error of a getter with its type and message as JSON, for the client to raise again.
+    """
+    extra_info = json.dumps({"type": type(error).__name__, "message": str(error)}).encode()
+    return flight.FlightServerError(f"{type(error).__name__}: {error}", extra_info=extra_info)
+
+
+def _encode(value):
+    """
+    Encodes an argument as JSON, with arrays of eids as base64 int64 buffers and dates as ISO strings.
+    """
+    if isinstance(value, (pd.Series, pd.Index)):
+        value = value.to_numpy()
+    if isinstance(value, np.ndarray) and value.dtype.kind in "iu":
+        return {"int64": base64.b64encode(value.astype(np.int64).tobytes()).decode("ascii")}
+    if isinstance(value, (np.ndarray, list, tuple)):
+        return [_encode(item) for item in value]
+    if isinstance(value, (date, np.datetime64)):
+        return {"timestamp": pd.Timestamp(value).isoformat()}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {"dict": {key: _encode(item) for key, item in value.items()}}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict) and "int64" in value:
+        return np.frombuffer(base64.b64decode(value["int64"]), dtype=np.int64)
+    if isinstance(value, dict) and "timestamp" in value:
+        return pd.Timestamp(value["timestamp"])
+    if isinstance(value, dict) and "dict" in value:
+        return {key: _decode(item) for key, item in value["dict"].items()}
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+def get_args():
+    """
+    Parse arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", type=str, required=True, help="The directory of final derived files.")
+    parser.add_argument("--location", type=str, default=DEFAULT_LOCATION, help="Where to listen, on localhost.")
+    parser.add_argument("--max_concurrency", type=int, default=4, help="Number of requests answered at once.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s:%(lineno)d - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    args = get_args()
+    QueryServer(args.data_dir, location=args.location, max_concurrency=args.max_concurrency).serve()
@@ -0,0 +1,472 @@
+"""
+Shared, range-request-aware filesystem access for local and s3 parquet files.
+"""
+import bisect
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from ukbb_loaders.utilities.tracing import span
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Bytes read from the end of a file to get the parquet footer in a single request
+FOOTER_PREFETCH = 64 * 1024
+# Ranges closer than this are fetched in a single request
+COALESCE_GAP = 512 * 1024
+# Ranges larger than this are split into parts fetched in parallel
+PART_SIZE = 16 * 1024 * 1024
+
+_settings = {"max_concurrency": 16, "storage_options": {}}
+_lock = threading.Lock()
+
+# Fetches the byte ranges of a file for the running query instead of the shared thread pool, e.g.
+# on the event loop of an AsyncDataLoader
+Fetcher = Callable[[str, List[Tuple[int, int]]], List[bytes]]
+_fetcher: ContextVar[Optional[Fetcher]] = ContextVar("ukbb_loaders_fetcher", default=None)
+
+
+def configure(max_concurrency: int = None, **storage_options):
+    """
+    Configures the shared s3 filesystem.
+
+    Args:
+        max_concurrency (int): The maximum number of requests in flight, which is also the size of
+            the connection pool. Defaults to 16.
+        storage_options: Keyword arguments passed to s3fs.S3FileSystem, e.g.
+            client_kwargs={"endpoint_url": "http://localhost:9000"} for a local MinIO.
+
+    Example:
+        >>> configure(max_concurrency=32, client_kwargs={"endpoint_url": "http://localhost:9000"})
+    """
+    with _lock:
+        if max_concurrency is not None:
+            _settings["max_concurrency"] = max_concurrency
+        _settings["storage_options"] = storage_options
+        _s3_filesystem.cache_clear()
+        _executor.cache_clear()
+
+
+def is_s3(path: str) -> bool:
+    return path.startswith("s3://")
+
+
+@lru_cache(maxsize=None)
+def _s3_filesystem():
+    """
+    Creates the shared s3 filesystem, whose connection pool is sized to the request concurrency.
+    s3fs is only imported here, once an s3:// path is actually used.
+    """
+    from s3fs import S3FileSystem
+
+    options = dict(_settings["storage_options"])
+    config_kwargs = {"max_pool_connections": _settings["max_concurrency"], **options.pop("config_kwargs", {})}
+    return S3FileSystem(config_kwargs=config_kwargs, **options)
+
+
+def get_filesystem(path: str):
+    """
+    Returns the shared filesystem for a path: one pooled S3FileSystem for s3:// paths and the local
+    filesystem otherwise.
+    """
+    return _s3_filesystem() if is_s3(path) else _local_filesystem()
+
+
+def async_s3_filesystem(loop):
+    """
+    Creates an asynchronous s3 filesystem bound to an event loop, with the options of the shared
+    filesystem. Its session must be started with `await fs.set_session()`.
+    """
+    from s3fs import S3FileSystem
+
+    options = dict(_settings["storage_options"])
+    config_kwargs = {"max_pool_connections": _settings["max_concurrency"], **options.pop("config_kwargs", {})}
+    return S3FileSystem(
+        asynchronous=True, loop=loop, skip_instance_cache=True, config_kwargs=config_kwargs, **options
+    )
+
+
+@contextmanager
+def fetching_with(fetcher: Optional[Fetcher]):
+    """
+    Fetches the byte ranges of the s3 files read inside the block with `fetcher`, which is called
+    with a path and a list of [start, end) ranges and returns their bytes.
+    """
+    token = _fetcher.set(fetcher)
+    try:
+        yield
+    finally:
+        _fetcher.reset(token)
+
+
+@lru_cache(maxsize=None)
+def _local_filesystem():
+    from fsspec.implementations.local import LocalFileSystem
+
+    return LocalFileSystem()
+
+
+@lru_cache(maxsize=None)
+def _executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=_settings["max_concurrency"], thread_name_prefix="ukbb_fetch")
+
+
+def is_nonempty_dir(path: str) -> bool:
+    """
+    Checks that a directory exists and has at least one file. On s3 this is a single listing
+    request for one key rather than a listing of the whole directory.
+    """
+    fs = get_filesystem(path)
+    if is_s3(path):
+        return fs.isdir(path)
+    return len(fs.ls(path, detail=False)) > 0
+
+
+class RangeFile(io.RawIOBase):
+    def __init__(self, fs, path: str, size: int = None):
+        """
+        A read-only file serving reads from byte ranges fetched ahead of time.
+
+        Ranges passed to `prefetch` are coalesced and fetched in parallel, with a bounded number
+        of requests in flight, and any read outside of them is fetched on demand.
+
+        Args:
+            fs: The fsspec filesystem holding the file.
+            path (str): The path of the file.
+            size (int): The size of the file, if known, which saves a request.
+        """
+        super().__init__()
+        self.fs = fs
+        self.path = path
+        self.size = int(fs.size(path)) if size is None else size
+        self.position = 0
+        self.bytes_fetched = 0
+        self.requests = 0
+        self._starts: List[int] = []
+        self._blocks: Dict[int, bytes] = {}
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        end = min(self.position + len(buffer), self.size)
+        data = self.read_range(self.position, end)
+        buffer[: len(data)] = data
+        self.position = end
+        return len(data)
+
+    def read_range(self, start: int, end: int) -> bytes:
+        """
+        Returns the bytes in [start, end), fetching them if they were not prefetched.
+        """
+        data = self._from_blocks(start, end)
+        if data is None:
+            self.prefetch([(start, end)])
+            data = self._from_blocks(start, end)
+        return data
+
+    def prefetch(self, ranges: Sequence[Tuple[int, int]]):
+        """
+        Fetches byte ranges in parallel, coalescing nearby ranges and splitting large ones. Ranges
+        that were already fetched are skipped.
+        """
+        parts = _plan_requests([(start, end) for start, end in ranges if self._from_blocks(start, end) is None])
+        if not parts:
+            return
+        fetcher = _fetcher.get()
+        if fetcher is not None:
+            results = fetcher(self.path, parts)
+            self.requests += len(parts)
+            self.bytes_fetched += sum(len(data) for data in results)
+        elif len(parts) == 1:
+            results = [self._fetch(*parts[0])]
+        else:
+            results = list(_executor().map(lambda part: self._fetch(*part), parts))
+        for (start, _), data in zip(parts, results):
+            if start not in self._blocks:
+                bisect.insort(self._starts, start)
+            self._blocks[start] = data
+
+    def _fetch(self, start: int, end: int) -> bytes:
+        data = self.fs.cat_file(self.path, start=start, end=end)
+        self.requests += 1
+        self.bytes_fetched += len(data)
+        return data
+
+    def _from_blocks(self, start: int, end: int) -> Optional[bytes]:
+        """
+        Assembles [start, end) from contiguous fetched blocks, or returns None if there is a gap.
+        """
+        chunks = []
+        position = start
+        while position < end:
+            index = bisect.bisect_right(self._starts, position) - 1
+            if index < 0:
+                return None
+            block_start = self._starts[index]
+            block = self._blocks[block_start]
+            if position >= block_start + len(block):
+                return None
+            chunk = block[position - block_start: end - block_start]
+            chunks.append(chunk)
+            position += len(chunk)
+        return b"".join(chunks)
+
+
+def open_parquet(path: str, size: int = None, metadata: pq.FileMetaData = None) -> pq.ParquetFile:
+    """
+    Opens a parquet file. On s3 the footer is fetched with a single range request.
+
+    Args:
+        path (str): The local or s3 path of the file.
+        size (int): The size of the file, if known, which saves a request on s3.
+        metadata (pq.FileMetaData): The metadata of the file, if known, e.g. from the manifest of
+            the final directory, which saves reading the footer.
+    Returns:
+        (pq.ParquetFile): The opened parquet file. For s3 files, the underlying RangeFile is
+            available as its `range_file` attribute.
+    """
+    with span("open", path=path, metadata_cached=metadata is not None) as s:
+        if not is_s3(path):
+            return pq.ParquetFile(path, metadata=metadata)
+        range_file = RangeFile(get_filesystem(path), path, size=size)
+        if metadata is None:
+            range_file.prefetch([(max(0, range_file.size - FOOTER_PREFETCH), range_file.size)])
+            footer_length = int.from_bytes(range_file.read_range(range_file.size - 8, range_file.size - 4), "little")
+            if footer_length + 8 > FOOTER_PREFETCH:
+                range_file.prefetch([(max(0, range_file.size - footer_length - 8), range_file.size)])
+        parquet_file = pq.ParquetFile(range_file, metadata=metadata)
+        parquet_file.range_file = range_file
+        s.set(bytes_read=range_file.bytes_fetched, requests=range_file.requests)
+        return parquet_file
+
+
+def select_row_groups(parquet_file: pq.ParquetFile, patient_list: np.ndarray = None, column: str = "eid") -> List[int]:
+    """
+    Returns the row groups that may hold any of the patients, from the eid statistics of each
+    row group. All row groups are returned when no patients are given.
+    """
+    metadata = parquet_file.metadata
+    row_groups = list(range(metadata.num_row_groups))
+    if patient_list is None or len(patient_list) == 0:
+        return row_groups
+    names = [metadata.schema.column(i).name for i in range(metadata.num_columns)]
+    if column not in names:
+        return row_groups
+    position = names.index(column)
+    patients = np.sort(np.asarray(patient_list))
+
+    selected = []
+    for row_group in row_groups:
+        statistics = metadata.row_group(row_group).column(position).statistics
+        if statistics is None or not statistics.has_min_max:
+            selected.append(row_group)
+            continue
+        first = np.searchsorted(patients, statistics.min, side="left")
+        if first < len(patients) and patients[first] <= statistics.max:
+            selected.append(row_group)
+    return selected
+
+
+def read_table(
+        path: Union[str, pq.ParquetFile],
+        columns: List[str] = None,
+        patient_list: np.ndarray = None,
+        row_groups: List[int] = None,
+        size: int = None,
+        metadata: pq.FileMetaData = None,
+        filters: List[Tuple[str, str, object]] = None,
+) -> pa.Table:
+    """
+    Reads a parquet file, only reading the row groups and columns that are needed.
+
+    On s3, the byte ranges of the selected column chunks are fetched in parallel before decoding.
+
+    Args:
+        path (str or pq.ParquetFile): The local or s3 path of the file, or the file opened by
+            `open_parquet`.
+        columns (list): The columns to read. The pandas index columns are always read.
+            Defaults to all columns.
+        patient_list (np.ndarray): If given, row groups whose eid range holds none of these patients
+            are skipped. Rows are not filtered.
+        row_groups (list): The row groups to read. Defaults to all of them.
+        size (int): The size of the file, if known, which saves a request on s3.
+        metadata (pq.FileMetaData): The metadata of the file, if known, which saves reading the footer.
+        filters (list): The (column, op, value) conditions the rows must all meet, see `filter_table`.
+    Returns:
+        (pa.Table): The rows of the selected row groups.
+    """
+    if isinstance(path, pq.ParquetFile):
+        parquet_file = path
+    else:
+        parquet_file = open_parquet(path, size=size, metadata=metadata)
+    if row_groups is None:
+        row_groups = select_row_groups(parquet_file, patient_list)
+    if columns is not None:
+        columns = list(columns) + [c for c in _index_columns(parquet_file) if c not in columns]
+    # The columns only read for the filters are dropped after filtering
+    selected = columns
+    if columns is not None and filters:
+        columns = columns + [column for column, _, _ in filters if column not in columns]
+
+    if hasattr(parquet_file, "range_file"):
+        range_file = parquet_file.range_file
+        with span("fetch") as s:
+            bytes_fetched, requests = range_file.bytes_fetched, range_file.requests
+            range_file.prefetch(_column_chunk_ranges(parquet_file.metadata, row_groups, columns))
+            s.set(bytes_read=range_file.bytes_fetched - bytes_fetched, requests=range_file.requests - requests)
+    with span("decode") as s:
+        table = parquet_file.read_row_groups(row_groups, columns=columns, use_pandas_metadata=True)
+        s.set(
+            row_groups_scanned=len(row_groups),
+            row_groups_skipped=parquet_file.num_row_groups - len(row_groups),
+            rows=table.num_rows,
+            bytes_decoded=table.nbytes,
+        )
+    if filters:
+        table = filter_table(table, filters)
+        if selected is not None:
+            table = table.select(selected)
+    return table
+
+
+def filter_table(table: pa.Table, filters: List[Tuple[str, str, object]]) -> pa.Table:
+    """
+    Keeps the rows meeting every (column, op, value) condition, with op one of == and in, before
+    the rows are converted to pandas.
+
+    Example:
+        >>> filter_table(table, [("level", "in", [1, 2])])
+    """
+    with span("filter_rows", rows_before=table.num_rows) as s:
+        mask = None
+        for column, op, value in filters:
+            values = table.column(column)
+            if op == "==":
+                condition = pc.equal(values, pa.scalar(value, type=values.type))
+            elif op == "in":
+                condition = pc.is_in(values, value_set=pa.array(value, type=values.type))
+            else:
+                raise ValueError("The op argument should be one of ['==', 'in']")
+            mask = condition if mask is None else pc.and_(mask, condition)
+        table = table.filter(mask)
+        s.set(rows_after=table.num_rows)
+    return table
+
+
+def read_parquet(
+        path: str,
+        columns: List[str] = None,
+        patient_list: np.ndarray = None,
+        size: int = None,
+        metadata: pq.FileMetaData = None,
+        compact: bool = False,
+        filters: List[Tuple[str, str, object]] = None,
+) -> pd.DataFrame:
+    """
+    Reads a parquet file into pandas, only reading the row groups and columns that are needed.
+    See `read_table` for the arguments, and `to_pandas` for `compact`.
+    """
+    table = read_table(
+        path, columns=columns, patient_list=patient_list, size=size, metadata=metadata, filters=filters
+    )
+    return to_pandas(table, compact=compact)
+
+
+def to_pandas(table: pa.Table, compact: bool = False) -> pd.DataFrame:
+    """
+    Converts a table to pandas.
+
+    Args:
+        table (pa.Table): The table to convert.
+        compact (bool): Whether to convert string columns to categoricals, dictionary encoding them
+            before conversion so no Python string is created per row, and eids to int32.
+    Returns:
+        (pd.DataFrame): The converted table.
+    """
+    with span("convert", rows=table.num_rows, compact=compact):
+        if compact:
+            table = compact_table(table)
+        return table.to_pandas()
+
+
+def compact_table(table: pa.Table) -> pa.Table:
+    """
+    Dictionary encodes the string columns of a table and casts its eids to int32, so they convert
+    to categoricals and int32 in pandas.
+    """
+    for i, field in enumerate(table.schema):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            table = table.set_column(i, field.name, table.column(i).dictionary_encode())
+        elif field.name == "eid" and pa.types.is_integer(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.int32()))
+    return table
+
+
+def _index_columns(parquet_file: pq.ParquetFile) -> List[str]:
+    pandas_metadata = parquet_file.schema_arrow.pandas_metadata or {}
+    return [c for c in pandas_metadata.get("index_columns", []) if isinstance(c, str)]
+
+
+def _column_chunk_ranges(metadata, row_groups: List[int], columns: List[str] = None) -> List[Tuple[int, int]]:
+    """
+    Returns the byte ranges of the column chunks of the given row groups and columns.
+    """
+    ranges = []
+    for row_group in row_groups:
+        row_group_metadata = metadata.row_group(row_group)
+        for i in range(row_group_metadata.num_columns):
+            chunk = row_group_metadata.column(i)
+            if columns is not None and chunk.path_in_schema.split(".")[0] not in columns:
+                continue
+            start = chunk.data_page_offset
+            if chunk.has_dictionary_page and chunk.dictionary_page_offset:
+                start = min(start, chunk.dictionary_page_offset)
+            ranges.append((start, start + chunk.total_compressed_size))
+    return ranges
+
+
+def _plan_requests(ranges: Sequence[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    Coalesces ranges closer than COALESCE_GAP and splits the result into parts of PART_SIZE.
+    """
+    merged: List[List[int]] = []
+    for start, end in sorted(ranges):
+        if end <= start:
+            continue
+        if merged and start - merged[-1][1] <= COALESCE_GAP:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [
+        (part_start, min(part_start + PART_SIZE, end))
+        for start, end in merged
+        for part_start in range(start, end, PART_SIZE)
+    ]
@@ -0,0 +1,214 @@
+"""
+Precomputed code hierarchies for ancestry queries and rollups.
+"""
+from functools import lru_cache
+from typing import List, Union
+
+import numpy as np
+import pandas as pd
+
+from ukbb_loaders.utilities.util import load_lookup, load_mapper
+
+Codes = Union[str, List[str], np.ndarray, pd.Series]
+# The prefix of the phecodes of the icd10_to_phecodes mapper, e.g. PHECODE_250.2
+PHECODE_PREFIX = "PHECODE_"
+
+
+class HierarchyIndex:
+    def __init__(self, codes: np.ndarray, parents: np.ndarray, root_level: int = 0):
+        """
+        A code hierarchy with precomputed ancestor closures and interval labels.
+
+        Every code stores its ancestor at each depth, so a rollup to any level is one gather, and
+        its [start, end) interval in a pre-order traversal, so "is X a descendant of Y" is two
+        comparisons. Both are vectorised over arrays of codes.
+
+        Args:
+            codes (np.ndarray): The codes of the hierarchy.
+            parents (np.ndarray): The position in `codes` of the parent of each code, -1 for roots.
+            root_level (int): The level of the roots, e.g. 2 for ATC trees rooted at therapeutic
+                subgroups such as A10.
+        """
+        self.codes = np.asarray(codes, dtype=object)
+        self.parents = np.asarray(parents, dtype=np.int64)
+        self.root_level = root_level
+        self._index = pd.Index(self.codes)
+        if self._index.has_duplicates:
+            raise ValueError("The codes of a hierarchy should be unique.")
+
+        # Walk up the tree once, one level per iteration, to get each code's chain of ancestors
+        chain = [np.arange(len(self.codes))]
+        while (chain[-1] >= 0).any():
+            if len(chain) > len(self.codes):
+                raise ValueError("The hierarchy contains a cycle.")
+            current = chain[-1]
+            chain.append(np.where(current >= 0, self.parents[np.maximum(current, 0)], -1))
+        chain = np.stack(chain[:-1], axis=1)
+        self.depths = (chain >= 0).sum(axis=1) - 1
+
+        # ancestors[i, d] is the ancestor of code i at depth d, or -1 below the code's own depth
+        self.ancestors = np.full(chain.shape, -1, dtype=np.int64)
+        rows, steps = np.nonzero(chain >= 0)
+        self.ancestors[rows, self.depths[rows] - steps] = chain[rows, steps]
+
+        # Sorting by ancestor paths gives a pre-order traversal, and a subtree is a contiguous run
+        self.order = np.lexsort(self.ancestors.T[::-1])
+        self.starts = np.empty(len(self.codes), dtype=np.int64)
+        self.starts[self.order] = np.arange(len(self.codes))
+        self.ends = self.starts + np.bincount(self.ancestors[self.ancestors >= 0], minlength=len(self.codes))
+
+    @classmethod
+    def from_edges(cls, children: np.ndarray, parents: np.ndarray, root_level: int = 0) -> "HierarchyIndex":
+        """
+        Builds a hierarchy from (child, parent) edges.
+
+        When a child is listed with several parents, as when edges to grandparents are included,
+        the longest parent code is taken as the direct parent.
+        """
+        edges = pd.DataFrame({"child": children, "parent": parents}).dropna().astype(str).drop_duplicates()
+        edges = edges.loc[edges["child"] != edges["parent"]]
+        edges = edges.assign(length=edges["parent"].str.len()).sort_values(["child", "length"])
+        edges = edges.drop_duplicates("child", keep="last")
+        codes = pd.Index(pd.unique(np.concatenate([edges["parent"].to_numpy(), edges["child"].to_numpy()])))
+        parent_of = np.full(len(codes), -1, dtype=np.int64)
+        parent_of[codes.get_indexer(edges["child"])] = codes.get_indexer(edges["parent"])
+        return cls(codes.to_numpy(), parent_of, root_level=root_level)
+
+    @classmethod
+    def from_prefixes(cls, codes: np.ndarray, root_level: int = 0) -> "HierarchyIndex":
+        """
+        Builds a hierarchy where the parent of a code is its longest proper prefix that is also a
+        code, e.g. N18 -> N181 or 250 -> 250.2 -> 250.21.
+        """
+        codes = pd.Index(pd.unique(pd.Series(codes).dropna().astype(str)))
+        lengths = codes.str.len().to_numpy()
+        parents = np.full(len(codes), -1, dtype=np.int64)
+        for length in range(int(lengths.max(initial=0)) - 1, 0, -1):
+            missing = (parents < 0) & (lengths > length)
+            candidates = codes.get_indexer(codes[missing].str[:length])
+            parents[np.flatnonzero(missing)] = candidates
+        return cls(codes.to_numpy(), parents, root_level=root_level)
+
+    def positions(self, codes: Codes) -> np.ndarray:
+        """
+        Returns the position of each code in the hierarchy, or -1 for unknown codes.
+        """
+        code_ids, uniques = pd.factorize(np.atleast_1d(np.asarray(codes, dtype=object)))
+        positions = self._index.get_indexer(pd.Index(uniques).astype(str))
+        return np.where(code_ids >= 0, positions[code_ids], -1)
+
+    def rollup(self, codes: Codes, level: int, strict: bool = False) -> np.ndarray:
+        """
+        Rolls codes up to their ancestor at a given level.
+
+        Args:
+            codes (str or list): The codes to roll up.
+            level (int): The level to roll up to, where the roots are at `root_level`.
+            strict (bool): Whether codes above the requested level, or unknown codes, are returned
+                as missing. Defaults to returning them unchanged.
+        Returns:
+            (np.ndarray): The ancestor of each code at the requested level.
+
+        Example:
+            Roll medications mapped to ATC codes up to ATC level 3:
+            >>> atc_hierarchy().rollup(["N06AX11", "A10BA02"], level=3)
+            array(['N06A', 'A10B'], dtype=object)
+        """
+        depth = level - self.root_level
+        if depth < 0:
+            raise ValueError(f"The level argument should be at least {self.root_level}")
+        positions = self.positions(codes)
+        ancestors = np.full(len(positions), -1, dtype=np.int64)
+        if depth < self.ancestors.shape[1]:
+            ancestors = np.where(positions >= 0, self.ancestors[np.maximum(positions, 0), depth], -1)
+        result = np.where(ancestors >= 0, self.codes[np.maximum(ancestors, 0)], None)
+        if not strict:
+            original = np.atleast_1d(np.asarray(codes, dtype=object))
+            result = np.where(ancestors >= 0, result, original)
+        return result
+
+    def level(self, codes: Codes) -> np.ndarray:
+        """
+        Returns the level of each code, or -1 for unknown codes.
+        """
+        positions = self.positions(codes)
+        return np.where(positions >= 0, self.depths[np.maximum(positions, 0)] + self.root_level, -1)
+
+    def is_descendant(self, codes: Codes, ancestor: str, include_self: bool = True) -> np.ndarray:
+        """
+        Checks whether codes are descendants of a given code.
+
+        Args:
+            codes (str or list): The codes to check.
+            ancestor (str): The code whose subtree is checked.
+            include_self (bool): Whether a code counts as its own descendant.
+        Returns:
+            (np.ndarray): A boolean per code.
+
+        Example:
+            >>> atc_hierarchy().is_descendant(df["atc"], "C10")
+        """
+        positions = self.positions(codes)
+        (node,) = self.positions(ancestor)
+        if node < 0:
+            return np.zeros(len(positions), dtype=bool)
+        starts = np.where(positions >= 0, self.starts[np.maximum(positions, 0)], -1)
+        lower = self.starts[node] + (0 if include_self else 1)
+        return (starts >= lower) & (starts < self.ends[node])
+
+    def descendants(self, code: str, include_self: bool = True) -> np.ndarray:
+        """
+        Returns all the descendants of a code, in pre-order.
+        """
+        (node,) = self.positions(code)
+        if node < 0:
+            return np.array([], dtype=object)
+        start = self.starts[node] + (0 if include_self else 1)
+        return self.codes[self.order[start: self.ends[node]]]
+
+    def ancestors_of(self, code: str, include_self: bool = True) -> np.ndarray:
+        """
+        Returns all the ancestors of a code, from the root down.
+        """
+        (node,) = self.positions(code)
+        if node < 0:
+            return np.array([], dtype=object)
+        path = self.ancestors[node, : self.depths[node] + (1 if include_self else 0)]
+        return self.codes[path]
+
+
+@lru_cache(maxsize=None)
+def atc_hierarchy() -> HierarchyIndex:
+    """
+    Returns the ATC hierarchy built from the atc_child_to_parent mapper, rooted at level 2.
+    """
+    df = load_mapper("atc_child_to_parent")
+    return HierarchyIndex.from_edges(df["child"].to_numpy(), df["parent"].to_numpy(), root_level=2)
+
+
+@lru_cache(maxsize=None)
+def icd10_hierarchy() -> HierarchyIndex:
+    """
+    Returns the ICD10 prefix hierarchy of the ehr_diagnosis_icd10 lookup, rooted at 3-character
+    categories such as N18.
+    """
+    codes = load_lookup("ehr_diagnosis_icd10")["coding"]
+    return HierarchyIndex.from_prefixes(codes.loc[codes.str.match(r"^[A-Z][0-9]")].to_numpy())
+
+
+@lru_cache(maxsize=None)
+def phecode_hierarchy() -> HierarchyIndex:
+    """
+    Returns the phecode prefix hierarchy, covering both the codes of the ehr_diagnosis_phecodes
+    lookup (e.g. 250.2) and the prefixed codes of the icd10_to_phecodes mapper (e.g. PHECODE_250.2).
+    Every lookup code is also added with the prefix, so both forms have the same tree.
+    """
+    lookup = load_lookup("ehr_diagnosis_phecodes")["coding"].astype(str)
+    codes = np.concatenate(
+        [
+            lookup.to_numpy(),
+            (PHECODE_PREFIX + lookup).to_numpy(),
+            load_mapper("icd10_to_phecodes")["phecode"].to_numpy(),
+        ]
+    )
+    return HierarchyIndex.from_prefixes(codes)
@@ -0,0 +1,195 @@
+"""
+Manifest of the final directory, written by ukbb_parser and read by the loaders.
+"""
+import base64
+import hashlib
+import json
+import logging
+from functools import lru_cache
+from os.path import join as pjoin
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ukbb_loaders.utilities.filesystem import get_filesystem
+from ukbb_loaders.utilities.tombstones import TOMBSTONES_NAME, Tombstones
+from ukbb_loaders.utilities.tracing import span
+from ukbb_loaders.utilities.util import LOOKUP_PATH, MAPPERS_PATH
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MANIFEST_NAME = "manifest.json"
+# Bumped whenever the layout of the final directory changes in a way older loaders cannot read
+FORMAT_VERSION = 2
+
+
+class Manifest:
+    def __init__(self, content: dict):
+        """
+        The manifest of a final directory.
+
+        It lists every table with its schema, row count, eid range, row group layout, size and
+        checksum, together with its parquet footer, so tables can be read without first fetching
+        their footers.
+
+        Args:
+            content (dict): The decoded manifest.json.
+        """
+        self.content = content
+        self.format_version = content["format_version"]
+        self.code_dictionary_version = content.get("code_dictionary_version")
+        self.tables: Dict[str, dict] = content["tables"]
+        # The withdrawals recorded since the tables were derived, see ukbb_loaders.utilities.tombstones
+        self.tombstones: Optional[dict] = content.get("tombstones")
+        self._metadata: Dict[str, pq.FileMetaData] = {}
+
+    @classmethod
+    def load(cls, data_dir: str) -> Optional["Manifest"]:
+        """
+        Loads the manifest of a final directory, or returns None for directories written before
+        manifests existed.
+
+        Raises:
+            ValueError: If the directory was written in a format this version cannot read.
+        """
+        path = pjoin(data_dir, MANIFEST_NAME)
+        try:
+            with get_filesystem(path).open(path, "rb") as f:
+                content = json.load(f)
+        except FileNotFoundError:
+            logger.warning(f"No {MANIFEST_NAME} found in {data_dir}, tables are not validated.")
+            return None
+
+        if content.get("format_version") != FORMAT_VERSION:
+            raise ValueError(
+                f"{data_dir} was written in format version {content.get('format_version')}, but this version "
+                f"of ukbb_loaders reads format version {FORMAT_VERSION}. Re-run update_data.py or upgrade ukbb_loaders."
+            )
+        manifest = cls(content)
+        if manifest.code_dictionary_version != code_dictionary_version():
+            logger.warning(
+                f"{data_dir} was derived with different lookups than the ones bundled with this version of "
+                "ukbb_loaders, so some codes may have no meaning."
+            )
+        return manifest
+
+    def missing(self, file_names: List[str]) -> List[str]:
+        """
+        Returns the given tables that are not listed in the manifest.
+        """
+        return [file_name for file_name in file_names if file_name not in self.tables]
+
+    def verify(self, data_dir: str, checksums: bool = False) -> List[str]:
+        """
+        Checks the tables of a final directory against the manifest, with a single listing of the
+        directory, and optionally by recomputing their checksums.
+
+        Args:
+            data_dir (str): The final directory the manifest was loaded from.
+            checksums (bool): Whether to read every table to compare its checksum.
+        Returns:
+            (list): A description of every problem found. Empty if the directory is complete.
+        """
+        fs = get_filesystem(data_dir)
+        sizes = {
+            entry["name"].rstrip("/").split("/")[-1]: entry["size"] for entry in fs.ls(data_dir, detail=True)
+        }
+        problems = []
+        for file_name, table in sorted(self.tables.items()):
+            if file_name not in sizes:
+                problems.append(f"{file_name} is missing.")
+            elif sizes[file_name] != table["size"]:
+                problems.append(f"{file_name} has {sizes[file_name]} bytes instead of {table['size']}.")
+            elif checksums and describe_table(pjoin(data_dir, file_name))["checksum"] != table["checksum"]:
+                problems.append(f"{file_name} does not match its checksum.")
+        if self.tombstones is not None and sizes.get(TOMBSTONES_NAME) != self.tombstones["size"]:
+            problems.append(f"{TOMBSTONES_NAME} is missing or has changed.")
+        return problems
+
+    def size(self, file_name: str) -> Optional[int]:
+        table = self.tables.get(file_name)
+        return None if table is None else table["size"]
+
+    def metadata(self, file_name: str) -> Optional[pq.FileMetaData]:
+        """
+        Returns the parquet metadata of a table, decoded from the footer stored in the manifest.
+        """
+        table = self.tables.get(file_name)
+        if table is None or "footer" not in table:
+            return None
+        with span("manifest_metadata", file=file_name, cache_hit=file_name in self._metadata):
+            if file_name not in self._metadata:
+                footer = base64.b64decode(table["footer"])
+                self._metadata[file_name] = pq.read_metadata(pa.BufferReader(b"PAR1" + footer))
+            return self._metadata[file_name]
+
+
+def describe_table(path: str) -> dict:
+    """
+    Describes a parquet file for the manifest: its schema, rows, eid range, row groups, size,
+    checksum and footer.
+    """
+    fs = get_filesystem(path)
+    checksum = hashlib.sha256()
+    with fs.open(path, "rb") as f:
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            checksum.update(block)
+        size = f.tell()
+        f.seek(size - 8)
+        footer_length = int.from_bytes(f.read(4), "little")
+        f.seek(size - footer_length - 8)
+        footer = f.read(footer_length + 8)
+
+    metadata = pq.read_metadata(pa.BufferReader(b"PAR1" + footer))
+    schema = metadata.schema.to_arrow_schema()
+    names = [metadata.schema.column(i).name for i in range(metadata.num_columns)]
+    eid_position = names.index("eid") if "eid" in names else None
+
+    row_groups = []
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        entry = {"rows": row_group.num_rows, "bytes": row_group.total_byte_size}
+        if eid_position is not None:
+            statistics = row_group.column(eid_position).statistics
+            if statistics is not None and statistics.has_min_max:
+                entry.update(eid_min=int(statistics.min), eid_max=int(statistics.max))
+        row_groups.append(entry)
+    eid_mins = [row_group["eid_min"] for row_group in row_groups if "eid_min" in row_group]
+    eid_maxs = [row_group["eid_max"] for row_group in row_groups if "eid_max" in row_group]
+
+    return {
+        "rows": metadata.num_rows,
+        "size": size,
+        "checksum": f"sha256:{checksum.hexdigest()}",
+        "schema": {field.name: str(field.type) for field in schema},
+        "eid_min": min(eid_mins) if eid_mins else None,
+        "eid_max": max(eid_maxs) if eid_maxs else None,
+        "row_groups": row_groups,
+        "footer": base64.b64encode(footer).decode("ascii"),
+    }
+
+
+def describe_tombstones(data_dir: str) -> Optional[dict]:
+    """
+    Describes the tombstones of a final directory for the manifest, or returns None without any.
+    """
+    tombstones = Tombstones.load(data_dir)
+    if tombstones is None:
+        return None
+    path = pjoin(data_dir, TOMBSTONES_NAME)
+    return {"withdrawn": len(tombstones), "size": get_filesystem(path).size(path)}
+
+
+@lru_cache(maxsize=None)
+def code_dictionary_version() -> str:
+    """
+    Returns a hash of the bundled lookups and mappers, which the codes of the final tables are
+    resolved against.
+    """
+    digest = hashlib.sha1()
+    for path in sorted(list(LOOKUP_PATH.glob("*.parquet")) + list(MAPPERS_PATH.glob("*.parquet"))):
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()[:16]
@@ -0,0 +1,231 @@
+"""
+Vectorised application of the bundled ontology mappers.
+"""
+from functools import lru_cache
+from typing import Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from ukbb_loaders.utilities.util import load_mapper
+
+# The (source, target) code columns of each bundled mapper
+MAPPER_COLUMNS = {
+    "ac_to_opcs4": ("ukbiobank_procedures_self_reported_20004", "ehr_procedures_opcs4"),
+    "atc_child_to_parent": ("child", "parent"),
+    "icd10_to_mondo": ("icd10", "mondo"),
+    "icd10_to_phecodes": ("icd10_code", "phecode"),
+    "medications_to_atc": ("feature", "atc"),
+    "mondo_to_icd10": ("mondo", "icd10"),
+    "opcs3_to_opcs4": ("ehr_procedures_opcs3", "ehr_procedures_opcs4"),
+    "readcode_to_icd10": ("readcode", "icd10"),
+}
+
+
+class CompiledMapper:
+    def __init__(
+            self,
+            name: str,
+            source_codes: np.ndarray,
+            offsets: np.ndarray,
+            targets: np.ndarray,
+            target_codes: np.ndarray,
+            target_name: str,
+    ):
+        """
+        An ontology mapper compiled into integer code arrays.
+
+        The targets of the i-th source code are `target_codes[targets[offsets[i]:offsets[i + 1]]]`,
+        as in a CSR sparse matrix, so one-to-many mappings are applied by a single gather rather
+        than by a merge.
+
+        Args:
+            name (str): The name of the mapper, e.g. icd10_to_phecodes.
+            source_codes (np.ndarray): The unique codes mapped from.
+            offsets (np.ndarray): The start of the targets of each source code, plus the end.
+            targets (np.ndarray): The indices in `target_codes` of the targets of every source code.
+            target_codes (np.ndarray): The unique codes mapped to.
+            target_name (str): The name of the column the targets are written to by default.
+        """
+        self.name = name
+        self.source_codes = source_codes
+        self.offsets = offsets
+        self.targets = targets
+        self.target_codes = target_codes
+        self.target_name = target_name
+        self._source_index = pd.Index(source_codes)
+
+    @classmethod
+    def from_pairs(cls, name: str, sources: np.ndarray, targets: np.ndarray, target_name: str) -> "CompiledMapper":
+        """
+        Compiles a mapper from aligned arrays of source and target codes.
+        """
+        pairs = pd.DataFrame({"source": sources, "target": targets}).dropna().astype(str).drop_duplicates()
+        source_ids, source_codes = pd.factorize(pairs["source"], sort=True)
+        target_ids, target_codes = pd.factorize(pairs["target"], sort=True)
+        order = np.lexsort((target_ids, source_ids))
+        offsets = np.searchsorted(source_ids[order], np.arange(len(source_codes) + 1))
+        return cls(
+            name=name,
+            source_codes=np.asarray(source_codes, dtype=object),
+            offsets=offsets.astype(np.int64),
+            targets=target_ids[order].astype(np.int32),
+            target_codes=np.asarray(target_codes, dtype=object),
+            target_name=target_name,
+        )
+
+    def then(self, other: "CompiledMapper") -> "CompiledMapper":
+        """
+        Composes this mapper with another one, e.g. read2 -> icd10 with icd10 -> phecode.
+        """
+        # Position of each of our target codes among the source codes of the other mapper
+        middle = other.lookup(self.target_codes)[self.targets]
+        entries, next_targets = other._expand(middle)
+        sources = np.repeat(np.arange(len(self.source_codes)), np.diff(self.offsets))[entries]
+        pairs = np.unique(np.stack([sources, next_targets]), axis=1)
+        offsets = np.searchsorted(pairs[0], np.arange(len(self.source_codes) + 1))
+        return CompiledMapper(
+            name=f"{self.name}->{other.name}",
+            source_codes=self.source_codes,
+            offsets=offsets.astype(np.int64),
+            targets=pairs[1].astype(np.int32),
+            target_codes=other.target_codes,
+            target_name=other.target_name,
+        )
+
+    def lookup(self, codes: np.ndarray) -> np.ndarray:
+        """
+        Returns the position of each code among the source codes, or -1 if it is not mapped.
+        """
+        return self._source_index.get_indexer(pd.Index(codes).astype(str))
+
+    def map_codes(self, codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Maps an array of codes.
+
+        Args:
+            codes (np.ndarray): The codes to map.
+        Returns:
+            (np.ndarray, np.ndarray): For every mapped (code, target) pair, the position of the code
+                in `codes` and the index of the target in `target_codes`.
+        """
+        code_ids, uniques = pd.factorize(np.asarray(codes))
+        positions = np.where(code_ids >= 0, self.lookup(uniques)[code_ids], -1)
+        return self._expand(positions)
+
+    def apply(
+            self,
+            data: Union[pd.DataFrame, pa.Table],
+            column: str = "feature",
+            target_column: str = None,
+            keep_unmapped: bool = False,
+    ) -> Union[pd.DataFrame, pa.Table]:
+        """
+        Maps a column of a DataLoader result or an Arrow table.
+
+        Rows are repeated once per target of their code, so one-to-many mappings keep every target.
+
+        Args:
+            data (pd.DataFrame or pa.Table): The data holding the codes to map.
+            column (str): The column holding the codes to map.
+            target_column (str): The column the mapped codes are written to. Defaults to the target
+                name of the mapper, e.g. phecode.
+            keep_unmapped (bool): Whether to keep rows whose code has no mapping, with a missing
+                target. Defaults to dropping them.
+        Returns:
+            (pd.DataFrame or pa.Table): The mapped rows with the mapped codes as a categorical column.
+
+        Example:
+            Map the ICD10 diagnoses of all patients to phecodes:
+            >>> get_mapper("icd10_to_phecodes").apply(dl.get_hospital_data("icd10"))
+        """
+        target_column = target_column or self.target_name
+        if isinstance(data, pa.Table):
+            codes = data.column(column).combine_chunks()
+            if pa.types.is_dictionary(codes.type):
+                codes = codes.cast(codes.type.value_type)
+            encoded = pc.dictionary_encode(codes)
+            positions = self.lookup(encoded.dictionary.to_numpy(zero_copy_only=False))
+            indices = encoded.indices.fill_null(-1).to_numpy()
+            positions = np.where(indices >= 0, positions[indices], -1)
+        else:
+            code_ids, uniques = pd.factorize(data[column].to_numpy())
+            positions = np.where(code_ids >= 0, self.lookup(uniques)[code_ids], -1)
+
+        rows, targets = self._expand(positions, keep_unmapped=keep_unmapped)
+        if isinstance(data, pa.Table):
+            mapped = pa.DictionaryArray.from_arrays(
+                pa.array(targets, mask=targets < 0, type=pa.int32()), pa.array(self.target_codes, type=pa.string())
+            )
+            data = data.take(pa.array(rows))
+            if target_column in data.column_names:
+                data = data.drop([target_column])
+            return data.append_column(target_column, mapped)
+
+        data = data.iloc[rows].copy()
+        data[target_column] = pd.Categorical.from_codes(targets, categories=self.target_codes)
+        return data
+
+    def _expand(self, positions: np.ndarray, keep_unmapped: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Expands source code positions into (row, target) pairs with one vectorised gather.
+        """
+        mapped = positions >= 0
+        safe = np.where(mapped, positions, 0)
+        counts = np.where(mapped, self.offsets[safe + 1] - self.offsets[safe], 0)
+        if keep_unmapped:
+            counts = np.where(counts == 0, 1, counts)
+        rows = np.repeat(np.arange(len(positions)), counts)
+        # Index of each output row within the targets of its source row
+        within = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        entries = self.offsets[safe[rows]] + within
+        has_target = (within < np.diff(self.offsets)[safe[rows]]) & mapped[rows]
+        targets = np.where(has_target, self.targets[np.minimum(entries, len(self.targets) - 1)], -1)
+        return rows, targets.astype(np.int32)
+
+
+@lru_cache(maxsize=None)
+def get_mapper(mapper_name: str) -> CompiledMapper:
+    """
+    Loads and compiles a bundled ontology mapper, compiling each mapper only once.
+
+    Args:
+        mapper_name (str): The name of the mapper, one of the keys of MAPPER_COLUMNS.
+    Returns:
+        (CompiledMapper): The compiled mapper.
+
+    Example:
+        >>> get_mapper("icd10_to_phecodes")
+        Returns the compiled mapping from ICD10 codes to Phecodes.
+    """
+    if mapper_name not in MAPPER_COLUMNS:
+        raise ValueError(f"The mapper_name argument should be one of {list(MAPPER_COLUMNS)}")
+    source, target = MAPPER_COLUMNS[mapper_name]
+    df = load_mapper(mapper_name)
+    return CompiledMapper.from_pairs(
+        name=mapper_name, sources=df[source].to_numpy(), targets=df[target].to_numpy(), target_name=target
+    )
+
+
+@lru_cache(maxsize=None)
+def get_chain(*mapper_names: str) -> CompiledMapper:
+    """
+    Compiles a chain of mappers into a single mapper, compiling each chain only once.
+
+    Args:
+        mapper_names (str): The names of the mappers to apply, in order.
+    Returns:
+        (CompiledMapper): The composed mapper.
+
+    Example:
+        >>> get_chain("readcode_to_icd10", "icd10_to_phecodes")
+        Returns the compiled mapping from Readcodes to Phecodes through ICD10.
+    """
+    if not mapper_names:
+        raise ValueError("At least one mapper name should be given.")
+    mapper = get_mapper(mapper_names[0])
+    for mapper_name in mapper_names[1:]:
+        mapper = mapper.then(get_mapper(mapper_name))
+    return mapper
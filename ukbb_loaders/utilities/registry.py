@@ -0,0 +1,93 @@
+"""
+Registry of the bundled lookups and mappers.
+"""
+from functools import lru_cache
+from typing import List, Union
+
+import numpy as np
+import pandas as pd
+
+from ukbb_loaders.utilities.util import LOOKUP_PATH, MAPPERS_PATH, _read_cached
+
+
+class LookupRegistry:
+    """
+    Registry of the lookups listed in `parent_lookup.parquet` and of the bundled mappers.
+
+    Decoded tables are memoised and shared, and code -> meaning lookups go through a hash index
+    built once per lookup.
+    """
+
+    def lookups(self, config_use: bool = None) -> pd.DataFrame:
+        """
+        Lists the bundled lookups with their descriptions.
+
+        Args:
+            config_use (bool): If given, only list the lookups that can (or cannot) be used in a
+                disease config.
+        Returns:
+            (pd.DataFrame): The rows of the parent lookup whose lookup file is bundled.
+        """
+        df = _read_cached(LOOKUP_PATH / "parent_lookup.parquet")
+        df = df.loc[[(LOOKUP_PATH / f"{name}.parquet").exists() for name in df["lookup"]]]
+        if config_use is not None:
+            df = df.loc[df["config_use"] == config_use]
+        return df.reset_index(drop=True)
+
+    def mappers(self) -> List[str]:
+        """
+        Lists the names of the bundled mappers.
+        """
+        return sorted(path.stem for path in MAPPERS_PATH.glob("*.parquet"))
+
+    def lookup(self, lookup_name: str) -> pd.DataFrame:
+        """
+        Returns a lookup table, shared between callers and therefore not to be modified.
+        """
+        _check_name(lookup_name, self.lookups()["lookup"].tolist(), "lookup_name")
+        return _read_cached(LOOKUP_PATH / f"{lookup_name}.parquet")
+
+    def mapper(self, mapper_name: str) -> pd.DataFrame:
+        """
+        Returns a mapper table, shared between callers and therefore not to be modified.
+        """
+        _check_name(mapper_name, self.mappers(), "mapper_name")
+        return _read_cached(MAPPERS_PATH / f"{mapper_name}.parquet")
+
+    def meaning(self, lookup_name: str, codes: Union[str, List[str], np.ndarray]) -> np.ndarray:
+        """
+        Looks up the meaning of codes.
+
+        Args:
+            lookup_name (str): The lookup the codes belong to, e.g. ehr_diagnosis_icd10.
+            codes (str or list): The codes to look up.
+        Returns:
+            (np.ndarray): The meaning of each code, None for unknown codes. Codes listed several
+                times in a lookup get the meaning of their first row.
+
+        Example:
+            >>> registry.meaning("ehr_diagnosis_icd10", ["N181", "E11"])
+        """
+        index, meanings = _meaning_index(self, lookup_name)
+        positions = index.get_indexer(pd.Index(np.atleast_1d(np.asarray(codes, dtype=object))).astype(str))
+        return np.where(positions >= 0, meanings[np.maximum(positions, 0)], None)
+
+
+@lru_cache(maxsize=None)
+def _meaning_index(registry: LookupRegistry, lookup_name: str):
+    """
+    Builds the hash index from codes to meanings of a lookup.
+    """
+    df = registry.lookup(lookup_name)
+    if not {"coding", "meaning"}.issubset(df.columns):
+        raise ValueError(f"The {lookup_name} lookup has no coding and meaning columns.")
+    df = df.loc[~df["coding"].astype(str).duplicated()]
+    return pd.Index(df["coding"].astype(str)), df["meaning"].to_numpy(dtype=object)
+
+
+def _check_name(name: str, accepted: List[str], arg_type: str):
+    if name not in accepted:
+        raise ValueError(f"The {arg_type} argument should be one of {accepted}")
+
+
+registry = LookupRegistry()
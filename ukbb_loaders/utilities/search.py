@@ -0,0 +1,242 @@
+"""
+Indexed keyword and code search across the bundled lookups.
+"""
+import hashlib
+import logging
+import os
+import re
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ukbb_loaders import __version__
+from ukbb_loaders.utilities.registry import registry
+from ukbb_loaders.utilities.util import LOOKUP_PATH
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CACHE_DIR = Path(os.environ.get("UKBB_LOADERS_CACHE", Path.home() / ".cache" / "ukbb_loaders"))
+# Bumped whenever the layout of the cached index changes, so older caches are rebuilt
+INDEX_FORMAT = 2
+# The columns of the entries of the index, and its arrays, as cached on disk
+ENTRY_COLUMNS = ["lookups", "codings", "meanings", "occurrences", "normalised"]
+INDEX_ARRAYS = ["vocabulary", "postings", "offsets", "code_order"]
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+class LookupSearch:
+    def __init__(self, lookups: List[str]):
+        """
+        Keyword and code prefix search over lookup tables.
+
+        Meanings are split into lowercase tokens and indexed in a sorted vocabulary with CSR
+        postings, so each query token, matched as a prefix, resolves to a contiguous slice of
+        postings. Codes are kept sorted, so a code prefix is a single range.
+
+        Args:
+            lookups (list): The lookups to index. They need `coding` and `meaning` columns.
+        """
+        frames = []
+        for lookup_name in lookups:
+            df = registry.lookup(lookup_name)
+            frames.append(
+                pd.DataFrame(
+                    {
+                        "lookup": lookup_name,
+                        "coding": df["coding"].astype(str).to_numpy(),
+                        "meaning": df["meaning"].fillna("").astype(str).to_numpy(),
+                        "occurrence": df["occurrence"].to_numpy() if "occurrence" in df else 0,
+                    }
+                )
+            )
+        entries = pd.concat(frames, ignore_index=True).drop_duplicates(["lookup", "coding", "meaning"])
+        self.lookups = np.asarray(entries["lookup"], dtype=object)
+        self.codings = np.asarray(entries["coding"], dtype=object)
+        self.meanings = np.asarray(entries["meaning"], dtype=object)
+        self.occurrences = entries["occurrence"].to_numpy(dtype=np.int64)
+
+        # Token inverted index
+        tokens = [_TOKEN.findall(meaning.lower()) for meaning in self.meanings]
+        entry_ids = np.repeat(np.arange(len(tokens)), [len(t) for t in tokens])
+        self.normalised = np.asarray([" ".join(t) for t in tokens], dtype=object)
+        token_ids, self.vocabulary = pd.factorize(
+            np.concatenate([np.asarray(t, dtype=object) for t in tokens]), sort=True
+        )
+        pairs = np.unique(np.stack([token_ids, entry_ids]), axis=1)
+        self.vocabulary = np.asarray(self.vocabulary, dtype=object)
+        self.postings = pairs[1]
+        self.offsets = np.searchsorted(pairs[0], np.arange(len(self.vocabulary) + 1))
+
+        # Code prefix index
+        self.code_order = np.argsort(self.codings, kind="stable")
+        self.sorted_codings = self.codings[self.code_order]
+
+    def save(self, entries_path: Path, arrays_path: Path):
+        """
+        Writes the index as plain arrays: the entries to the parquet file `entries_path` and the
+        token and code indexes to the npz file `arrays_path`.
+        """
+        pd.DataFrame({column: getattr(self, column) for column in ENTRY_COLUMNS}).to_parquet(
+            entries_path, index=False
+        )
+        arrays = {name: getattr(self, name) for name in INDEX_ARRAYS}
+        arrays["vocabulary"] = arrays["vocabulary"].astype(str)
+        with open(arrays_path, "wb") as f:
+            np.savez(f, format=np.int64(INDEX_FORMAT), **arrays)
+
+    @classmethod
+    def load(cls, entries_path: Path, arrays_path: Path) -> "LookupSearch":
+        """
+        Reads an index written by `save`.
+
+        Raises:
+            ValueError: If the files were written in another index format.
+        """
+        with np.load(arrays_path, allow_pickle=False) as arrays:
+            if "format" not in arrays or int(arrays["format"]) != INDEX_FORMAT:
+                raise ValueError(f"{arrays_path} was not written in index format {INDEX_FORMAT}.")
+            index = {name: arrays[name] for name in INDEX_ARRAYS}
+        entries = pd.read_parquet(entries_path, columns=ENTRY_COLUMNS)
+        search = cls.__new__(cls)
+        for column in ENTRY_COLUMNS:
+            values = entries[column].to_numpy()
+            setattr(search, column, values.astype(np.int64) if column == "occurrences" else values.astype(object))
+        search.vocabulary = index["vocabulary"].astype(object)
+        search.postings, search.offsets, search.code_order = index["postings"], index["offsets"], index["code_order"]
+        search.sorted_codings = search.codings[search.code_order]
+        return search
+
+    def search_text(self, query: str, limit: int = 20) -> pd.DataFrame:
+        """
+        Finds the lookup entries whose meaning contains every query token, each as a word prefix.
+
+        Hits are ranked by the number of query tokens matched as whole words, then by whether the
+        meaning contains the query as a phrase, then by how often the code occurs in UKBB.
+        """
+        return self._hits(*self._text_matches(query), limit=limit)
+
+    def search_code(self, prefix: str, limit: int = 20) -> pd.DataFrame:
+        """
+        Finds the lookup entries whose code starts with the given prefix. Exact codes rank first.
+        """
+        return self._hits(*self._code_matches(prefix), limit=limit)
+
+    def search(self, query: str, limit: int = 20) -> pd.DataFrame:
+        """
+        Searches the lookups by code prefix and by keywords, code matches ranking first.
+
+        Args:
+            query (str): A code prefix (e.g. N18) or keywords (e.g. chronic kidney).
+            limit (int): The maximum number of hits to return.
+        Returns:
+            (pd.DataFrame): The ranked hits, with the lookup, coding, meaning and score of each.
+
+        Example:
+            >>> get_search().search("chronic kidney")
+        """
+        code_matches, code_scores = self._code_matches(query.strip())
+        text_matches, text_scores = self._text_matches(query)
+        matches = np.concatenate([code_matches, text_matches])
+        scores = np.concatenate([code_scores + 100, text_scores])
+        # Entries matching both ways keep their code score, which comes first
+        matches, first = np.unique(matches, return_index=True)
+        return self._hits(matches, scores[first], limit=limit)
+
+    def _text_matches(self, query: str) -> Tuple[np.ndarray, np.ndarray]:
+        tokens = _TOKEN.findall(query.lower())
+        if not tokens:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+
+        matches = None
+        exact = []
+        for token in tokens:
+            start, stop = _prefix_range(self.vocabulary, token)
+            entries = np.unique(self.postings[self.offsets[start]: self.offsets[stop]])
+            matches = entries if matches is None else np.intersect1d(matches, entries, assume_unique=True)
+            if start < stop and self.vocabulary[start] == token:
+                exact.append(self.postings[self.offsets[start]: self.offsets[start + 1]])
+
+        scores = np.full(len(matches), len(tokens), dtype=np.int64)
+        for postings in exact:
+            scores += 2 * np.isin(matches, postings, assume_unique=True)
+        if len(tokens) > 1:
+            phrase = " ".join(tokens)
+            scores += [phrase in meaning for meaning in self.normalised[matches]]
+        return matches, scores
+
+    def _code_matches(self, prefix: str) -> Tuple[np.ndarray, np.ndarray]:
+        start, stop = _prefix_range(self.sorted_codings, prefix)
+        matches = self.code_order[start:stop]
+        return matches, np.where(self.codings[matches] == prefix, 2, 1)
+
+    def _hits(self, matches: np.ndarray, scores: np.ndarray, limit: int) -> pd.DataFrame:
+        order = np.lexsort((self.occurrences[matches] * -1, -scores))[:limit]
+        matches = matches[order]
+        return pd.DataFrame(
+            {
+                "lookup": self.lookups[matches],
+                "coding": self.codings[matches],
+                "meaning": self.meanings[matches],
+                "score": np.asarray(scores, dtype=np.int64)[order],
+            }
+        )
+
+
+@lru_cache(maxsize=None)
+def get_search(lookups: tuple = None) -> LookupSearch:
+    """
+    Returns the search index over the given lookups, by default all lookups flagged `config_use`
+    in the parent lookup.
+
+    The index is built once and cached on disk under CACHE_DIR (overridable through the
+    UKBB_LOADERS_CACHE environment variable) as plain arrays, keyed by the package version, the
+    index format and the lookup files. Caches that cannot be read are rebuilt.
+
+    Args:
+        lookups (tuple): The names of the lookups to search.
+    Returns:
+        (LookupSearch): The search index.
+    """
+    if lookups is None:
+        lookups = tuple(registry.lookups(config_use=True)["lookup"])
+    stats = [(name, (LOOKUP_PATH / f"{name}.parquet").stat()) for name in lookups]
+    key = hashlib.sha1(
+        repr(
+            [__version__, INDEX_FORMAT] + [(name, stat.st_size, stat.st_mtime_ns) for name, stat in stats]
+        ).encode()
+    ).hexdigest()
+    entries_path = CACHE_DIR / f"search_index_{key}.parquet"
+    arrays_path = CACHE_DIR / f"search_index_{key}.npz"
+
+    if arrays_path.exists() and entries_path.exists():
+        try:
+            return LookupSearch.load(entries_path, arrays_path)
+        except Exception:
+            logger.warning(f"Could not read the search index cache {arrays_path}, rebuilding it.")
+
+    search = LookupSearch(list(lookups))
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Every process writes its own temporary files, so concurrent first builds do not race
+        temp_entries_path = CACHE_DIR / f".search_index_{key}.{os.getpid()}.parquet"
+        temp_arrays_path = CACHE_DIR / f".search_index_{key}.{os.getpid()}.npz"
+        search.save(temp_entries_path, temp_arrays_path)
+        # The arrays are moved into place last, as the cache is only read when both files exist
+        os.replace(temp_entries_path, entries_path)
+        os.replace(temp_arrays_path, arrays_path)
+    except OSError:
+        logger.warning(f"Could not write the search index cache to {CACHE_DIR}.")
+    return search
+
+
+def _prefix_range(values: np.ndarray, prefix: str):
+    """
+    Returns the [start, stop) range of the sorted values starting with the prefix.
+    """
+    start = np.searchsorted(values, prefix, side="left")
+    stop = np.searchsorted(values, prefix + "\U0010ffff", side="left")
+    return int(start), int(stop)
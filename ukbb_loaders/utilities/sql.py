@@ -0,0 +1,100 @@
+"""
+SQL over the final directory and the bundled lookups and mappers, with DuckDB.
+"""
+import logging
+import re
+from os.path import join as pjoin
+from typing import Dict
+
+import pyarrow as pa
+
+from ukbb_loaders.utilities.filesystem import get_filesystem, is_s3
+from ukbb_loaders.utilities.tombstones import Tombstones
+from ukbb_loaders.utilities.util import LOOKUP_PATH, MAPPERS_PATH
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Suffix of the inverted code indexes, which are not registered as views
+CODE_INDEX_SUFFIX = ".code_index.parquet"
+
+
+def connect(data_dir: str, threads: int = None, memory_limit: str = None, temp_directory: str = None):
+    """
+    Opens an in-memory DuckDB database with a view over every parquet file of a final directory,
+    named after the file, e.g. ehr_diagnosis_icd10, and over every bundled lookup and mapper,
+    prefixed with lookup_ and mapper_, e.g. mapper_icd10_to_phecodes.
+
+    Views read the parquet files as they are queried, so queries run multi-threaded and spill to
+    `temp_directory` rather than materialising the tables. Eids are an ordinary eid column, and the
+    patients withdrawn since the tables were derived, recorded as tombstones, are left out of them.
+    DuckDB is only imported here, as it is an optional dependency: pip install ukbiobank_loaders[sql].
+
+    Args:
+        data_dir (str): The local or s3 path of the final directory. s3 paths are read through
+            the shared filesystem, so they use the options given to `filesystem.configure`.
+        threads (int): The number of threads of DuckDB. Defaults to the number of CPUs.
+        memory_limit (str): The memory DuckDB may use before spilling to disk, e.g. "8GB".
+        temp_directory (str): Where DuckDB spills. Defaults to a directory next to the database.
+    Returns:
+        (duckdb.DuckDBPyConnection): The connection.
+
+    Example:
+        >>> con = connect("<OUTPUT_DIR_FOLDER>/final")
+        >>> con.sql("SELECT feature, count(DISTINCT eid) AS n FROM ehr_diagnosis_icd10 GROUP BY feature").df()
+    """
+    try:
+        import duckdb
+    except ImportError:
+        raise ImportError("SQL queries need duckdb. Install it with pip install ukbiobank_loaders[sql].") from None
+
+    con = duckdb.connect(":memory:")
+    for setting, value in [("threads", threads), ("memory_limit", memory_limit), ("temp_directory", temp_directory)]:
+        if value is not None:
+            con.execute(f"SET {setting} = '{value}'")
+    if is_s3(data_dir):
+        con.register_filesystem(get_filesystem(data_dir))
+
+    withdrawn = ""
+    tombstones = Tombstones.load(data_dir)
+    if tombstones is not None:
+        # A table rather than a registered Arrow object, so the cursors of the connection see it
+        con.register("withdrawn", pa.table({"eid": tombstones.eids()}))
+        con.execute("CREATE TABLE withdrawn_eids AS SELECT eid FROM withdrawn")
+        con.unregister("withdrawn")
+        withdrawn = " WHERE eid NOT IN (SELECT eid FROM withdrawn_eids)"
+
+    final_tables, bundled_tables = _final_tables(data_dir), _bundled_tables()
+    for view, path in sorted(final_tables.items()):
+        con.execute(f"CREATE VIEW {view} AS SELECT * FROM read_parquet('{_quote(path)}'){withdrawn}")
+    for view, path in sorted(bundled_tables.items()):
+        con.execute(f"CREATE VIEW {view} AS SELECT * FROM read_parquet('{_quote(path)}')")
+    views = {**final_tables, **bundled_tables}
+    logger.info(f"Registered {len(views)} views over {data_dir} and the bundled lookups and mappers.")
+    return con
+
+
+def _final_tables(data_dir: str) -> Dict[str, str]:
+    fs = get_filesystem(data_dir)
+    views = {}
+    for path in fs.ls(data_dir, detail=False):
+        file_name = path.rstrip("/").split("/")[-1]
+        if file_name.endswith(".parquet") and not file_name.endswith(CODE_INDEX_SUFFIX):
+            views[_view_name(file_name)] = pjoin(data_dir, file_name)
+    return views
+
+
+def _bundled_tables() -> Dict[str, str]:
+    views = {}
+    for prefix, directory in [("lookup", LOOKUP_PATH), ("mapper", MAPPERS_PATH)]:
+        for path in directory.glob("*.parquet"):
+            views[f"{prefix}_{_view_name(path.name)}"] = str(path)
+    return views
+
+
+def _view_name(file_name: str) -> str:
+    return re.sub(r"\W", "_", file_name[: -len(".parquet")])
+
+
+def _quote(path: str) -> str:
+    return path.replace("'", "''")
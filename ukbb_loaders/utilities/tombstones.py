@@ -0,0 +1,94 @@
+"""
+Tombstones of the patients who withdrew consent after the final directory was derived.
+
+The eids are stored as a bitmap next to the final tables, and the loaders drop their rows from
+every read, so a new withdrawal list takes effect without reprocessing. ukbb_parser's withdraw.py
+writes the bitmap, and later rewrites the affected tables without those rows.
+"""
+import logging
+from os.path import join as pjoin
+from typing import Optional
+
+import numpy as np
+
+from ukbb_loaders.utilities.filesystem import get_filesystem
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TOMBSTONES_NAME = "tombstones.npz"
+
+
+class Tombstones:
+    def __init__(self, offset: int, bits: np.ndarray):
+        """
+        A bitmap of withdrawn eids, where bit i of `bits` is set if eid `offset` + i withdrew.
+
+        UKBB eids span a few million consecutive values, so the bitmap of every participant takes
+        well under a megabyte, and checking eids against it is a vectorised lookup.
+
+        Args:
+            offset (int): The eid of the first bit.
+            bits (np.ndarray): The bitmap, packed into uint8 with np.packbits.
+        """
+        self.offset = int(offset)
+        self.bits = np.asarray(bits, dtype=np.uint8)
+
+    @classmethod
+    def from_eids(cls, eids: np.ndarray) -> "Tombstones":
+        """
+        Builds the bitmap of the given eids.
+        """
+        eids = np.unique(np.asarray(eids, dtype=np.int64))
+        if len(eids) == 0:
+            return cls(0, np.array([], dtype=np.uint8))
+        flags = np.zeros(eids[-1] - eids[0] + 1, dtype=bool)
+        flags[eids - eids[0]] = True
+        return cls(eids[0], np.packbits(flags))
+
+    @classmethod
+    def load(cls, data_dir: str) -> Optional["Tombstones"]:
+        """
+        Loads the tombstones of a final directory, or returns None if no patient was withdrawn
+        since it was derived.
+        """
+        path = pjoin(data_dir, TOMBSTONES_NAME)
+        try:
+            with get_filesystem(path).open(path, "rb") as f:
+                content = np.load(f)
+                return cls(content["offset"], content["bits"])
+        except FileNotFoundError:
+            return None
+
+    def write(self, f):
+        """
+        Writes the bitmap to an open binary file.
+        """
+        np.savez_compressed(f, offset=np.int64(self.offset), bits=self.bits)
+
+    def eids(self) -> np.ndarray:
+        """
+        Returns the sorted withdrawn eids.
+        """
+        return np.flatnonzero(np.unpackbits(self.bits)).astype(np.int64) + self.offset
+
+    def union(self, eids: np.ndarray) -> "Tombstones":
+        """
+        Returns the tombstones of these eids and of the given ones.
+        """
+        return Tombstones.from_eids(np.concatenate([self.eids(), np.asarray(eids, dtype=np.int64)]))
+
+    def withdrawn(self, eids: np.ndarray) -> np.ndarray:
+        """
+        Returns whether each of the given eids withdrew, as a boolean array.
+        """
+        eids = np.asarray(eids, dtype=np.int64)
+        positions = eids - self.offset
+        inside = (positions >= 0) & (positions < len(self.bits) * 8)
+        if not inside.any():
+            return inside
+        positions = np.where(inside, positions, 0)
+        return inside & (((self.bits[positions >> 3] >> (7 - (positions & 7))) & 1) == 1)
+
+    def __len__(self) -> int:
+        return int(np.unpackbits(self.bits).sum())
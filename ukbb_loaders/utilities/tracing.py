@@ -0,0 +1,152 @@
+"""
+Optional tracing of DataLoader queries, one structured span per phase.
+"""
+import itertools
+import time
+from contextvars import ContextVar
+from typing import Callable, List, Optional
+
+import pandas as pd
+
+_current: ContextVar[Optional["Trace"]] = ContextVar("ukbb_loaders_trace", default=None)
+# The innermost open span. Being a context variable, concurrent queries of an AsyncDataLoader or of
+# several threads each nest their spans under their own parents.
+_current_span: ContextVar[Optional["_Span"]] = ContextVar("ukbb_loaders_span", default=None)
+
+
+class Trace:
+    def __init__(self, callback: Callable[[dict], None] = None):
+        """
+        Collects the spans of the queries run while it is active.
+
+        Args:
+            callback (callable): Called with the record of every span as it finishes, e.g. to send
+                it to a logging or metrics system.
+        """
+        self.callback = callback
+        self.spans: List[dict] = []
+        self._ids = itertools.count()
+        self._token = None
+
+    def __enter__(self) -> "Trace":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _current.reset(self._token)
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Returns the finished spans, in the order they started, with their attributes as columns.
+
+        Example:
+            >>> with trace() as t:
+            ...     dl.get_hospital_data("icd10", patient_list=eids)
+            >>> t.summary()[["name", "depth", "duration_ms", "rows_before", "rows_after"]]
+        """
+        if not self.spans:
+            return pd.DataFrame(columns=["id", "parent", "depth", "name", "start", "duration_ms"])
+        df = pd.DataFrame([{**span.pop("attributes"), **span} for span in map(dict, self.spans)])
+        first = ["id", "parent", "depth", "name", "start", "duration_ms"]
+        return df.sort_values("id")[first + [c for c in df.columns if c not in first]].reset_index(drop=True)
+
+    def _finish(self, record: dict):
+        self.spans.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+
+class _Span:
+    __slots__ = ("trace", "name", "attributes", "id", "parent", "depth", "start", "_token")
+
+    def __init__(self, trace: Trace, name: str, attributes: dict):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        """
+        Adds attributes to the span, e.g. the number of rows once they are known.
+        """
+        self.attributes.update(attributes)
+
+    def __enter__(self) -> "_Span":
+        parent = _current_span.get()
+        if parent is not None and parent.trace is not self.trace:
+            parent = None
+        self.id = next(self.trace._ids)
+        self.parent = None if parent is None else parent.id
+        self.depth = 0 if parent is None else parent.depth + 1
+        self._token = _current_span.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *_):
+        duration = time.perf_counter() - self.start
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.trace._finish(
+            {
+                "id": self.id,
+                "parent": self.parent,
+                "depth": self.depth,
+                "name": self.name,
+                "start": self.start,
+                "duration_ms": duration * 1000,
+                "attributes": self.attributes,
+            }
+        )
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name: str, **attributes):
+    """
+    Opens a span of the active trace. Without an active trace this returns a shared no-op span, so
+    instrumented code pays a single context variable lookup.
+
+    Example:
+        >>> with span("decode", file=path) as s:
+        ...     table = parquet_file.read_row_groups(row_groups)
+        ...     s.set(rows=table.num_rows)
+    """
+    trace = _current.get()
+    if trace is None:
+        return _NOOP
+    return _Span(trace, name, attributes)
+
+
+def trace(callback: Callable[[dict], None] = None) -> Trace:
+    """
+    Traces the DataLoader queries run inside the returned context manager.
+
+    Args:
+        callback (callable): Called with the record of every span as it finishes.
+    Returns:
+        (Trace): The trace, whose spans are available after the block.
+
+    Example:
+        >>> with trace() as t:
+        ...     dl.get_hospital_data("icd10")
+        >>> t.summary()
+    """
+    return Trace(callback=callback)
+
+
+def is_tracing() -> bool:
+    return _current.get() is not None
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from pathlib import Path
 
 import pandas as pd
@@ -10,6 +11,8 @@ def load_lookup(lookup_name: str) -> pd.DataFrame:
     """
     Loads lookup table.
 
+    The decoded table is memoised, so only the first call reads the parquet file.
+
     Args:
         lookup_name (str): The name of the lookup table to be loaded.
 
@@ -21,12 +24,14 @@ def load_lookup(lookup_name: str) -> pd.DataFrame:
         Returns the lookup table containing ICD10 diagnosis information.
     """
 
-    return pd.read_parquet(LOOKUP_PATH / f"{lookup_name}.parquet")
+    return _read_cached(LOOKUP_PATH / f"{lookup_name}.parquet").copy()
 
 def load_mapper(mapper_name: str) -> pd.DataFrame:
     """
     Loads ontology mapper.
 
+    The decoded table is memoised, so only the first call reads the parquet file.
+
     Args:
         mapper_name (str): The name of the mapper to be loaded.
 
@@ -38,4 +43,11 @@ def load_mapper(mapper_name: str) -> pd.DataFrame:
         Returns the mapping from ICD10 codes to Phecodes.
     """
 
-    return pd.read_parquet(MAPPERS_PATH / f"{mapper_name}.parquet")
+    return _read_cached(MAPPERS_PATH / f"{mapper_name}.parquet").copy()
+
+@lru_cache(maxsize=None)
+def _read_cached(path: Path) -> pd.DataFrame:
+    """
+    Reads a bundled parquet file once. Callers must not modify the returned frame.
+    """
+    return pd.read_parquet(path)
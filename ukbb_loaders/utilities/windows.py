@@ -0,0 +1,179 @@
+"""
+Index-date-relative windowed aggregation of coded events.
+"""
+from typing import Iterable, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+# Date columns returned by the DataLoader getters, in order of preference
+DATE_COLUMNS = [
+    "date_of_visit",
+    "date_of_issue",
+    "date_of_measurement",
+    "date_of_death",
+    "date_of_first_occurrence",
+    "date",
+]
+
+
+class Window(NamedTuple):
+    """
+    A window of days relative to each patient's index date. Both ends are inclusive and
+    negative values lie before the index date, e.g. Window("5y_before", -5 * 365, -1).
+    """
+
+    name: str
+    start: int
+    end: int
+
+
+def aggregate_windows(
+        df: pd.DataFrame,
+        index_dates: pd.Series,
+        windows: Iterable[Union[Window, Tuple[str, int, int]]],
+        codes: Optional[Iterable[str]] = None,
+        date_col: Optional[str] = None,
+        keep_empty: bool = False,
+) -> pd.DataFrame:
+    """
+    Aggregates coded events per (patient, code, window) relative to each patient's index date.
+
+    Events are sorted once by (eid, feature, date) and every window boundary is resolved with a
+    single vectorised searchsorted over the sorted keys, so no cartesian join between events and
+    windows is ever materialised.
+
+    Args:
+        df (pd.DataFrame): A long canonical dataframe as returned by the DataLoader getters, with
+            patients as the index and a `feature` column.
+        index_dates (pd.Series): The index date of every patient, indexed by eid. Patients without
+            an index date are ignored.
+        windows (list): The windows to aggregate over, as Window objects or (name, start, end)
+            tuples of days relative to the index date.
+        codes (list): The codes to aggregate. Defaults to all codes in `df`.
+        date_col (str): The column holding the event dates. Inferred from the getter output
+            if not given.
+        keep_empty (bool): Whether to keep (patient, code, window) combinations with no events.
+            Only codes a patient has at least one dated event for are considered.
+    Returns:
+        df (pd.DataFrame): A long dataframe with patients as the index and the following columns:
+            - feature: the code being aggregated
+            - window: the name of the window
+            - count: the number of events within the window
+            - exists: whether there is at least one event within the window
+            - first_date: the date of the first event within the window
+            - last_date: the date of the last event within the window
+
+    Example:
+        Flag any N18 code in the five years before baseline:
+        >>> df = dl.get_hospital_data("icd10")
+        >>> aggregate_windows(df.loc[df["feature"].str.startswith("N18")], baseline_dates,
+        ...                   [Window("5y_before", -5 * 365, -1)])
+    """
+    windows = [Window(*window) for window in windows]
+    for window in windows:
+        if window.start > window.end:
+            raise ValueError(f"The window {window.name} starts after it ends.")
+    if index_dates.index.has_duplicates:
+        raise ValueError("The index_dates argument should have one date per patient.")
+    date_col = date_col or _infer_date_column(df)
+
+    # Keep dated events of the requested codes for patients with an index date
+    index_dates = index_dates.dropna()
+    mask = df[date_col].notna().to_numpy() & df.index.isin(index_dates.index)
+    if codes is not None:
+        mask &= df["feature"].isin(list(codes)).to_numpy()
+    eids = df.index.to_numpy()[mask]
+    days = _to_days(df[date_col].to_numpy()[mask])
+    feature_codes, features = pd.factorize(df["feature"].to_numpy()[mask], sort=True)
+    # Events without a code are factorized to -1, which would take the last code
+    coded = feature_codes >= 0
+    eids, days, feature_codes = eids[coded], days[coded], feature_codes[coded]
+
+    if len(eids) == 0:
+        return _empty_result(df.index.name)
+
+    # Sort events by (eid, feature, date) and label each (eid, feature) group
+    order = np.lexsort((days, feature_codes, eids))
+    eids, feature_codes, days = eids[order], feature_codes[order], days[order]
+    new_group = np.empty(len(eids), dtype=bool)
+    new_group[0] = True
+    new_group[1:] = (eids[1:] != eids[:-1]) | (feature_codes[1:] != feature_codes[:-1])
+    group_starts = np.flatnonzero(new_group)
+    group_ids = np.cumsum(new_group) - 1
+
+    # Encode (group, day) into a single monotonically increasing key
+    day_min = days.min()
+    span = np.int64(days.max() - day_min + 1)
+    keys = group_ids * span + (days - day_min)
+    group_eids = eids[group_starts]
+    group_features = features.take(feature_codes[group_starts])
+    group_index_days = _to_days(index_dates.loc[group_eids].to_numpy()) - day_min
+    group_offsets = np.arange(len(group_starts), dtype=np.int64) * span
+
+    results: List[pd.DataFrame] = []
+    for window in windows:
+        # Window bounds are clipped to the group's key range so they never leak into neighbours
+        lower = np.clip(group_index_days + window.start, 0, span)
+        upper = np.clip(group_index_days + window.end, -1, span - 1)
+        left = np.searchsorted(keys, group_offsets + lower, side="left")
+        right = np.searchsorted(keys, group_offsets + upper, side="right")
+        count = np.maximum(right - left, 0)
+        exists = count > 0
+        first = np.where(exists, days[np.minimum(left, len(days) - 1)], np.iinfo(np.int64).min)
+        last = np.where(exists, days[np.maximum(right - 1, 0)], np.iinfo(np.int64).min)
+
+        keep = slice(None) if keep_empty else exists
+        results.append(
+            pd.DataFrame(
+                {
+                    "eid": group_eids[keep],
+                    "feature": group_features[keep],
+                    "window": window.name,
+                    "count": count[keep],
+                    "exists": exists[keep],
+                    "first_date": _from_days(first[keep]),
+                    "last_date": _from_days(last[keep]),
+                }
+            )
+        )
+
+    return pd.concat(results, ignore_index=True).set_index("eid").rename_axis(df.index.name)
+
+
+def _infer_date_column(df: pd.DataFrame) -> str:
+    """
+    Returns the date column of a DataLoader getter output.
+    """
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            return col
+    raise ValueError(f"Could not infer the date column, please pass one of {list(df.columns)}.")
+
+
+def _to_days(dates: np.ndarray) -> np.ndarray:
+    """
+    Converts datetimes to int64 days since the epoch.
+    """
+    return dates.astype("datetime64[D]").astype(np.int64)
+
+
+def _from_days(days: np.ndarray) -> pd.DatetimeIndex:
+    """
+    Converts int64 days since the epoch to datetimes. The int64 minimum is numpy's NaT.
+    """
+    return pd.to_datetime(days.astype("datetime64[D]").astype("datetime64[ns]"))
+
+
+def _empty_result(index_name: Optional[str]) -> pd.DataFrame:
+    df = pd.DataFrame(
+        {
+            "feature": pd.Series(dtype=object),
+            "window": pd.Series(dtype=object),
+            "count": pd.Series(dtype=np.int64),
+            "exists": pd.Series(dtype=bool),
+            "first_date": pd.Series(dtype="datetime64[ns]"),
+            "last_date": pd.Series(dtype="datetime64[ns]"),
+        }
+    )
+    return df.rename_axis(index_name)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Seeded generator of synthetic UKBB raw files, for testing and benchmarking the pipeline without
+access to real UKBB data.
+"""
+import argparse
+import logging
+import os
+from functools import lru_cache
+from os.path import join as pjoin
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ukbb_loaders.utilities.util import load_lookup, load_mapper
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s:%(lineno)d - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Columns of each raw file, in the order of the UKBB record-level extracts
+RAW_COLUMNS = {
+    "hesin.txt": ["eid", "ins_index", "dsource", "source", "epistart", "epiend", "admidate"],
+    "hesin_diag.txt": ["eid", "ins_index", "arr_index", "level", "diag_icd9", "diag_icd9_nb", "diag_icd10", "diag_icd10_nb"],
+    "hesin_oper.txt": ["eid", "ins_index", "arr_index", "level", "opdate", "oper3", "oper3_nb", "oper4", "oper4_nb"],
+    "death.txt": ["eid", "ins_index", "dsource", "source", "date_of_death"],
+    "death_cause.txt": ["eid", "ins_index", "arr_index", "level", "cause_icd10"],
+    "gp_clinical.txt": ["eid", "data_provider", "event_dt", "read_2", "read_3", "value1", "value2", "value3"],
+    "gp_scripts.txt": ["eid", "data_provider", "issue_date", "read_2", "bnf_code", "dmd_code", "drug_name", "quantity"],
+}
+WITHDRAWN_FILE = "withdrawn_consent.txt"
+
+# Placeholder dates used by UKBB for unknown, pre-birth and future GP event dates
+SENTINEL_DATES = ["01/01/1900", "01/01/1901", "02/02/1902", "03/03/1903", "07/07/2037"]
+
+# Cardinalities, roughly matching the UKBB extracts
+HES_EPISODES_PER_PARTICIPANT = 8.0
+SECONDARY_DIAGNOSES_PER_EPISODE = 2.5
+OPERATIONS_PER_EPISODE = 0.9
+DEATH_RATE = 0.07
+SECONDARY_CAUSES_PER_DEATH = 2.0
+GP_COVERAGE = 0.45
+GP_EVENTS_PER_PARTICIPANT = 500.0
+GP_SCRIPTS_PER_PARTICIPANT = 250.0
+WITHDRAWN_RATE = 0.0003
+SENTINEL_RATE = 0.005
+MISSING_DATE_RATE = 0.01
+
+CHUNK_SIZE = 10_000
+_EPOCH = np.datetime64("1900-01-01")
+
+
+def get_args():
+    """
+    Parse arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out_dir", type=str, required=True, help="Directory where the raw files will be saved.")
+    parser.add_argument("--n_participants", type=int, default=1000, help="Number of participants to generate.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator.")
+    return parser.parse_args()
+
+
+def main(out_dir: str, n_participants: int = 1000, seed: int = 0) -> Dict[str, int]:
+    """
+    Generates the seven raw UKBB files and the withdrawn consent file.
+
+    Participants are generated in chunks, so memory stays flat from 1k up to 500k participants.
+    Codes are drawn from the bundled lookups, weighted by their occurrence in UKBB, and dates are
+    written day-first with UKBB's sentinel dates mixed in.
+
+    Args:
+        out_dir (str): The directory the files are written to.
+        n_participants (int): The number of participants.
+        seed (int): The seed of the random generator. The same seed gives the same files.
+    Returns:
+        (dict): The number of rows written to each file.
+
+    Example:
+        >>> main("/tmp/raw", n_participants=10_000, seed=42)
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    vocabulary = _vocabulary()
+    eids = np.sort(rng.choice(np.arange(1_000_000, 6_030_000), size=n_participants, replace=False))
+
+    rows = {file_name: 0 for file_name in RAW_COLUMNS}
+    for start in range(0, n_participants, CHUNK_SIZE):
+        logger.info(f"Generating participants {start} to {min(start + CHUNK_SIZE, n_participants)}.")
+        tables = _generate_chunk(rng, eids[start: start + CHUNK_SIZE], vocabulary)
+        for file_name, df in tables.items():
+            df[RAW_COLUMNS[file_name]].to_csv(
+                pjoin(out_dir, file_name), sep="\t", index=False, header=start == 0, mode="w" if start == 0 else "a"
+            )
+            rows[file_name] += len(df)
+
+    withdrawn = rng.choice(eids, size=max(1, int(n_participants * WITHDRAWN_RATE)), replace=False)
+    pd.Series(np.sort(withdrawn)).to_csv(pjoin(out_dir, WITHDRAWN_FILE), index=False, header=False)
+    rows[WITHDRAWN_FILE] = len(withdrawn)
+    return rows
+
+
+def _vocabulary() -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Returns the codes to draw from for each coding, with their sampling probabilities.
+    """
+    vocabulary = {}
+    for coding, lookup_name in [
+        ("icd9", "ehr_diagnosis_icd9"),
+        ("icd10", "ehr_diagnosis_icd10"),
+        ("opcs3", "ehr_procedures_opcs3"),
+        ("opcs4", "ehr_procedures_opcs4"),
+        ("read_2", "ehr_diagnosis_read2"),
+    ]:
+        df = load_lookup(lookup_name).drop_duplicates("coding")
+        vocabulary[coding] = _weighted(df["coding"].to_numpy(), df["occurrence"].to_numpy())
+
+    # No read3 or medication lookups are bundled, so their codes come from the mappers
+    read_2 = set(vocabulary["read_2"][0])
+    read_3 = np.array(sorted(set(load_mapper("readcode_to_icd10")["readcode"]) - read_2), dtype=object)
+    medications = np.array(sorted(load_mapper("medications_to_atc")["feature"].dropna().unique()), dtype=object)
+    vocabulary["read_3"] = _weighted(read_3, None)
+    vocabulary["medication"] = _weighted(medications, None)
+    return vocabulary
+
+
+def _weighted(codes: np.ndarray, occurrence: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns codes with sampling probabilities from their occurrence, smoothed so every code can
+    be drawn, or from a Zipf law over a fixed shuffle when occurrences are not known.
+    """
+    if occurrence is None:
+        ranks = np.random.default_rng(len(codes)).permutation(len(codes)) + 1
+        weights = 1.0 / ranks
+    else:
+        weights = np.asarray(occurrence, dtype=np.float64) + 0.1
+    return np.asarray(codes, dtype=object), weights / weights.sum()
+
+
+def _generate_chunk(rng: np.random.Generator, eids: np.ndarray, vocabulary: dict) -> Dict[str, pd.DataFrame]:
+    n = len(eids)
+    tables = {}
+
+    # Hospital episodes, over-dispersed across participants
+    episodes = _counts(rng, n, HES_EPISODES_PER_PARTICIPANT)
+    episode_eids = np.repeat(eids, episodes)
+    episode_index = _within(episodes)
+    epistart = rng.integers(_day(1985), _day(2022), size=len(episode_eids))
+    admidate = epistart - rng.integers(0, 4, size=len(epistart))
+    hesin = pd.DataFrame(
+        {
+            "eid": episode_eids,
+            "ins_index": episode_index,
+            "dsource": rng.choice(["HES", "SMR", "PEDW"], p=[0.88, 0.08, 0.04], size=len(epistart)),
+            "source": rng.integers(1, 10, size=len(epistart)),
+            "epistart": _format_dates(rng, epistart, missing_rate=0.03),
+            "epiend": _format_dates(rng, epistart + rng.integers(0, 15, size=len(epistart))),
+            "admidate": _format_dates(rng, admidate),
+        }
+    )
+    tables["hesin.txt"] = hesin
+
+    # One primary diagnosis per episode, secondary and external ones on top
+    diagnoses = 1 + rng.poisson(SECONDARY_DIAGNOSES_PER_EPISODE, size=len(epistart))
+    diag_episode = np.repeat(np.arange(len(epistart)), diagnoses)
+    arr_index = _within(diagnoses)
+    level = np.where(arr_index == 0, 1, np.where(rng.random(len(arr_index)) < 0.03, 3, 2))
+    # Older Scottish episodes are coded in ICD9
+    icd9 = (epistart[diag_episode] < _day(1996)) & (rng.random(len(diag_episode)) < 0.5)
+    icd9_codes = _draw(rng, vocabulary["icd9"], len(diag_episode))
+    icd10_codes = _draw(rng, vocabulary["icd10"], len(diag_episode))
+    tables["hesin_diag.txt"] = pd.DataFrame(
+        {
+            "eid": episode_eids[diag_episode],
+            "ins_index": episode_index[diag_episode],
+            "arr_index": arr_index,
+            "level": level,
+            "diag_icd9": np.where(icd9, icd9_codes, None),
+            "diag_icd9_nb": None,
+            "diag_icd10": np.where(icd9, None, icd10_codes),
+            "diag_icd10_nb": None,
+        }
+    )
+
+    # Operations, coded in OPCS3 before 1990
+    operations = rng.poisson(OPERATIONS_PER_EPISODE, size=len(epistart))
+    oper_episode = np.repeat(np.arange(len(epistart)), operations)
+    oper_index = _within(operations)
+    opcs3 = epistart[oper_episode] < _day(1990)
+    tables["hesin_oper.txt"] = pd.DataFrame(
+        {
+            "eid": episode_eids[oper_episode],
+            "ins_index": episode_index[oper_episode],
+            "arr_index": oper_index,
+            "level": np.where(oper_index == 0, 1, 2),
+            "opdate": _format_dates(rng, epistart[oper_episode], missing_rate=0.1),
+            "oper3": np.where(opcs3, _draw(rng, vocabulary["opcs3"], len(oper_episode)), None),
+            "oper3_nb": None,
+            "oper4": np.where(opcs3, None, _draw(rng, vocabulary["opcs4"], len(oper_episode))),
+            "oper4_nb": None,
+        }
+    )
+
+    # Deaths, a few of them recorded twice
+    died = eids[rng.random(n) < DEATH_RATE]
+    death_days = rng.integers(_day(2006), _day(2022), size=len(died))
+    duplicated = rng.random(len(died)) < 0.01
+    tables["death.txt"] = pd.DataFrame(
+        {
+            "eid": np.concatenate([died, died[duplicated]]),
+            "ins_index": np.concatenate([np.zeros(len(died), dtype=int), np.ones(duplicated.sum(), dtype=int)]),
+            "dsource": "E/W",
+            "source": 1,
+            "date_of_death": _format_dates(rng, np.concatenate([death_days, death_days[duplicated]]), missing_rate=0),
+        }
+    ).sort_values(["eid", "ins_index"])
+    causes = 1 + rng.poisson(SECONDARY_CAUSES_PER_DEATH, size=len(died))
+    cause_index = _within(causes)
+    tables["death_cause.txt"] = pd.DataFrame(
+        {
+            "eid": np.repeat(died, causes),
+            "ins_index": 0,
+            "arr_index": cause_index,
+            "level": np.where(cause_index == 0, 1, 2),
+            "cause_icd10": _draw(rng, vocabulary["icd10"], causes.sum()),
+        }
+    )
+
+    # Primary care, for the participants whose practice shared records
+    gp_eids = eids[rng.random(n) < GP_COVERAGE]
+    provider = rng.choice([1, 2, 3, 4], p=[0.35, 0.1, 0.5, 0.05], size=len(gp_eids))
+    events = _counts(rng, len(gp_eids), GP_EVENTS_PER_PARTICIPANT)
+    event_provider = np.repeat(provider, events)
+    # TPP practices record read3 codes, the others read2
+    tpp = event_provider == 3
+    values = np.where(rng.random(len(tpp)) < 0.15, np.round(rng.normal(80, 20, size=len(tpp)), 1).astype(str), None)
+    tables["gp_clinical.txt"] = pd.DataFrame(
+        {
+            "eid": np.repeat(gp_eids, events),
+            "data_provider": event_provider,
+            "event_dt": _format_dates(
+                rng, rng.integers(_day(1960), _day(2022), size=len(tpp)), missing_rate=0.003, sentinel_rate=SENTINEL_RATE
+            ),
+            "read_2": np.where(tpp, None, _draw(rng, vocabulary["read_2"], len(tpp))),
+            "read_3": np.where(tpp, _draw(rng, vocabulary["read_3"], len(tpp)), None),
+            "value1": values,
+            "value2": None,
+            "value3": None,
+        }
+    )
+
+    scripts = _counts(rng, len(gp_eids), GP_SCRIPTS_PER_PARTICIPANT)
+    tables["gp_scripts.txt"] = pd.DataFrame(
+        {
+            "eid": np.repeat(gp_eids, scripts),
+            "data_provider": np.repeat(provider, scripts),
+            "issue_date": _format_dates(
+                rng, rng.integers(_day(1990), _day(2022), size=scripts.sum()), sentinel_rate=SENTINEL_RATE / 5
+            ),
+            "read_2": None,
+            "bnf_code": None,
+            "dmd_code": None,
+            "drug_name": _draw(rng, vocabulary["medication"], scripts.sum()),
+            "quantity": rng.choice(["28 tablet", "56 tablet", "1 pack", "100 ml", "30 capsule"], size=scripts.sum()),
+        }
+    )
+    return tables
+
+
+def _counts(rng: np.random.Generator, n: int, mean: float) -> np.ndarray:
+    """
+    Draws over-dispersed (negative binomial) counts per participant with the given mean.
+    """
+    return rng.poisson(rng.gamma(shape=0.8, scale=mean / 0.8, size=n))
+
+
+def _within(counts: np.ndarray) -> np.ndarray:
+    """
+    Returns 0..count-1 for every group of the given sizes, concatenated.
+    """
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def _draw(rng: np.random.Generator, codes: Tuple[np.ndarray, np.ndarray], size: int) -> np.ndarray:
+    values, probabilities = codes
+    return values[rng.choice(len(values), size=size, p=probabilities)]
+
+
+@lru_cache(maxsize=None)
+def _date_strings() -> np.ndarray:
+    return pd.to_datetime(np.arange(_day(2040)), unit="D", origin="1900-01-01").strftime("%d/%m/%Y").to_numpy(dtype=object)
+
+
+def _day(year: int) -> int:
+    return int((np.datetime64(f"{year}-01-01") - _EPOCH).astype(int))
+
+
+def _format_dates(
+        rng: np.random.Generator, days: np.ndarray, missing_rate: float = MISSING_DATE_RATE, sentinel_rate: float = 0.0
+) -> np.ndarray:
+    """
+    Formats days since 1900 as dd/mm/yyyy, with missing and sentinel dates mixed in. Every day is
+    formatted once and then gathered, which is much faster than formatting each row.
+    """
+    dates = _date_strings()[days]
+    draws = rng.random(len(days))
+    dates[draws < sentinel_rate] = rng.choice(SENTINEL_DATES, size=int((draws < sentinel_rate).sum()))
+    dates[(draws >= sentinel_rate) & (draws < sentinel_rate + missing_rate)] = None
+    return dates
+
+
+if __name__ == "__main__":
+    args = get_args()
+    counts = main(out_dir=args.out_dir, n_participants=args.n_participants, seed=args.seed)
+    for file_name, count in counts.items():
+        logger.info(f"{file_name}: {count} rows")
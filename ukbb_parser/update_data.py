@@ -10,6 +10,13 @@ import ukbb_parser.updater.standardise_raw as standardise_raw
 import ukbb_parser.updater.derive_gp as derive_gp
 import ukbb_parser.updater.derive_hospital as derive_hospital
 import ukbb_parser.updater.derive_death as derive_death
+import ukbb_parser.updater.derive_first_occurrence as derive_first_occurrence
+import ukbb_parser.updater.delta as delta
+import ukbb_parser.updater.export_sequences as export_sequences
+import ukbb_parser.updater.manifest as manifest
+from ukbb_loaders.utilities.filesystem import get_filesystem
+from ukbb_parser.updater.checkpoint import Checkpoints, remove_temporary_files
+import ukbb_parser.updater.telemetry as telemetry
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s:%(lineno)d - %(levelname)s - %(message)s",
@@ -42,6 +49,29 @@ def get_args():
         required=True,
         help="Output directory where standardised files will be saved.",
     )
+    parser.add_argument(
+        "--statsd",
+        type=str,
+        default=None,
+        help="host:port of a StatsD daemon the telemetry of each stage is sent to.",
+    )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=None,
+        help="Number of processes parsing each large raw file. Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the stages completed by a previous, interrupted run with the same out_dir.",
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Only derive the patients whose records changed since the previous run with the same out_dir, "
+        "and merge them into its final tables.",
+    )
     return parser.parse_args()
 
 
@@ -50,17 +80,90 @@ if __name__ == "__main__":
 
     std_dir = pjoin(args.out_dir, "standardised")
     final_dir = pjoin(args.out_dir, "final")
+    sequences_dir = pjoin(args.out_dir, "sequences")
+    # In delta mode, the new release is standardised and its changed patients derived under <out_dir>/delta
+    delta_dir = pjoin(args.out_dir, "delta")
+    new_std_dir, changed_dir, delta_final_dir = (pjoin(delta_dir, name) for name in ["standardised", "changed", "final"])
     if not args.out_dir.startswith("s3://"):
         os.makedirs(std_dir, exist_ok=True)
         os.makedirs(final_dir, exist_ok=True)
+        if args.delta:
+            for directory in [new_std_dir, changed_dir, delta_final_dir]:
+                os.makedirs(directory, exist_ok=True)
+
+    # Per-stage telemetry is written to <out_dir>/telemetry.json as the run progresses
+    sinks = []
+    if args.statsd is not None:
+        host, port = args.statsd.rsplit(":", 1)
+        sinks.append(telemetry.statsd_sink(host=host, port=int(port)))
+    telemetry.telemetry.configure(report_path=pjoin(args.out_dir, "telemetry.json"), sinks=sinks)
+
+    # Each stage commits its outputs atomically and records its completion in <out_dir>/_checkpoints
+    for directory in [std_dir, final_dir, sequences_dir, new_std_dir, changed_dir, delta_final_dir]:
+        removed = remove_temporary_files(directory)
+        if removed:
+            logger.info(f"Removed {removed} partially written files from {directory}.")
+    checkpoints = Checkpoints(args.out_dir, resume=args.resume)
 
     script_dir = os.path.dirname(os.path.realpath(__file__))
-    try:
-        standardise_raw.main(raw_dir=args.raw_dir, std_dir=std_dir, withdrawn_file=args.withdrawn_file)
 
-        derive_gp.main(std_dir=std_dir, final_dir=final_dir)
-        derive_hospital.main(std_dir=std_dir, final_dir=final_dir)
-        derive_death.main(std_dir=std_dir, final_dir=final_dir)
+    try:
+        if args.delta:
+            checkpoints.run(
+                "delta.standardise_raw",
+                lambda: standardise_raw.main(
+                    raw_dir=args.raw_dir,
+                    std_dir=new_std_dir,
+                    withdrawn_file=args.withdrawn_file,
+                    n_workers=args.n_workers,
+                ),
+            )
+            checkpoints.run(
+                "delta.find_changes",
+                lambda: delta.find_changes(std_dir=std_dir, new_std_dir=new_std_dir, changed_dir=changed_dir),
+            )
+            if len(delta.load_changed_eids(changed_dir)) > 0:
+                checkpoints.run(
+                    "delta.derive_gp", lambda: derive_gp.main(std_dir=changed_dir, final_dir=delta_final_dir)
+                )
+                checkpoints.run(
+                    "delta.derive_hospital",
+                    lambda: derive_hospital.main(std_dir=changed_dir, final_dir=delta_final_dir),
+                )
+                checkpoints.run(
+                    "delta.derive_death", lambda: derive_death.main(std_dir=changed_dir, final_dir=delta_final_dir)
+                )
+                checkpoints.run(
+                    "delta.derive_first_occurrence",
+                    lambda: derive_first_occurrence.main(final_dir=delta_final_dir),
+                )
+                checkpoints.run(
+                    "delta.merge",
+                    lambda: delta.merge(final_dir=final_dir, delta_final_dir=delta_final_dir, changed_dir=changed_dir),
+                )
+            checkpoints.run(
+                "delta.replace_standardised",
+                lambda: delta.replace_standardised(std_dir=std_dir, new_std_dir=new_std_dir),
+            )
+        else:
+            checkpoints.run(
+                "standardise_raw",
+                lambda: standardise_raw.main(
+                    raw_dir=args.raw_dir, std_dir=std_dir, withdrawn_file=args.withdrawn_file, n_workers=args.n_workers
+                ),
+            )
+            checkpoints.run("derive_gp", lambda: derive_gp.main(std_dir=std_dir, final_dir=final_dir))
+            checkpoints.run("derive_hospital", lambda: derive_hospital.main(std_dir=std_dir, final_dir=final_dir))
+            checkpoints.run("derive_death", lambda: derive_death.main(std_dir=std_dir, final_dir=final_dir))
+            checkpoints.run("derive_first_occurrence", lambda: derive_first_occurrence.main(final_dir=final_dir))
+        checkpoints.run(
+            "export_sequences",
+            lambda: export_sequences.main(final_dir=final_dir, sequences_dir=sequences_dir),
+        )
+        checkpoints.run("manifest", lambda: manifest.main(final_dir=final_dir))
+        if args.delta:
+            get_filesystem(delta_dir).rm(delta_dir, recursive=True)
+        logger.info("Telemetry of the run:\n" + telemetry.summary(telemetry.telemetry.report()["stages"]))
     # Write trace of error
     except Exception:
         logger.error(traceback.format_exc())
@@ -0,0 +1,157 @@
+"""
+Checkpoints of the pre-processing pipeline, so an interrupted run can resume from the first
+incomplete stage.
+"""
+import json
+import logging
+import os
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from os.path import join as pjoin
+from typing import Callable, Dict, List, Optional
+
+from ukbb_loaders.utilities.filesystem import get_filesystem, is_s3
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CHECKPOINT_DIR = "_checkpoints"
+# Marks the files being written, so they are never mistaken for finished outputs
+TEMPORARY_MARKER = ".tmp-"
+
+# The outputs committed by the running stage
+_outputs: Optional[List[str]] = None
+
+
+@contextmanager
+def atomic_write(path: str):
+    """
+    Yields the path to write a file to, so that it only appears at `path` once fully written.
+
+    Local files are written to a hidden temporary file in the same directory and renamed into
+    place. Objects written to s3 only become visible once their upload completes, so they are
+    written in place.
+
+    Example:
+        >>> with atomic_write(path) as tmp_path:
+        ...     df.to_parquet(tmp_path)
+    """
+    if is_s3(path):
+        yield path
+    else:
+        directory, file_name = os.path.split(path)
+        tmp_path = pjoin(directory, f".{file_name}{TEMPORARY_MARKER}{uuid.uuid4().hex[:8]}")
+        try:
+            yield tmp_path
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    if _outputs is not None:
+        _outputs.append(path)
+
+
+def remove_temporary_files(directory: str) -> int:
+    """
+    Removes the temporary files left behind by an interrupted run.
+
+    Returns:
+        (int): The number of files removed.
+    """
+    fs = get_filesystem(directory)
+    if not fs.exists(directory):
+        return 0
+    paths = [path for path in fs.ls(directory, detail=False) if TEMPORARY_MARKER in path.rstrip("/").split("/")[-1]]
+    for path in paths:
+        fs.rm(path)
+    return len(paths)
+
+
+class Checkpoints:
+    def __init__(self, out_dir: str, resume: bool = False):
+        """
+        Records the completion of each stage of a run in <out_dir>/_checkpoints/<stage>.json, with
+        the size of every file the stage committed.
+
+        Args:
+            out_dir (str): The local or s3 output directory of the run.
+            resume (bool): Whether to skip the stages completed by a previous run. Otherwise the
+                checkpoints of previous runs are cleared and every stage runs.
+        """
+        self.checkpoint_dir = pjoin(out_dir, CHECKPOINT_DIR)
+        self.fs = get_filesystem(self.checkpoint_dir)
+        self.resume = resume
+        # Once a stage runs, the stages after it depend on its new outputs and run too
+        self._rerun = not resume
+        if not resume and self.fs.exists(self.checkpoint_dir):
+            self.fs.rm(self.checkpoint_dir, recursive=True)
+        if not is_s3(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+    def run(self, name: str, stage: Callable[[], None]):
+        """
+        Runs a stage, unless resuming and the stage completed with all of its outputs intact.
+
+        Example:
+            >>> checkpoints = Checkpoints(out_dir, resume=True)
+            >>> checkpoints.run("derive_gp", lambda: derive_gp.main(std_dir=std_dir, final_dir=final_dir))
+        """
+        if not self._rerun:
+            if self.is_complete(name):
+                logger.info(f"Skipping {name}, completed by a previous run.")
+                return
+            logger.info(f"Resuming from {name}.")
+            self._rerun = True
+
+        global _outputs
+        self._clear(name)
+        _outputs = []
+        try:
+            stage()
+            outputs = list(_outputs)
+        finally:
+            _outputs = None
+        self._commit(name, outputs)
+
+    def is_complete(self, name: str) -> bool:
+        """
+        Returns whether a stage completed and its outputs still have the sizes they were committed
+        with.
+        """
+        checkpoint = self.load(name)
+        if checkpoint is None:
+            return False
+        for path, size in checkpoint["outputs"].items():
+            fs = get_filesystem(path)
+            if not fs.exists(path) or fs.size(path) != size:
+                logger.warning(f"{path} has changed since {name} completed.")
+                return False
+        return True
+
+    def load(self, name: str) -> Optional[Dict]:
+        path = self._path(name)
+        try:
+            with self.fs.open(path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _commit(self, name: str, outputs: List[str]):
+        checkpoint = {
+            "stage": name,
+            "completed_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "outputs": {path: get_filesystem(path).size(path) for path in outputs},
+        }
+        with atomic_write(self._path(name)) as tmp_path:
+            with self.fs.open(tmp_path, "w") as f:
+                json.dump(checkpoint, f, indent=1)
+
+    def _clear(self, name: str):
+        path = self._path(name)
+        if self.fs.exists(path):
+            self.fs.rm(path)
+
+    def _path(self, name: str) -> str:
+        return pjoin(self.checkpoint_dir, f"{name}.json")
@@ -0,0 +1,300 @@
+"""
+Processing script to ingest a new UKBB release by only deriving the patients whose records changed.
+
+Every final table is derived patient by patient, so the rows of a patient only depend on their own
+standardised records. The new release is standardised next to the previous one, and a digest of
+every patient's records in each standardised file finds the patients with new episodes (new
+ins_index values), new GP records, or changed or removed records. Only their records are derived,
+into a delta final directory, and merged into the eid-sorted final tables: the row groups without
+any of their rows are copied unchanged, and only the row groups holding their eids are rebuilt.
+
+The delta directory holds:
+    - standardised: the new release, standardised, which replaces the previous one once merged
+    - changed: the records of the changed patients in the new release, and changed_eids.npy
+    - final: the final tables derived from the changed records
+"""
+import argparse
+import traceback
+from os.path import join as pjoin
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from ukbb_loaders.utilities.filesystem import get_filesystem, open_parquet, read_table
+from ukbb_parser.updater.checkpoint import atomic_write
+from ukbb_parser.updater.telemetry import record, record_written, telemetry
+from ukbb_parser.updater.utils import (
+    CODE_INDEX_SUFFIX,
+    FINAL_ROW_GROUP_SIZE,
+    init_logger,
+    write_code_index,
+)
+
+logger = init_logger(__name__)
+
+# The standardised files written by standardise_raw.py
+STANDARDISED_NAMES = ["hesin", "hesin_diag", "hesin_oper", "death_cause", "death", "gp_clinical", "gp_scripts"]
+CHANGED_EIDS_NAME = "changed_eids.npy"
+
+
+def find_changes(std_dir: str, new_std_dir: str, changed_dir: str) -> np.ndarray:
+    """
+    Finds the patients whose records differ between two standardised releases, and writes their
+    records in the new release, with their eids, to `changed_dir`.
+
+    Returns:
+        (np.ndarray): The sorted eids of the changed patients.
+    """
+    changed = []
+    for name in STANDARDISED_NAMES:
+        with telemetry.stage(f"delta.compare.{name}") as stage:
+            old_path, new_path = pjoin(std_dir, f"{name}.parquet"), pjoin(new_std_dir, f"{name}.parquet")
+            if not get_filesystem(old_path).exists(old_path):
+                raise ValueError(
+                    f"{std_dir} has no standardised {name} to compare the new release with. "
+                    "Run update_data.py without --delta first."
+                )
+            stage.read(old_path)
+            stage.read(new_path)
+            eids = changed_eids(old_path, new_path)
+            logger.info(f"{len(eids)} patients have new or changed {name} records.")
+            changed.append(eids)
+    changed = np.unique(np.concatenate(changed)).astype(np.int64)
+
+    fs = get_filesystem(changed_dir)
+    fs.makedirs(changed_dir, exist_ok=True)
+    with telemetry.stage("delta.subset") as stage:
+        for name in STANDARDISED_NAMES:
+            path = pjoin(new_std_dir, f"{name}.parquet")
+            stage.read(path)
+            rows = subset_patients(path, pjoin(changed_dir, f"{name}.parquet"), changed)
+            stage.add(rows_out=rows)
+        with atomic_write(pjoin(changed_dir, CHANGED_EIDS_NAME)) as tmp_path:
+            with fs.open(tmp_path, "wb") as f:
+                np.save(f, changed)
+    logger.info(f"{len(changed)} patients have new or changed records.")
+    return changed
+
+
+def load_changed_eids(changed_dir: str) -> np.ndarray:
+    """
+    Loads the eids of the changed patients written by `find_changes`.
+    """
+    path = pjoin(changed_dir, CHANGED_EIDS_NAME)
+    with get_filesystem(path).open(path, "rb") as f:
+        return np.load(f)
+
+
+def changed_eids(old_path: str, new_path: str) -> np.ndarray:
+    """
+    Returns the sorted eids whose records differ between two versions of a standardised file,
+    including the patients only found in one of them.
+
+    Each patient is summarised by their number of records and the sum of the hashes of their
+    records, which does not depend on the order of the records in the raw file.
+    """
+    old_columns, new_columns = _data_columns(old_path), _data_columns(new_path)
+    if sorted(old_columns) != sorted(new_columns):
+        logger.warning(f"The columns of {new_path} have changed, so all of its patients are compared as changed.")
+        old_eids, new_eids = _digests(old_path, ["eid"])[0], _digests(new_path, ["eid"])[0]
+        return np.union1d(old_eids, new_eids)
+
+    old_eids, old_counts, old_sums = _digests(old_path, new_columns)
+    new_eids, new_counts, new_sums = _digests(new_path, new_columns)
+    eids = np.union1d(old_eids, new_eids)
+    changed = np.zeros(len(eids), dtype=bool)
+    for old, new in [(old_counts, new_counts), (old_sums, new_sums)]:
+        changed |= _align(old_eids, old, eids) != _align(new_eids, new, eids)
+    return eids[changed]
+
+
+def _align(digest_eids: np.ndarray, values: np.ndarray, eids: np.ndarray) -> np.ndarray:
+    """
+    Returns the value of each of the given eids, 0 for the eids without a value.
+    """
+    positions = np.searchsorted(digest_eids, eids)
+    found = positions < len(digest_eids)
+    found[found] = digest_eids[positions[found]] == eids[found]
+    aligned = np.zeros(len(eids), dtype=values.dtype)
+    aligned[found] = values[positions[found]]
+    return aligned
+
+
+def _data_columns(path: str) -> List[str]:
+    """
+    Returns the columns of a parquet file, without the index written by pandas, which holds row
+    positions in the raw file rather than record content.
+    """
+    schema = open_parquet(path).schema_arrow
+    index_columns = (schema.pandas_metadata or {}).get("index_columns", [])
+    return [name for name in schema.names if name not in index_columns]
+
+
+def _digests(path: str, columns: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the sorted eids of a file, with their number of records and the sum of the hashes of
+    their records, reading one row group at a time.
+    """
+    parquet_file = open_parquet(path)
+    partial = []
+    for row_group in range(parquet_file.metadata.num_row_groups):
+        df = parquet_file.read_row_group(row_group, columns=columns).to_pandas()
+        hashes = pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+        partial.append(_reduce(df["eid"].to_numpy().astype(np.int64), np.ones(len(df), dtype=np.int64), hashes))
+    if not partial:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.uint64)
+    eids, counts, sums = (np.concatenate(arrays) for arrays in zip(*partial))
+    return _reduce(eids, counts, sums)
+
+
+def _reduce(eids: np.ndarray, counts: np.ndarray, sums: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Adds up the counts and hash sums of each eid, the sums wrapping around 2 ** 64.
+    """
+    if len(eids) == 0:
+        return eids, counts, sums.astype(np.uint64)
+    order = np.argsort(eids, kind="stable")
+    eids, counts, sums = eids[order], counts[order], sums[order].astype(np.uint64)
+    unique, starts = np.unique(eids, return_index=True)
+    return unique, np.add.reduceat(counts, starts), np.add.reduceat(sums, starts)
+
+
+def subset_patients(path: str, subset_path: str, eids: np.ndarray) -> int:
+    """
+    Writes the records of the given patients in a standardised file to `subset_path`, with the
+    schema of the file.
+
+    Returns:
+        (int): The number of records written.
+    """
+    parquet_file = open_parquet(path)
+    value_set = pa.array(eids, type=pa.int64())
+    rows = 0
+    with atomic_write(subset_path) as tmp_path:
+        with get_filesystem(tmp_path).open(tmp_path, "wb") as f, pq.ParquetWriter(f, parquet_file.schema_arrow) as writer:
+            for row_group in range(parquet_file.metadata.num_row_groups):
+                table = parquet_file.read_row_group(row_group)
+                table = table.filter(pc.is_in(table.column("eid").cast(pa.int64()), value_set=value_set))
+                writer.write_table(table)
+                rows += table.num_rows
+    return rows
+
+
+def merge(final_dir: str, delta_final_dir: str, changed_dir: str):
+    """
+    Replaces the rows of the changed patients in every final table by their rows derived from the
+    new release.
+    """
+    changed = load_changed_eids(changed_dir)
+    fs = get_filesystem(delta_final_dir)
+    file_names = sorted(
+        path.rstrip("/").split("/")[-1]
+        for path in fs.ls(delta_final_dir, detail=False)
+        if path.endswith(".parquet") and not path.endswith(CODE_INDEX_SUFFIX)
+    )
+    for file_name in file_names:
+        name = file_name[: -len(".parquet")]
+        with telemetry.stage(f"delta.merge.{name}") as stage:
+            path, delta_path = pjoin(final_dir, file_name), pjoin(delta_final_dir, file_name)
+            if not get_filesystem(path).exists(path):
+                raise ValueError(f"{final_dir} has no {file_name} to merge the new release into.")
+            stage.read(delta_path)
+            counters = merge_table(path, delta_path, changed)
+            stage.add(rows_in=counters["rows_in"])
+            logger.info(f"Rebuilt {counters['row_groups_rebuilt']} of the {counters['row_groups']} row groups of {name}.")
+            df = pd.read_parquet(path, columns=["feature"])
+            write_code_index(df=df, final_dir=final_dir, name=name)
+            record(rows_out=len(df))
+            record_written(path)
+            record_written(pjoin(final_dir, f"{name}{CODE_INDEX_SUFFIX}"))
+
+
+def merge_table(path: str, delta_path: str, changed: np.ndarray) -> dict:
+    """
+    Merges the rows of the changed patients into an eid-sorted final table, which stays sorted.
+
+    Final tables are written in row groups of a fixed number of rows, so the rows of a patient can
+    span consecutive row groups. Every row group whose eid range holds a changed eid drops the rows
+    of the changed patients. The new rows of a patient go to the first row group whose last eid is
+    at least theirs, or to the last row group, and that row group is sorted again by eid. The other
+    row groups are copied unchanged.
+
+    Returns:
+        (dict): The number of rows of the delta table, and the number of row groups of the table
+            and of row groups rebuilt.
+    """
+    parquet_file = open_parquet(path)
+    schema = parquet_file.schema_arrow
+    metadata = parquet_file.metadata
+    group_rows = np.array([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)], dtype=np.int64)
+    non_empty = np.flatnonzero(group_rows > 0)
+    eids = read_table(parquet_file, columns=["eid"]).column("eid").to_numpy()
+    group_ends = np.cumsum(group_rows)[non_empty]
+    group_firsts, group_lasts = eids[group_ends - group_rows[non_empty]], eids[group_ends - 1]
+
+    delta = pq.read_table(delta_path).select(schema.names).cast(schema)
+    delta_eids = delta.column("eid").to_numpy()
+    # The row group each new row goes to
+    delta_groups = np.minimum(np.searchsorted(group_lasts, delta_eids, side="left"), max(len(non_empty) - 1, 0))
+    # The row groups holding old rows of each changed eid are the range [first, last]
+    first = np.searchsorted(group_lasts, changed, side="left")
+    last = np.searchsorted(group_firsts, changed, side="right") - 1
+    holding = np.zeros(len(non_empty) + 1, dtype=np.int64)
+    spans = first <= last
+    np.add.at(holding, first[spans], 1)
+    np.add.at(holding, last[spans] + 1, -1)
+    rebuilt = np.cumsum(holding)[:-1] > 0
+    if len(non_empty):
+        rebuilt[delta_groups] = True
+    value_set = pa.array(changed, type=pa.int64())
+
+    with atomic_write(path) as tmp_path:
+        with get_filesystem(tmp_path).open(tmp_path, "wb") as f, pq.ParquetWriter(f, schema) as writer:
+            if not len(non_empty):
+                writer.write_table(_sort(delta), row_group_size=FINAL_ROW_GROUP_SIZE)
+            for position, row_group in enumerate(non_empty):
+                table = read_table(parquet_file, row_groups=[int(row_group)])
+                if rebuilt[position]:
+                    kept = pc.invert(pc.is_in(table.column("eid").cast(pa.int64()), value_set=value_set))
+                    new_rows = delta.take(pa.array(np.flatnonzero(delta_groups == position)))
+                    table = _sort(pa.concat_tables([table.filter(kept), new_rows]))
+                writer.write_table(table, row_group_size=FINAL_ROW_GROUP_SIZE)
+    return {"rows_in": delta.num_rows, "row_groups": len(non_empty), "row_groups_rebuilt": int(rebuilt.sum())}
+
+
+def _sort(table: pa.Table) -> pa.Table:
+    # A stable sort keeps the order of the rows of each patient
+    return table.take(pc.sort_indices(table, sort_keys=[("eid", "ascending")]))
+
+
+def replace_standardised(std_dir: str, new_std_dir: str):
+    """
+    Replaces the standardised files with those of the new release, which the next release is
+    compared with.
+    """
+    fs = get_filesystem(std_dir)
+    for name in STANDARDISED_NAMES:
+        fs.mv(pjoin(new_std_dir, f"{name}.parquet"), pjoin(std_dir, f"{name}.parquet"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--std_dir", type=str, required=True, help="The directory of the previous standardised files.")
+    parser.add_argument("--new_std_dir", type=str, required=True, help="The directory of the new standardised files.")
+    parser.add_argument("--changed_dir", type=str, required=True, help="The directory the changed records are written to.")
+    args = parser.parse_args()
+
+    # Run main bit of the function
+    try:
+        logger.info("Finding the patients with new or changed records.")
+        find_changes(std_dir=args.std_dir, new_std_dir=args.new_std_dir, changed_dir=args.changed_dir)
+        logger.info("The changed records have been written successfully.")
+
+    # Write trace of error
+    except Exception:
+        logger.error(traceback.format_exc())
+        raise
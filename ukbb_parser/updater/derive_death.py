@@ -1,14 +1,17 @@
 """
-Processing script to derive the final death registry files.
+Processing script to derive the final death registry file.
 """
 import argparse
 import logging
 import traceback
 from os.path import join as pjoin
 
+import numpy as np
 import pandas as pd
 
-from ukbb_parser.updater.utils import get_args, init_logger
+from ukbb_parser.updater import manifest
+from ukbb_parser.updater.telemetry import telemetry
+from ukbb_parser.updater.utils import get_args, init_logger, save_final_table
 
 logger = init_logger(__name__)
 
@@ -17,39 +20,75 @@ def main(std_dir: str, final_dir: str):
     """
     Load and format the death data.
     """
-    logger.info("Loading death causes.")
-    df = pd.read_parquet(pjoin(std_dir, "death_cause.parquet"))
-    df = df.rename({"cause_icd10": "feature"}, axis=1).drop(
-        columns=["ins_index", "arr_index"]
-    )
-    df = df.set_index("eid")
-
-    # Load death dates
-    logger.info("Loading death dates.")
-    df_dates = pd.read_parquet(pjoin(std_dir, "death.parquet"))
-    df_dates = (
-        df_dates[["eid", "date_of_death"]]
-        .drop_duplicates()
-        .set_index("eid")["date_of_death"]
-    )
-    df["date"] = df.index.map(df_dates)
-    df = df.reset_index().drop_duplicates().set_index("eid")
-    del df_dates
-
-    # Splitting into primary and secondary to match cohort.yaml
-    logger.info("Saving death_icd10_primary.")
-    df_primary = df.loc[df["level"] == 1, ["date", "feature"]]
-    df_primary.to_parquet(
-        pjoin(final_dir, "death_icd10_primary.parquet"),
-    )
+    with telemetry.stage("derive_death") as stage:
+        logger.info("Loading death causes.")
+        path = pjoin(std_dir, "death_cause.parquet")
+        stage.read(path)
+        df = pd.read_parquet(path, columns=["eid", "level", "cause_icd10"])
+        stage.add(rows_in=len(df))
 
-    logger.info("Saving death_icd10_secondary.")
-    df_secondary = df.loc[df["level"] == 2, ["date", "feature"]]
-    df_secondary.to_parquet(
-        pjoin(final_dir, "death_icd10_secondary.parquet"),
-    )
+        # Load death dates
+        logger.info("Loading death dates.")
+        path = pjoin(std_dir, "death.parquet")
+        stage.read(path)
+        df_dates = pd.read_parquet(path, columns=["eid", "date_of_death"])
 
-    del df, df_primary, df_secondary
+        df = derive_deaths(df, df_dates)
+        logger.info("Saving death_icd10.")
+        save_final_table(df, final_dir=final_dir, name="death_icd10")
+        del df, df_dates
+
+
+def derive_deaths(df: pd.DataFrame, df_dates: pd.DataFrame) -> pd.DataFrame:
+    """
+    Joins the causes of death to the dates of death with sorts and binary searches.
+
+    A patient can have several death records, e.g. when their death was registered in more than
+    one country. The earliest date of death is kept, as is a single row per cause and level.
+
+    Args:
+        df (pd.DataFrame): The standardised death causes, with eid, level and cause_icd10 columns.
+        df_dates (pd.DataFrame): The standardised death records, with eid and date_of_death columns.
+    Returns:
+        (pd.DataFrame): One row per patient, level and cause, sorted by eid, level and cause, with
+            eids as the index and the following columns:
+                - feature: the ICD10 cause of death
+                - date: the date of death, missing if the patient has no death record
+                - level: 1 for the primary cause and 2 for the secondary causes, as an int8
+    """
+    # The earliest date of every patient, missing dates sorting last
+    date_eids = df_dates["eid"].to_numpy().astype(np.int64)
+    dates = pd.to_datetime(df_dates["date_of_death"]).to_numpy()
+    order = np.lexsort((dates, np.isnat(dates), date_eids))
+    date_eids, dates = date_eids[order], dates[order]
+    date_eids, first = np.unique(date_eids, return_index=True)
+    dates = dates[first]
+
+    # A single row per (eid, level, cause)
+    codes, causes = pd.factorize(df["cause_icd10"], sort=True)
+    eids = df["eid"].to_numpy().astype(np.int64)
+    levels = df["level"].to_numpy().astype(np.int8)
+    keep = codes >= 0
+    eids, levels, codes = eids[keep], levels[keep], codes[keep]
+    order = np.lexsort((codes, levels, eids))
+    eids, levels, codes = eids[order], levels[order], codes[order]
+    starts = np.ones(len(eids), dtype=bool)
+    starts[1:] = (eids[1:] != eids[:-1]) | (levels[1:] != levels[:-1]) | (codes[1:] != codes[:-1])
+    eids, levels, codes = eids[starts], levels[starts], codes[starts]
+
+    # Patients without a death record get the trailing NaT
+    positions = np.searchsorted(date_eids, eids)
+    found = positions < len(date_eids)
+    found[found] = date_eids[positions[found]] == eids[found]
+    dates = np.append(dates.astype("datetime64[ns]"), np.datetime64("NaT", "ns"))
+    return pd.DataFrame(
+        {
+            "feature": pd.Categorical.from_codes(codes, categories=np.asarray(causes)),
+            "date": dates[np.where(found, positions, len(date_eids))],
+            "level": levels,
+        },
+        index=pd.Index(eids, name="eid"),
+    )
 
 
 if __name__ == "__main__":
@@ -59,6 +98,7 @@ if __name__ == "__main__":
     try:
         logger.info("Creating final death registry files.")
         main(std_dir=args.std_dir, final_dir=args.final_dir)
+        manifest.refresh(final_dir=args.final_dir)
         logger.info("All death registry files have been created successfully.")
 
     # Write trace of error
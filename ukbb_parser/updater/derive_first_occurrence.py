@@ -0,0 +1,131 @@
+"""
+Processing script to derive the first occurrence of every code for every patient.
+"""
+import argparse
+import traceback
+from os.path import join as pjoin
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from ukbb_loaders.utilities.mapping import get_mapper
+from ukbb_parser.updater import manifest
+from ukbb_parser.updater.telemetry import telemetry
+from ukbb_parser.updater.utils import init_logger, save_final_table
+
+logger = init_logger(__name__)
+
+# The final tables the first occurrences of each source are derived from
+FIRST_OCCURRENCE_SOURCES: Dict[str, List[str]] = {
+    "icd9": ["ehr_diagnosis_icd9"],
+    "icd10": ["ehr_diagnosis_icd10"],
+    "opcs3": ["ehr_procedures_opcs3"],
+    "opcs4": ["ehr_procedures_opcs4"],
+    "read_2": ["ehr_diagnosis_read2"],
+    "read_3": ["ehr_diagnosis_read3"],
+    "medication": ["gp_medications"],
+    "death": ["death_icd10"],
+}
+# The ontologies mapped to, with their mapper and the ICD10 tables they are mapped from
+FIRST_OCCURRENCE_ONTOLOGIES: Dict[str, Tuple[str, List[str]]] = {
+    "phecode": ("icd10_to_phecodes", ["ehr_diagnosis_icd10", "death_icd10"]),
+    "mondo": ("icd10_to_mondo", ["ehr_diagnosis_icd10", "death_icd10"]),
+}
+
+
+def main(final_dir: str):
+    """
+    Reduce the final tables of every source and mapped ontology to their first occurrences.
+    """
+    for name in FIRST_OCCURRENCE_SOURCES:
+        _derive_source(final_dir, name)
+    for name in FIRST_OCCURRENCE_ONTOLOGIES:
+        _derive_ontology(final_dir, name)
+
+
+def _derive_source(final_dir: str, name: str):
+    with telemetry.stage(f"derive_first_occurrence.{name}") as stage:
+        logger.info(f"Deriving the first occurrences of {name}.")
+        df = _read_events(final_dir, FIRST_OCCURRENCE_SOURCES[name], stage)
+        save_final_table(first_occurrence(df), final_dir=final_dir, name=f"first_occurrence_{name}")
+
+
+def _derive_ontology(final_dir: str, name: str):
+    mapper_name, tables = FIRST_OCCURRENCE_ONTOLOGIES[name]
+    with telemetry.stage(f"derive_first_occurrence.{name}") as stage:
+        logger.info(f"Deriving the first occurrences of {name} through {mapper_name}.")
+        df = get_mapper(mapper_name).apply(_read_events(final_dir, tables, stage), target_column="mapped")
+        df = df.drop(columns="feature").rename({"mapped": "feature"}, axis=1)
+        save_final_table(first_occurrence(df), final_dir=final_dir, name=f"first_occurrence_{name}")
+
+
+def first_occurrence(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reduces events to the earliest date of every (eid, feature) pair, with a sort rather than a
+    groupby: the events are sorted by eid, feature and date, and the first event of every run of
+    equal (eid, feature) is kept. Missing dates sort last, so a pair only has no date if none of its
+    events has one.
+
+    Args:
+        df (pd.DataFrame): Events with eids as the index and date and feature columns.
+    Returns:
+        (pd.DataFrame): One row per (eid, feature) pair, sorted by eid and feature, with eids as
+            the index and the following columns:
+                - feature: the code, as a categorical
+                - date: the date of its first occurrence
+                - count: the number of times it occurred
+    """
+    codes, categories = pd.factorize(df["feature"].astype("category").array, sort=True)
+    keep = codes >= 0
+    eids = df.index.to_numpy()[keep]
+    codes = codes[keep]
+    dates = pd.to_datetime(df["date"]).to_numpy()[keep]
+    days = dates.view(np.int64)
+    days = np.where(np.isnat(dates), np.iinfo(np.int64).max, days)
+
+    order = np.lexsort((days, codes, eids))
+    eids, codes = eids[order], codes[order]
+    starts = np.ones(len(eids), dtype=bool)
+    starts[1:] = (eids[1:] != eids[:-1]) | (codes[1:] != codes[:-1])
+    starts = np.flatnonzero(starts)
+    return pd.DataFrame(
+        {
+            "feature": pd.Categorical.from_codes(codes[starts], categories=np.asarray(categories)),
+            "date": dates[order[starts]],
+            "count": np.diff(np.r_[starts, len(order)]).astype(np.int32),
+        },
+        index=pd.Index(eids[starts], name="eid"),
+    )
+
+
+def _read_events(final_dir: str, tables: List[str], stage) -> pd.DataFrame:
+    df_list = []
+    for table in tables:
+        path = pjoin(final_dir, f"{table}.parquet")
+        stage.read(path)
+        df_list.append(pd.read_parquet(path, columns=["date", "feature"]))
+    # Shared categories keep the concatenated features categorical
+    categories = union_categoricals([df["feature"].astype("category") for df in df_list]).categories
+    df = pd.concat([df.assign(feature=df["feature"].astype(pd.CategoricalDtype(categories))) for df in df_list])
+    stage.add(rows_in=len(df))
+    return df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--final_dir", type=str, required=True, help="The directory of final derived files.")
+    args = parser.parse_args()
+
+    # Run main bit of the function
+    try:
+        logger.info("Creating first occurrence files.")
+        main(final_dir=args.final_dir)
+        manifest.refresh(final_dir=args.final_dir)
+        logger.info("All first occurrence files have been created successfully.")
+
+    # Write trace of error
+    except Exception:
+        logger.error(traceback.format_exc())
+        raise
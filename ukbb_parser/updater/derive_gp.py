@@ -5,38 +5,120 @@ import traceback
 from datetime import datetime
 from os.path import join as pjoin
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 
-from ukbb_parser.updater.utils import get_args, init_logger
+from ukbb_parser.updater import manifest
+from ukbb_parser.updater.telemetry import telemetry
+from ukbb_parser.updater.utils import get_args, init_logger, save_final_table
 
 logger = init_logger(__name__)
 
+# The columns of gp_clinical holding the values of measurements, e.g. the systolic and diastolic
+# blood pressures in value1 and value2
+VALUE_COLUMNS = ["value1", "value2", "value3"]
+# The codings of the read codes of gp_clinical, as named by the source column of the loaders
+READ_SOURCES = ["read_2", "read_3"]
+
 
 def main(std_dir: str, final_dir: str):
-    logger.info("Deriving read2/read3 diagnoses files.")
-    df = pd.read_parquet(pjoin(std_dir, "gp_clinical.parquet"))
-    df = df.rename({"event_dt": "date"}, axis=1)
-    for read_version in [2, 3]:
-        logger.info(f"Formatting read_{read_version}.")
-        df_new = df[["eid", "date", f"read_{read_version}"]].dropna().copy()
-        df_new = df_new.rename({f"read_{read_version}": "feature"}, axis=1)
-        df_new = df_new.drop_duplicates().set_index("eid")
-
-        # Save data
-        logger.info(f"Saving read_{read_version}.")
-        df_new.to_parquet(
-            pjoin(final_dir, f"ehr_diagnosis_read{read_version}.parquet"),
+    with telemetry.stage("derive_gp.diagnoses") as stage:
+        logger.info("Deriving read2/read3 diagnoses files.")
+        path = pjoin(std_dir, "gp_clinical.parquet")
+        stage.read(path)
+        clinical = pd.read_parquet(path)
+        stage.add(rows_in=len(clinical))
+        for read_version in [2, 3]:
+            logger.info(f"Formatting read_{read_version}.")
+            df_new = clinical[["eid", "event_dt", f"read_{read_version}"]].dropna()
+            df_new = df_new.rename({"event_dt": "date", f"read_{read_version}": "feature"}, axis=1)
+            df_new = df_new.drop_duplicates().set_index("eid")
+
+            # Save data
+            logger.info(f"Saving read_{read_version}.")
+            save_final_table(df_new, final_dir=final_dir, name=f"ehr_diagnosis_read{read_version}")
+            del df_new
+
+    # The measurements are derived from the gp_clinical records read for the diagnoses
+    with telemetry.stage("derive_gp.measurements") as stage:
+        logger.info("Deriving GP measurements.")
+        stage.add(rows_in=len(clinical))
+        df = derive_measurements(clinical)
+        del clinical
+
+        logger.info("Saving GP measurements.")
+        save_final_table(df, final_dir=final_dir, name="gp_measurements")
+        del df
+
+    with telemetry.stage("derive_gp.medications") as stage:
+        logger.info("Deriving GP medication data")
+        path = pjoin(std_dir, "gp_scripts.parquet")
+        stage.read(path)
+        df = pd.read_parquet(path)
+        stage.add(rows_in=len(df))
+        df = df.loc[df["issue_date"] <= datetime.now()]
+        df = df.rename({"issue_date": "date", "drug_name": "feature"}, axis=1)
+        df = df[["eid", "date", "feature"]].dropna().set_index("eid")
+
+        logger.info("Saving GP medication data")
+        save_final_table(df, final_dir=final_dir, name="gp_medications")
+
+
+def derive_measurements(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Extracts the numeric values of the gp_clinical records into a long table with one row per
+    value, dropping empty and non-numeric values.
+
+    Values repeat a lot, so only the distinct strings of each value column are parsed, and every
+    row then gathers its parsed value.
+
+    Args:
+        df (pd.DataFrame): The standardised gp_clinical records.
+    Returns:
+        (pd.DataFrame): A dataframe with eids as the index and the following columns:
+            - date: the date of the measurement
+            - feature: the read code of the record, read_2 if given and read_3 otherwise
+            - source: the coding of the read code, read_2 or read_3, as a categorical
+            - value: the value, as a float32
+            - slot: the value column the value was found in, from 1 to 3
+    """
+    # Read codes are combined on their categorical codes, without a string per row
+    read_2, read_3 = df["read_2"].astype("category"), df["read_3"].astype("category")
+    categories = union_categoricals([read_2, read_3]).categories
+    read_2, read_3 = (codes.cat.set_categories(categories).cat.codes.to_numpy() for codes in (read_2, read_3))
+    features = np.where(read_2 >= 0, read_2, read_3)
+    # The same code string can mean different things in read_2 and read_3, so the coding is kept
+    sources = np.where(read_2 >= 0, 0, 1).astype(np.int8)
+
+    frames = []
+    for slot, col in enumerate(VALUE_COLUMNS, start=1):
+        values = _parse_numbers(df[col])
+        keep = np.isfinite(values) & (features >= 0)
+        frames.append(
+            pd.DataFrame(
+                {
+                    "eid": df["eid"].to_numpy()[keep],
+                    "date": df["event_dt"].to_numpy()[keep],
+                    "feature": pd.Categorical.from_codes(features[keep], categories=categories),
+                    "source": pd.Categorical.from_codes(sources[keep], categories=READ_SOURCES),
+                    "value": values[keep],
+                    "slot": np.full(keep.sum(), slot, dtype=np.int8),
+                }
+            )
         )
-        del df_new
+    return pd.concat(frames, ignore_index=True).set_index("eid")
 
-    logger.info("Deriving GP medication data")
-    df = pd.read_parquet(pjoin(std_dir, "gp_scripts.parquet"))
-    df = df.loc[df["issue_date"] <= datetime.now()]
-    df = df.rename({"issue_date": "date", "drug_name": "feature"}, axis=1)
-    df = df[["eid", "date", "feature"]].dropna().set_index("eid")
 
-    logger.info("Saving GP medication data")
-    df.to_parquet(pjoin(final_dir, "gp_medications.parquet"))
+def _parse_numbers(values: pd.Series) -> np.ndarray:
+    """
+    Parses strings as float32, with NaN for missing and non-numeric strings.
+    """
+    codes, uniques = pd.factorize(values.to_numpy())
+    parsed = pd.to_numeric(pd.Series(uniques, dtype=object).astype(str).str.strip(), errors="coerce")
+    # Missing values have the code -1, which picks the trailing NaN
+    parsed = np.append(parsed.to_numpy(dtype=np.float32, na_value=np.nan), np.float32(np.nan))
+    return parsed[codes]
 
 
 if __name__ == "__main__":
@@ -46,6 +128,7 @@ if __name__ == "__main__":
     try:
         logger.info("Creating final GP files.")
         main(std_dir=args.std_dir, final_dir=args.final_dir)
+        manifest.refresh(final_dir=args.final_dir)
         logger.info("All GP files have been created successfully.")
 
     # Write trace of error
@@ -0,0 +1,212 @@
+"""
+Processing script to export every patient's time-ordered codes as packed sequences for training
+sequence models, read back with ukbb_loaders.loaders.sequences.SequenceReader.
+
+The sequences directory holds:
+    - eids.npy: the sorted eids of the patients with at least one event, as int64
+    - offsets.npy: where the events of each patient start in the flat arrays, with a final entry
+      for the total number of events, as int64
+    - tokens.npy: the token of every event, as int32
+    - days.npy: the day of every event, in days since 1970-01-01, or MISSING_DAY, as int32
+    - vocabulary.parquet: the source and code of every token, the token being the row number
+    - metadata.json: the format version and the number of patients and events
+"""
+import argparse
+import json
+import traceback
+from datetime import datetime, timezone
+from os.path import join as pjoin
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ukbb_loaders.utilities.filesystem import get_filesystem
+from ukbb_loaders.utilities.tombstones import Tombstones
+from ukbb_loaders.utilities.util import load_lookup
+from ukbb_parser.updater.checkpoint import atomic_write
+from ukbb_parser.updater.telemetry import telemetry
+from ukbb_parser.updater.utils import init_logger
+
+logger = init_logger(__name__)
+
+FORMAT_VERSION = 1
+# The day of the events without a date, which sort after the dated events of their patient
+MISSING_DAY = np.iinfo(np.int32).max
+# The final table of each source, with the lookup its vocabulary starts from
+SEQUENCE_SOURCES: Dict[str, Tuple[str, Optional[str]]] = {
+    "icd9": ("ehr_diagnosis_icd9", "ehr_diagnosis_icd9"),
+    "icd10": ("ehr_diagnosis_icd10", "ehr_diagnosis_icd10"),
+    "opcs3": ("ehr_procedures_opcs3", "ehr_procedures_opcs3"),
+    "opcs4": ("ehr_procedures_opcs4", "ehr_procedures_opcs4"),
+    "read_2": ("ehr_diagnosis_read2", "ehr_diagnosis_read2"),
+    "read_3": ("ehr_diagnosis_read3", None),
+    "medication": ("gp_medications", None),
+}
+
+
+def main(final_dir: str, sequences_dir: str):
+    """
+    Pack the hospital, GP and medication events of every patient into time-ordered sequences.
+    """
+    tombstones = Tombstones.load(final_dir)
+    events = {}
+    for source, (table, _) in SEQUENCE_SOURCES.items():
+        with telemetry.stage(f"export_sequences.read.{source}") as stage:
+            path = pjoin(final_dir, f"{table}.parquet")
+            stage.read(path)
+            df = pd.read_parquet(path, columns=["date", "feature"])
+            stage.add(rows_in=len(df))
+            if tombstones is not None:
+                withdrawn = tombstones.withdrawn(df.index.to_numpy())
+                df = df.loc[~withdrawn]
+                stage.add(rows_withdrawn=int(withdrawn.sum()))
+            events[source] = _encode_events(df)
+
+    with telemetry.stage("export_sequences.pack") as stage:
+        logger.info("Building the vocabulary.")
+        vocabulary = build_vocabulary({source: uniques for source, (_, _, _, uniques) in events.items()})
+        token_index = pd.MultiIndex.from_frame(vocabulary[["source", "code"]])
+
+        eids, days, tokens = [], [], []
+        for source in list(events):
+            source_eids, source_days, codes, uniques = events.pop(source)
+            tokens_of_codes = token_index.get_indexer(pd.MultiIndex.from_arrays([[source] * len(uniques), uniques]))
+            eids.append(source_eids)
+            days.append(source_days)
+            tokens.append(tokens_of_codes.astype(np.int32)[codes])
+        logger.info("Sorting the events of every patient by day.")
+        eids, offsets, tokens, days = pack(np.concatenate(eids), np.concatenate(days), np.concatenate(tokens))
+        stage.add(rows_out=len(tokens))
+
+        arrays = {"eids": eids, "offsets": offsets, "tokens": tokens, "days": days}
+        write_sequences(sequences_dir, arrays, vocabulary)
+
+
+def _encode_events(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the eids, days, codes and distinct codes of the events with a code, where the codes
+    are positions in the distinct codes.
+    """
+    codes, uniques = pd.factorize(df["feature"])
+    keep = codes >= 0
+    dates = pd.to_datetime(df["date"]).to_numpy().astype("datetime64[D]")
+    days = np.where(np.isnat(dates), MISSING_DAY, dates.astype(np.int64)).astype(np.int32)
+    eids = df.index.to_numpy().astype(np.int64)
+    return eids[keep], days[keep], codes[keep], np.asarray(uniques, dtype=object).astype(str)
+
+
+def build_vocabulary(codes: Dict[str, np.ndarray]) -> pd.DataFrame:
+    """
+    Builds the vocabulary of the sources: the padding token 0 first, then the codes of the lookup of
+    every source, in lookup order, and last the codes only found in the data, sorted. Lookup codes
+    therefore keep their token across releases of the data.
+
+    Args:
+        codes (dict): The distinct codes found in the data of every source.
+    Returns:
+        (pd.DataFrame): The source and code of every token, the token being the row number.
+    """
+    frames = [pd.DataFrame({"source": [""], "code": [""]})]
+    for source, (_, lookup_name) in SEQUENCE_SOURCES.items():
+        if lookup_name is not None:
+            coding = load_lookup(lookup_name)["coding"].astype(str).drop_duplicates()
+            frames.append(pd.DataFrame({"source": source, "code": coding.to_numpy()}))
+    known = pd.concat(frames, ignore_index=True)
+    extra = pd.concat(
+        [pd.DataFrame({"source": source, "code": np.asarray(values, dtype=object)}) for source, values in codes.items()]
+        + [pd.DataFrame({"source": [], "code": []})],
+        ignore_index=True,
+    )
+    extra = extra.merge(known, how="left", indicator=True).query("_merge == 'left_only'").drop(columns="_merge")
+    extra = extra.sort_values(["source", "code"])
+    vocabulary = pd.concat([known, extra], ignore_index=True)
+    vocabulary.index.name = "token"
+    return vocabulary
+
+
+def pack(eids: np.ndarray, days: np.ndarray, tokens: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """
+    Sorts events by eid, day and token and packs them into ragged arrays.
+
+    Returns:
+        (tuple): The sorted distinct eids, the offsets of their events, and the tokens and days.
+    """
+    order = np.lexsort((tokens, days, eids))
+    eids, days, tokens = eids[order], days[order], tokens[order]
+    unique_eids, starts = np.unique(eids, return_index=True)
+    offsets = np.append(starts, len(eids)).astype(np.int64)
+    return unique_eids.astype(np.int64), offsets, tokens.astype(np.int32), days.astype(np.int32)
+
+
+def remove_withdrawn(sequences_dir: str, tombstones: Tombstones) -> int:
+    """
+    Rewrites exported sequences without the patients of the tombstones. The vocabulary is kept, so
+    the tokens of the other patients are unchanged.
+
+    Returns:
+        (int): The number of events removed.
+    """
+    fs = get_filesystem(sequences_dir)
+    arrays = {}
+    for name in ["eids", "offsets", "tokens", "days"]:
+        with fs.open(pjoin(sequences_dir, f"{name}.npy"), "rb") as f:
+            arrays[name] = np.load(f)
+    withdrawn = tombstones.withdrawn(arrays["eids"])
+    if not withdrawn.any():
+        return 0
+    offsets = arrays["offsets"]
+    lengths = np.diff(offsets)
+    events = np.repeat(~withdrawn, lengths)
+    arrays = {
+        "eids": arrays["eids"][~withdrawn],
+        "offsets": np.concatenate([[0], np.cumsum(lengths[~withdrawn])]).astype(np.int64),
+        "tokens": arrays["tokens"][events],
+        "days": arrays["days"][events],
+    }
+    vocabulary = pd.read_parquet(pjoin(sequences_dir, "vocabulary.parquet"))
+    write_sequences(sequences_dir, arrays, vocabulary)
+    return int((~events).sum())
+
+
+def write_sequences(sequences_dir: str, arrays: Dict[str, np.ndarray], vocabulary: pd.DataFrame):
+    fs = get_filesystem(sequences_dir)
+    fs.makedirs(sequences_dir, exist_ok=True)
+    for name, array in arrays.items():
+        with atomic_write(pjoin(sequences_dir, f"{name}.npy")) as tmp_path:
+            with fs.open(tmp_path, "wb") as f:
+                np.save(f, array)
+    with atomic_write(pjoin(sequences_dir, "vocabulary.parquet")) as tmp_path:
+        vocabulary.to_parquet(tmp_path)
+
+    metadata = {
+        "format_version": FORMAT_VERSION,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "patients": len(arrays["eids"]),
+        "events": len(arrays["tokens"]),
+        "tokens": len(vocabulary),
+        "sources": list(SEQUENCE_SOURCES),
+        "missing_day": int(MISSING_DAY),
+    }
+    with atomic_write(pjoin(sequences_dir, "metadata.json")) as tmp_path:
+        with fs.open(tmp_path, "w") as f:
+            json.dump(metadata, f, indent=1)
+    logger.info(f"Exported {metadata['events']} events of {metadata['patients']} patients to {sequences_dir}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--final_dir", type=str, required=True, help="The directory of final derived files.")
+    parser.add_argument("--sequences_dir", type=str, required=True, help="The directory the sequences are written to.")
+    args = parser.parse_args()
+
+    # Run main bit of the function
+    try:
+        logger.info("Exporting patient sequences.")
+        main(final_dir=args.final_dir, sequences_dir=args.sequences_dir)
+        logger.info("The patient sequences have been exported successfully.")
+
+    # Write trace of error
+    except Exception:
+        logger.error(traceback.format_exc())
+        raise
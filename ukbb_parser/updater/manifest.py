@@ -0,0 +1,101 @@
+"""
+Processing script to write the manifest of the final directory.
+"""
+import argparse
+import json
+import traceback
+from datetime import datetime, timezone
+from os.path import join as pjoin
+
+from ukbb_loaders import __version__
+from ukbb_loaders.utilities.filesystem import get_filesystem
+from ukbb_loaders.utilities.manifest import (
+    FORMAT_VERSION,
+    MANIFEST_NAME,
+    code_dictionary_version,
+    describe_table,
+    describe_tombstones,
+)
+from ukbb_parser.updater.checkpoint import atomic_write
+from ukbb_parser.updater.telemetry import telemetry
+from ukbb_parser.updater.utils import init_logger
+
+logger = init_logger(__name__)
+
+
+def main(final_dir: str):
+    """
+    Describe every table of the final directory and write them to its manifest.
+    """
+    fs = get_filesystem(final_dir)
+    file_names = sorted(
+        path.rstrip("/").split("/")[-1] for path in fs.ls(final_dir, detail=False) if path.endswith(".parquet")
+    )
+    tables = {}
+    with telemetry.stage("manifest") as stage:
+        for file_name in file_names:
+            logger.info(f"Describing {file_name}.")
+            tables[file_name] = describe_table(pjoin(final_dir, file_name))
+            stage.add(bytes_read=tables[file_name]["size"])
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "ukbb_loaders_version": __version__,
+        "code_dictionary_version": code_dictionary_version(),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "tables": tables,
+    }
+    tombstones = describe_tombstones(final_dir)
+    if tombstones is not None:
+        manifest["tombstones"] = tombstones
+    _write(final_dir, manifest)
+
+
+def refresh(final_dir: str):
+    """
+    Writes the manifest of the final directory again if it has one, for the scripts that rewrite
+    some of its tables outside update_data.py.
+    """
+    path = pjoin(final_dir, MANIFEST_NAME)
+    if get_filesystem(path).exists(path):
+        logger.info("Updating the manifest of the final directory.")
+        main(final_dir=final_dir)
+
+
+def update_tombstones(final_dir: str):
+    """
+    Records the current tombstones of the final directory in its manifest, without describing the
+    tables again.
+    """
+    path = pjoin(final_dir, MANIFEST_NAME)
+    with get_filesystem(path).open(path, "r") as f:
+        manifest = json.load(f)
+    manifest.pop("tombstones", None)
+    tombstones = describe_tombstones(final_dir)
+    if tombstones is not None:
+        manifest["tombstones"] = tombstones
+    _write(final_dir, manifest)
+
+
+def _write(final_dir: str, manifest: dict):
+    fs = get_filesystem(final_dir)
+    with atomic_write(pjoin(final_dir, MANIFEST_NAME)) as tmp_path:
+        with fs.open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--final_dir", type=str, required=True, help="The directory of final derived files.")
+    args = parser.parse_args()
+
+    # Run main bit of the function
+    try:
+        logger.info("Writing the manifest of the final directory.")
+        main(final_dir=args.final_dir)
+        logger.info("The manifest has been written successfully.")
+
+    # Write trace of error
+    except Exception:
+        logger.error(traceback.format_exc())
+        raise
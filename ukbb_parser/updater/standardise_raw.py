@@ -2,14 +2,27 @@
 Script to load the UKBB data to typed parquet files.
 """
 import argparse
+import io
 import logging
+import math
+import os
+import shutil
+import tempfile
 import traceback
-from typing import List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
 
 from os.path import join as pjoin
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from ukbb_loaders.utilities.filesystem import get_filesystem
+from ukbb_parser.updater.checkpoint import atomic_write
+from ukbb_parser.updater.telemetry import telemetry
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s:%(lineno)d - %(levelname)s - %(message)s",
@@ -18,6 +31,13 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Raw files at least this large are parsed in parallel, in newline-aligned byte ranges of about
+# RANGE_BYTES each
+PARALLEL_MIN_BYTES = 256 * 2 ** 20
+RANGE_BYTES = 64 * 2 ** 20
+# Standardised files are written in row groups of this many rows, whichever path parses them
+STD_ROW_GROUP_SIZE = 1_000_000
+
 
 def get_args():
     """
@@ -42,6 +62,12 @@ def get_args():
         required=True,
         help="Output directory where standardised files will be saved.",
     )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        default=None,
+        help="Number of processes parsing each large raw file. Defaults to the number of CPUs.",
+    )
     return parser.parse_args()
 
 
@@ -149,82 +175,113 @@ def main(
     raw_dir: str,
     std_dir: str,
     withdrawn_file: str,
+    n_workers: int = None,
 ):
+    """
+    Standardise and type every raw file.
+
+    Args:
+        raw_dir (str): The directory of the raw files.
+        std_dir (str): The directory the standardised files are written to.
+        withdrawn_file (str): The file of the eids of the patients who withdrew consent.
+        n_workers (int): The number of processes parsing each raw file of at least
+            PARALLEL_MIN_BYTES. Defaults to the number of CPUs.
+    """
+    n_workers = n_workers or os.cpu_count() or 1
     # Get patients who withdrew consent
     withdrawn = pd.read_csv(withdrawn_file, header=None)
 
     # Process hospital files
     logger.info("Loading hesin")
     dtypes, dates, categories = get_hesin_dtypes()
-    df = pd.read_table(
-        pjoin(raw_dir, "hesin.txt"),
+    _standardise(
+        "hesin",
+        raw_dir=raw_dir,
+        std_dir=std_dir,
+        withdrawn_eids=list(withdrawn[0]),
+        n_workers=n_workers,
+        categories=categories,
         dtype=dtypes,
         parse_dates=dates,
         dayfirst=True,
         infer_datetime_format=True,
         usecols=dtypes.keys(),
     )
-    df = _postprocess_df(df=df, categories=categories, withdrawn_eids=list(withdrawn[0]))
-    df.to_parquet(pjoin(std_dir, "hesin.parquet"))
     logger.info("Saved processed hesin")
-    del df
 
     logger.info("Loading hesin_diag")
     dtypes, _, categories = get_hesin_diag_dtypes()
-    df = pd.read_table(
-        pjoin(raw_dir, "hesin_diag.txt"), dtype=dtypes, usecols=dtypes.keys()
+    _standardise(
+        "hesin_diag",
+        raw_dir=raw_dir,
+        std_dir=std_dir,
+        withdrawn_eids=list(withdrawn[0]),
+        n_workers=n_workers,
+        categories=categories,
+        dtype=dtypes,
+        usecols=dtypes.keys(),
     )
-    df = _postprocess_df(df=df, categories=categories, withdrawn_eids=list(withdrawn[0]))
-    df.to_parquet(pjoin(std_dir, "hesin_diag.parquet"))
     logger.info("Saved processed hesin_diag")
-    del df
 
     logger.info("Loading hesin_oper")
     dtypes, dates, categories = get_hesin_oper_dtypes()
-    df = pd.read_table(
-        pjoin(raw_dir, "hesin_oper.txt"),
+    _standardise(
+        "hesin_oper",
+        raw_dir=raw_dir,
+        std_dir=std_dir,
+        withdrawn_eids=list(withdrawn[0]),
+        n_workers=n_workers,
+        categories=categories,
         dtype=dtypes,
         parse_dates=dates,
         dayfirst=True,
         infer_datetime_format=True,
         usecols=dtypes.keys(),
     )
-    df = _postprocess_df(df=df, categories=categories, withdrawn_eids=list(withdrawn[0]))
-    df.to_parquet(pjoin(std_dir, "hesin_oper.parquet"))
     logger.info("Saved processed hesin_oper")
-    del df
 
     # Process death data
     logger.info("Loading death_cause")
     dtypes, _, categories = get_death_cause_dtypes()
-    df = pd.read_table(
-        pjoin(raw_dir, "death_cause.txt"), dtype=dtypes, usecols=dtypes.keys()
+    _standardise(
+        "death_cause",
+        raw_dir=raw_dir,
+        std_dir=std_dir,
+        withdrawn_eids=list(withdrawn[0]),
+        n_workers=n_workers,
+        categories=categories,
+        dtype=dtypes,
+        usecols=dtypes.keys(),
     )
-    df = _postprocess_df(df=df, categories=categories, withdrawn_eids=list(withdrawn[0]))
-    df.to_parquet(pjoin(std_dir, "death_cause.parquet"))
     logger.info("Saved processed death_cause")
-    del df
 
     logger.info("Loading death")
     dtypes, dates, categories = get_death_dtypes()
-    df = pd.read_table(
-        pjoin(raw_dir, "death.txt"),
+    _standardise(
+        "death",
+        raw_dir=raw_dir,
+        std_dir=std_dir,
+        withdrawn_eids=list(withdrawn[0]),
+        n_workers=n_workers,
+        categories=categories,
         dtype=dtypes,
         parse_dates=dates,
         dayfirst=True,
         infer_datetime_format=True,
         usecols=dtypes.keys(),
     )
-    df = _postprocess_df(df=df, categories=categories, withdrawn_eids=list(withdrawn[0]))
-    df.to_parquet(pjoin(std_dir, "death.parquet"))
     logger.info("Saved processed death")
-    del df
 
     # Process clinical data
     logger.info("Loading gp_clinical")
     dtypes, dates, categories = get_gp_clinical_dtypes()
-    df = pd.read_table(
-        pjoin(raw_dir, "gp_clinical.txt"),
+    _standardise(
+        "gp_clinical",
+        raw_dir=raw_dir,
+        std_dir=std_dir,
+        withdrawn_eids=list(withdrawn[0]),
+        n_workers=n_workers,
+        categories=categories,
         dtype=dtypes,
         encoding="latin1",
         parse_dates=dates,
@@ -232,15 +289,17 @@ def main(
         infer_datetime_format=True,
         usecols=dtypes.keys(),
     )
-    df = _postprocess_df(df=df, categories=categories, withdrawn_eids=list(withdrawn[0]))
-    df.to_parquet(pjoin(std_dir, "gp_clinical.parquet"))
     logger.info("Saved processed gp_clinical")
-    del df
 
     logger.info("Loading gp_scripts")
     dtypes, dates, categories = get_gp_scripts_dtypes()
-    df = pd.read_table(
-        pjoin(raw_dir, "gp_scripts.txt"),
+    _standardise(
+        "gp_scripts",
+        raw_dir=raw_dir,
+        std_dir=std_dir,
+        withdrawn_eids=list(withdrawn[0]),
+        n_workers=n_workers,
+        categories=categories,
         dtype=dtypes,
         encoding="latin1",
         parse_dates=dates,
@@ -248,10 +307,177 @@ def main(
         infer_datetime_format=True,
         usecols=dtypes.keys(),
     )
-    df = _postprocess_df(df=df, categories=categories, withdrawn_eids=list(withdrawn[0]))
-    df.to_parquet(pjoin(std_dir, "gp_scripts.parquet"))
     logger.info("Saved processed gp_scripts")
-    del df
+
+
+def _standardise(
+    name: str,
+    raw_dir: str,
+    std_dir: str,
+    withdrawn_eids: list,
+    categories: list,
+    n_workers: int = 1,
+    **read_kwargs,
+):
+    """
+    Reads, types and filters one raw file, and saves it as parquet, recording the telemetry of
+    the stage. Files of at least PARALLEL_MIN_BYTES are parsed by `n_workers` processes.
+    """
+    raw_path, std_path = pjoin(raw_dir, f"{name}.txt"), pjoin(std_dir, f"{name}.parquet")
+    with telemetry.stage(f"standardise_raw.{name}") as stage:
+        stage.read(raw_path)
+        if n_workers > 1 and get_filesystem(raw_path).size(raw_path) >= PARALLEL_MIN_BYTES:
+            rows_in, rows_out = _standardise_parallel(
+                raw_path, std_path, withdrawn_eids, categories, n_workers, **read_kwargs
+            )
+            stage.add(rows_in=rows_in, rows_withdrawn=rows_in - rows_out, rows_out=rows_out)
+        else:
+            df = pd.read_table(raw_path, **read_kwargs)
+            stage.add(rows_in=len(df))
+            df = _postprocess_df(df=df, categories=categories, withdrawn_eids=withdrawn_eids)
+            stage.add(rows_withdrawn=stage.counters["rows_in"] - len(df), rows_out=len(df))
+            with atomic_write(std_path) as tmp_path:
+                df.to_parquet(tmp_path, index=False, row_group_size=STD_ROW_GROUP_SIZE)
+        stage.wrote(std_path)
+
+
+def _standardise_parallel(
+    raw_path: str,
+    std_path: str,
+    withdrawn_eids: list,
+    categories: list,
+    n_workers: int,
+    range_bytes: int = None,
+    row_group_size: int = STD_ROW_GROUP_SIZE,
+    **read_kwargs,
+) -> Tuple[int, int]:
+    """
+    Parses a raw file in newline-aligned byte ranges, each in a worker process, and writes the
+    ranges in order to one parquet file, in row groups of `row_group_size` rows whatever the size
+    of the ranges. The categorical columns of every row group share the union of the categories
+    found in all ranges.
+
+    Returns:
+        (int, int): The number of rows read and written.
+    """
+    read_kwargs["usecols"] = list(read_kwargs.get("usecols") or []) or None
+    ranges, header = _split_ranges(raw_path, range_bytes or RANGE_BYTES)
+    logger.info(f"Parsing {raw_path} in {len(ranges)} ranges with {n_workers} processes.")
+
+    parts_dir = tempfile.mkdtemp(prefix="ukbb_standardise_")
+    try:
+        parts = [pjoin(parts_dir, f"part-{i:05d}.parquet") for i in range(len(ranges))]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [
+                executor.submit(
+                    _parse_range, raw_path, start, end, header, part, withdrawn_eids, categories, read_kwargs
+                )
+                for (start, end), part in zip(ranges, parts)
+            ]
+            results = [future.result() for future in futures]
+
+        dictionaries = {
+            col: pa.array(sorted(set().union(*(result["categories"][col] for result in results))), type=pa.string())
+            for col in categories
+        }
+        schema = _unify_schemas([pq.read_schema(part) for part in parts], dictionaries)
+        with atomic_write(std_path) as tmp_path:
+            with get_filesystem(tmp_path).open(tmp_path, "wb") as f, pq.ParquetWriter(f, schema) as writer:
+                pending = schema.empty_table()
+                for part in parts:
+                    table = pq.read_table(part)
+                    for col, dictionary in dictionaries.items():
+                        table = table.set_column(
+                            table.schema.get_field_index(col), col, _encode(table.column(col), dictionary)
+                        )
+                    # Full row groups are written as soon as the parsed ranges fill them
+                    pending = pa.concat_tables([pending, table.cast(schema)])
+                    full = pending.num_rows // row_group_size * row_group_size
+                    if full:
+                        writer.write_table(pending.slice(0, full), row_group_size=row_group_size)
+                        pending = pending.slice(full)
+                if pending.num_rows:
+                    writer.write_table(pending)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    return sum(result["rows_in"] for result in results), sum(result["rows_out"] for result in results)
+
+
+def _split_ranges(raw_path: str, range_bytes: int) -> Tuple[List[Tuple[int, int]], bytes]:
+    """
+    Splits the body of a text file into byte ranges of about `range_bytes`, each starting at the
+    beginning of a line. Returns the ranges and the header line.
+    """
+    fs = get_filesystem(raw_path)
+    size = fs.size(raw_path)
+    with fs.open(raw_path, "rb") as f:
+        header = f.readline()
+        boundaries = {len(header), size}
+        for i in range(1, math.ceil((size - len(header)) / range_bytes)):
+            # The first line ending at or after the nominal boundary ends the range
+            f.seek(len(header) + i * range_bytes - 1)
+            f.readline()
+            boundaries.add(min(f.tell(), size))
+    boundaries = sorted(boundaries)
+    return list(zip(boundaries[:-1], boundaries[1:])), header
+
+
+def _parse_range(
+    raw_path: str,
+    start: int,
+    end: int,
+    header: bytes,
+    part_path: str,
+    withdrawn_eids: list,
+    categories: list,
+    read_kwargs: dict,
+) -> dict:
+    """
+    Parses and filters one byte range of a raw file into a parquet part, in a worker process.
+    """
+    with get_filesystem(raw_path).open(raw_path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    df = pd.read_table(io.BytesIO(header + data), **read_kwargs)
+    rows_in = len(df)
+    df = _postprocess_df(df=df, categories=categories, withdrawn_eids=withdrawn_eids)
+    df.to_parquet(part_path, index=False)
+    return {
+        "rows_in": rows_in,
+        "rows_out": len(df),
+        "categories": {col: set(df[col].cat.categories.astype(str)) for col in categories},
+    }
+
+
+def _unify_schemas(schemas: List[pa.Schema], dictionaries: Dict[str, pa.Array]) -> pa.Schema:
+    """
+    Returns the schema of the parts of a file, taking the type of each column from the parts in
+    which it is not entirely missing.
+    """
+    fields = []
+    for field in schemas[0]:
+        if field.name in dictionaries:
+            fields.append(pa.field(field.name, pa.dictionary(pa.int32(), pa.string())))
+            continue
+        types = {schema.field(field.name).type for schema in schemas} - {pa.null()}
+        if len(types) > 1:
+            raise ValueError(
+                f"The {field.name} column was parsed as different types {types} in different parts of the file. "
+                "Parse it with n_workers=1."
+            )
+        fields.append(pa.field(field.name, types.pop() if types else pa.null()))
+    return pa.schema(fields, metadata=schemas[0].metadata)
+
+
+def _encode(column: pa.ChunkedArray, dictionary: pa.Array) -> pa.Array:
+    """
+    Dictionary encodes a categorical column against the shared dictionary of all the parts.
+    """
+    values = column.combine_chunks()
+    if pa.types.is_dictionary(values.type):
+        values = values.cast(values.type.value_type)
+    indices = pc.index_in(values.cast(pa.string()), value_set=dictionary)
+    return pa.DictionaryArray.from_arrays(indices, dictionary)
 
 
 if __name__ == "__main__":
@@ -264,6 +490,7 @@ if __name__ == "__main__":
             raw_dir=args.raw_dir,
             std_dir=args.std_dir,
             withdrawn_file=args.withdrawn_file,
+            n_workers=args.n_workers,
         )
         logger.info("Standardisation and typing completed successfully.")
 
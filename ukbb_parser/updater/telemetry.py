@@ -0,0 +1,352 @@
+"""
+Per-stage performance telemetry for the pre-processing pipeline.
+"""
+import json
+import logging
+import os
+import resource
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from ukbb_loaders.utilities.filesystem import get_filesystem
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Interval between two samples of the resident memory of the process and of its worker processes
+SAMPLE_INTERVAL = 0.05
+COUNTERS = ["rows_in", "rows_out", "rows_withdrawn", "bytes_read", "bytes_written"]
+
+
+class Stage:
+    def __init__(self, name: str):
+        """
+        The measurements of one pipeline stage.
+
+        Args:
+            name (str): The name of the stage, e.g. standardise_raw.hesin.
+        """
+        self.name = name
+        self.status = "running"
+        self.started_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        self.wall_seconds: Optional[float] = None
+        self.cpu_seconds: Optional[float] = None
+        self.peak_rss_bytes: Optional[int] = None
+        self.children_cpu_seconds: Optional[float] = None
+        self.children_peak_rss_bytes: Optional[int] = None
+        self.counters = {counter: 0 for counter in COUNTERS}
+
+    def add(self, **counts: int):
+        """
+        Adds to the counters of the stage, e.g. add(rows_in=len(df)).
+        """
+        for counter, count in counts.items():
+            if counter not in self.counters:
+                raise ValueError(f"The counter argument should be one of {COUNTERS}")
+            self.counters[counter] += int(count)
+
+    def read(self, path: str):
+        """
+        Counts the size of a file read by the stage.
+        """
+        self.add(bytes_read=_size(path))
+
+    def wrote(self, path: str):
+        """
+        Counts the size of a file written by the stage.
+        """
+        self.add(bytes_written=_size(path))
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "status": self.status,
+            "started_at": self.started_at,
+            "wall_seconds": self.wall_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "peak_rss_bytes": self.peak_rss_bytes,
+            "children_cpu_seconds": self.children_cpu_seconds,
+            "children_peak_rss_bytes": self.children_peak_rss_bytes,
+            **self.counters,
+        }
+
+
+class Telemetry:
+    def __init__(self):
+        """
+        Collects the measurements of every stage of a pipeline run.
+
+        The report is rewritten whenever a stage starts or ends, so a run killed for running out of
+        memory still leaves behind a report naming the stage that was running.
+        """
+        self.stages: List[Stage] = []
+        self.report_path: Optional[str] = None
+        self.sinks: List[Callable[[dict], None]] = []
+        self._active: List[Stage] = []
+
+    def configure(self, report_path: str = None, sinks: List[Callable[[dict], None]] = None):
+        """
+        Starts a new run, setting where the report is written and the sinks each finished stage is
+        exported to.
+
+        Args:
+            report_path (str): The local or s3 path of the JSON report.
+            sinks (list): Callables receiving the record of each finished stage, e.g. `statsd_sink()`.
+        """
+        self.stages = []
+        self.report_path = report_path
+        self.sinks = list(sinks or [])
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measures a stage. Counters are added through the yielded Stage.
+
+        The CPU time and peak memory include the worker processes the stage starts, e.g. to parse
+        large raw files, which are also reported on their own as children_cpu_seconds and
+        children_peak_rss_bytes.
+
+        Example:
+            >>> with telemetry.stage("standardise_raw.hesin") as stage:
+            ...     df = pd.read_table(path)
+            ...     stage.add(rows_in=len(df))
+        """
+        record = Stage(name)
+        self.stages.append(record)
+        self._active.append(record)
+        self.write()
+        sampler = _PeakSampler()
+        wall, cpu, children_cpu = time.perf_counter(), time.process_time(), _children_cpu()
+        try:
+            yield record
+            record.status = "done"
+        except BaseException:
+            record.status = "failed"
+            raise
+        finally:
+            record.wall_seconds = round(time.perf_counter() - wall, 3)
+            # The CPU time of the worker processes is only counted once they have exited
+            record.children_cpu_seconds = round(_children_cpu() - children_cpu, 3)
+            record.cpu_seconds = round(time.process_time() - cpu + record.children_cpu_seconds, 3)
+            record.peak_rss_bytes, record.children_peak_rss_bytes = sampler.stop()
+            self._active.remove(record)
+            workers = ""
+            if record.children_cpu_seconds or record.children_peak_rss_bytes:
+                workers = (
+                    f" (workers: {record.children_cpu_seconds:.1f}s CPU, "
+                    f"{(record.children_peak_rss_bytes or 0) / 2 ** 20:.0f}MB peak)"
+                )
+            logger.info(
+                f"{name}: {record.wall_seconds:.1f}s wall, {record.cpu_seconds:.1f}s CPU, "
+                f"{(record.peak_rss_bytes or 0) / 2 ** 20:.0f}MB peak{workers}, "
+                f"{record.counters['rows_in']} rows in, {record.counters['rows_out']} rows out"
+            )
+            self.write()
+            self._export(record)
+
+    def current(self) -> Optional[Stage]:
+        """
+        Returns the innermost running stage, if any.
+        """
+        return self._active[-1] if self._active else None
+
+    def report(self) -> dict:
+        return {
+            "peak_rss_bytes": _max_rss(),
+            "stages": [stage.to_dict() for stage in self.stages],
+        }
+
+    def write(self):
+        if self.report_path is None:
+            return
+        try:
+            with get_filesystem(self.report_path).open(self.report_path, "w") as f:
+                json.dump(self.report(), f, indent=1)
+        except OSError:
+            logger.warning(f"Could not write the telemetry report to {self.report_path}.")
+
+    def _export(self, record: Stage):
+        for sink in self.sinks:
+            try:
+                sink(record.to_dict())
+            except Exception:
+                logger.warning(f"Could not export the telemetry of {record.name}.", exc_info=True)
+
+
+def record(**counts: int):
+    """
+    Adds to the counters of the running stage, if any.
+    """
+    stage = telemetry.current()
+    if stage is not None:
+        stage.add(**counts)
+
+
+def record_read(path: str):
+    """
+    Counts a file read by the running stage, if any.
+    """
+    stage = telemetry.current()
+    if stage is not None:
+        stage.read(path)
+
+
+def record_written(path: str):
+    """
+    Counts a file written by the running stage, if any.
+    """
+    stage = telemetry.current()
+    if stage is not None:
+        stage.wrote(path)
+
+
+def statsd_sink(host: str = "localhost", port: int = 8125, prefix: str = "ukbb_parser") -> Callable[[dict], None]:
+    """
+    Returns a sink sending the measurements of each stage to a StatsD daemon over UDP, as timings
+    and gauges named <prefix>.<stage>.<measurement>.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(record: dict):
+        name = f"{prefix}.{record['name']}"
+        lines = [
+            f"{name}.wall_ms:{record['wall_seconds'] * 1000:.0f}|ms",
+            f"{name}.cpu_ms:{record['cpu_seconds'] * 1000:.0f}|ms",
+        ]
+        if record["peak_rss_bytes"] is not None:
+            lines.append(f"{name}.peak_rss_bytes:{record['peak_rss_bytes']}|g")
+        if record["children_cpu_seconds"] is not None:
+            lines.append(f"{name}.children_cpu_ms:{record['children_cpu_seconds'] * 1000:.0f}|ms")
+        if record["children_peak_rss_bytes"] is not None:
+            lines.append(f"{name}.children_peak_rss_bytes:{record['children_peak_rss_bytes']}|g")
+        lines += [f"{name}.{counter}:{record[counter]}|g" for counter in COUNTERS]
+        sock.sendto("\n".join(lines).encode(), (host, port))
+
+    return send
+
+
+class _PeakSampler:
+    def __init__(self):
+        """
+        Samples the resident memory of the process and of its worker processes in a background
+        thread until stopped, as the kernel only keeps the peak over the whole life of a process.
+        """
+        self.peak = _current_rss()
+        self.children_peak = 0
+        # Without a listing of the children, their peak is taken from getrusage when stopped
+        self._children_listed = _children_rss() is not None
+        self._stop = threading.Event()
+        self._thread = None
+        if self.peak is not None:
+            self._sample()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            self._sample()
+
+    def _sample(self):
+        children = _children_rss() or 0
+        self.children_peak = max(self.children_peak, children)
+        self.peak = max(self.peak, (_current_rss() or 0) + children)
+
+    def stop(self) -> Tuple[Optional[int], Optional[int]]:
+        """
+        Returns the peak memory of the process and its workers together, and of the workers alone.
+        """
+        if self._thread is None:
+            return _max_rss(), _max_rss(resource.RUSAGE_CHILDREN)
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        if not self._children_listed:
+            return self.peak, _max_rss(resource.RUSAGE_CHILDREN)
+        return self.peak, self.children_peak
+
+
+def _current_rss() -> Optional[int]:
+    """
+    Returns the resident memory of the process in bytes, where /proc is available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _children_rss() -> Optional[int]:
+    """
+    Returns the resident memory of the child processes in bytes, or None where the kernel does not
+    list them.
+
+    The children, such as the workers of a ProcessPoolExecutor, are listed by each thread of the
+    process in /proc/self/task/<tid>/children, so only their own files are read rather than those
+    of every process on the host.
+    """
+    try:
+        tasks = os.listdir("/proc/self/task")
+    except OSError:
+        return None
+    if not os.path.exists(f"/proc/self/task/{os.getpid()}/children"):
+        return None
+    total = 0
+    for task in tasks:
+        try:
+            with open(f"/proc/self/task/{task}/children") as f:
+                pids = f.read().split()
+        except OSError:
+            # The thread has exited since the listing
+            continue
+        for pid in pids:
+            try:
+                with open(f"/proc/{pid}/statm") as f:
+                    total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            except (OSError, ValueError, IndexError):
+                continue
+    return total
+
+
+def _children_cpu() -> float:
+    """
+    Returns the CPU time of the child processes that have exited and been waited for, in seconds.
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _max_rss(who: int = resource.RUSAGE_SELF) -> int:
+    """
+    Returns the peak resident memory of the process, or of its largest child, so far, in bytes.
+    """
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+def _size(path: str) -> int:
+    try:
+        return int(get_filesystem(path).size(path))
+    except (OSError, TypeError):
+        return 0
+
+
+telemetry = Telemetry()
+
+
+def summary(stages: List[Dict]) -> str:
+    """
+    Formats stage records as a table for the logs.
+    """
+    lines = [f"{'stage':<40}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}{'rows in':>12}{'rows out':>12}"]
+    for record in stages:
+        lines.append(
+            f"{record['name']:<40}{record['wall_seconds'] or 0:>10.1f}{record['cpu_seconds'] or 0:>10.1f}"
+            f"{(record['peak_rss_bytes'] or 0) / 2 ** 20:>10.0f}{record['rows_in']:>12}{record['rows_out']:>12}"
+        )
+    return "\n".join(lines)
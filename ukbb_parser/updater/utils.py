@@ -1,5 +1,18 @@
 import argparse
 import logging
+from os.path import join as pjoin
+
+import numpy as np
+import pandas as pd
+
+from ukbb_parser.updater.checkpoint import atomic_write
+from ukbb_parser.updater.telemetry import record, record_written
+
+# Suffix of the inverted code index written next to each final table
+CODE_INDEX_SUFFIX = ".code_index.parquet"
+CODE_INDEX_ROW_GROUP_SIZE = 100_000
+# Final tables are sorted by eid, so each row group covers a narrow eid range that readers can skip
+FINAL_ROW_GROUP_SIZE = 250_000
 
 
 def get_args():
@@ -31,3 +44,36 @@ def init_logger(module_name: str):
     logger.setLevel(logging.INFO)
 
     return logger
+
+
+def save_final_table(df: pd.DataFrame, final_dir: str, name: str):
+    """
+    Saves a final table, sorted by eid, together with its inverted code index.
+    """
+    df = df.sort_index(kind="stable")
+    path = pjoin(final_dir, f"{name}.parquet")
+    with atomic_write(path) as tmp_path:
+        df.to_parquet(tmp_path, row_group_size=FINAL_ROW_GROUP_SIZE)
+    write_code_index(df=df, final_dir=final_dir, name=name)
+    record(rows_out=len(df))
+    record_written(path)
+    record_written(pjoin(final_dir, f"{name}{CODE_INDEX_SUFFIX}"))
+
+
+def write_code_index(df: pd.DataFrame, final_dir: str, name: str):
+    """
+    Writes the inverted index of a final table, mapping each code to its patients and row positions.
+
+    The index holds one (feature, eid, row) entry per row of the final table with a code, sorted
+    by code and then by eid, so the entries of a code are contiguous and the row group statistics
+    let readers skip straight to them.
+    """
+    # Rows without a code have no entry, rather than one under the string "nan"
+    coded = df["feature"].notna().to_numpy()
+    features = df["feature"].to_numpy()[coded].astype(str)
+    eids = df.index.to_numpy()[coded]
+    rows = np.flatnonzero(coded).astype(np.int64)
+    order = np.lexsort((rows, eids, features))
+    index = pd.DataFrame({"feature": features[order], "eid": eids[order], "row": rows[order]})
+    with atomic_write(pjoin(final_dir, f"{name}{CODE_INDEX_SUFFIX}")) as tmp_path:
+        index.to_parquet(tmp_path, index=False, row_group_size=CODE_INDEX_ROW_GROUP_SIZE)
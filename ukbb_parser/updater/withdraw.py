@@ -0,0 +1,135 @@
+"""
+Processing script to honour a new list of withdrawn consent eids without reprocessing.
+
+The withdrawn eids are recorded as tombstones in the final directory, which the loaders apply to
+every read as soon as they are written. The patient sequences exported next to the final directory
+are rewritten without them at once, as their reader does not apply tombstones. With --compact, the tables holding rows of withdrawn
+patients are then rewritten without them. The tombstones are kept after compacting, so they still
+hide the patients from tables derived again from older standardised files.
+"""
+import argparse
+import posixpath
+import traceback
+from os.path import join as pjoin
+from typing import List, Optional
+
+import pandas as pd
+
+from ukbb_loaders.utilities.filesystem import get_filesystem
+from ukbb_loaders.utilities.manifest import MANIFEST_NAME, Manifest
+from ukbb_loaders.utilities.tombstones import TOMBSTONES_NAME, Tombstones
+from ukbb_parser.updater import export_sequences, manifest
+from ukbb_parser.updater.checkpoint import atomic_write
+from ukbb_parser.updater.telemetry import telemetry
+from ukbb_parser.updater.utils import CODE_INDEX_SUFFIX, init_logger, save_final_table
+
+logger = init_logger(__name__)
+
+
+def main(final_dir: str, withdrawn_file: str, compact: bool = False, sequences_dir: Optional[str] = None):
+    """
+    Add the eids of a withdrawn consent file to the tombstones of the final directory, remove them
+    from the exported patient sequences, and rewrite the affected tables without them if compacting.
+
+    Args:
+        final_dir (str): The directory of final derived files.
+        withdrawn_file (str): File with withdrawn consent eids.
+        compact (bool): Whether to rewrite the tables holding rows of withdrawn patients.
+        sequences_dir (str): The directory of the exported patient sequences. Defaults to the
+            sequences directory next to final_dir, as written by update_data.py.
+    """
+    current = Manifest.load(final_dir)
+    if current is None:
+        raise ValueError(f"{final_dir} has no {MANIFEST_NAME} to record the withdrawals in. Re-run update_data.py.")
+
+    withdrawn = pd.read_csv(withdrawn_file, header=None)[0].to_numpy()
+    tombstones = Tombstones.load(final_dir)
+    tombstones = Tombstones.from_eids(withdrawn) if tombstones is None else tombstones.union(withdrawn)
+    path = pjoin(final_dir, TOMBSTONES_NAME)
+    with atomic_write(path) as tmp_path:
+        with get_filesystem(tmp_path).open(tmp_path, "wb") as f:
+            tombstones.write(f)
+    manifest.update_tombstones(final_dir)
+    logger.info(f"{len(tombstones)} patients are withdrawn from {final_dir}.")
+
+    if sequences_dir is None:
+        sequences_dir = posixpath.join(posixpath.dirname(final_dir.rstrip("/")), "sequences")
+    remove_from_sequences(sequences_dir, tombstones)
+
+    if compact:
+        file_names = [file_name for file_name in current.tables if not file_name.endswith(CODE_INDEX_SUFFIX)]
+        compacted = compact_tables(final_dir, sorted(file_names), tombstones)
+        if compacted:
+            manifest.main(final_dir=final_dir)
+
+
+def remove_from_sequences(sequences_dir: str, tombstones: Tombstones):
+    """
+    Rewrites the exported patient sequences without the withdrawn patients, if they were exported.
+    """
+    if not get_filesystem(sequences_dir).exists(pjoin(sequences_dir, "metadata.json")):
+        logger.info(f"No patient sequences were exported to {sequences_dir}.")
+        return
+    with telemetry.stage("withdraw.sequences") as stage:
+        removed = export_sequences.remove_withdrawn(sequences_dir, tombstones)
+        stage.add(rows_withdrawn=removed)
+    logger.info(f"Removed {removed} events of withdrawn patients from the sequences in {sequences_dir}.")
+
+
+def compact_tables(final_dir: str, file_names: List[str], tombstones: Tombstones) -> List[str]:
+    """
+    Rewrites the given final tables and their code indexes without the rows of withdrawn patients.
+    Tables without such rows are left untouched.
+
+    Returns:
+        (list): The tables rewritten.
+    """
+    compacted = []
+    for file_name in file_names:
+        path = pjoin(final_dir, file_name)
+        eids = pd.read_parquet(path, columns=[]).index.to_numpy()
+        withdrawn = tombstones.withdrawn(eids)
+        if not withdrawn.any():
+            continue
+        with telemetry.stage(f"withdraw.{file_name[: -len('.parquet')]}") as stage:
+            logger.info(f"Removing {withdrawn.sum()} rows of withdrawn patients from {file_name}.")
+            stage.read(path)
+            df = pd.read_parquet(path)
+            stage.add(rows_in=len(df), rows_withdrawn=int(withdrawn.sum()))
+            save_final_table(df.loc[~withdrawn], final_dir=final_dir, name=file_name[: -len(".parquet")])
+        compacted.append(file_name)
+    return compacted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--final_dir", type=str, required=True, help="The directory of final derived files.")
+    parser.add_argument("--withdrawn_file", type=str, required=True, help="File with withdrawn consent eids")
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Rewrite the tables holding rows of withdrawn patients without them.",
+    )
+    parser.add_argument(
+        "--sequences_dir",
+        type=str,
+        default=None,
+        help="The directory of the exported patient sequences. Defaults to the sequences directory next to final_dir.",
+    )
+    args = parser.parse_args()
+
+    # Run main bit of the function
+    try:
+        logger.info("Recording withdrawn patients.")
+        main(
+            final_dir=args.final_dir,
+            withdrawn_file=args.withdrawn_file,
+            compact=args.compact,
+            sequences_dir=args.sequences_dir,
+        )
+        logger.info("The withdrawals have been recorded successfully.")
+
+    # Write trace of error
+    except Exception:
+        logger.error(traceback.format_exc())
+        raise